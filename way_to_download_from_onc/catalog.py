@@ -0,0 +1,170 @@
+import sqlite3
+
+import pandas as pd
+
+from utils import pandas_timestamp_to_onc_format
+
+
+def merge_filters(filters):
+    '''
+    Merge the filters that share a device code and extension when their date
+    ranges overlap or touch, so that no date range is listed twice.
+    '''
+
+    grouped_filters = {}
+    for new_filter in filters:
+        key = (new_filter["deviceCode"], new_filter.get("extension"))
+        grouped_filters.setdefault(key, []).append(
+            (pd.Timestamp(new_filter["dateFrom"]), pd.Timestamp(new_filter["dateTo"]), new_filter)
+        )
+
+    merged_filters = []
+    for intervals in grouped_filters.values():
+        intervals.sort(key=lambda interval: interval[0])
+
+        date_from, date_to, template = intervals[0]
+        for next_from, next_to, _ in intervals[1:]:
+            if next_from <= date_to:
+                date_to = max(date_to, next_to)
+                continue
+
+            merged_filters.append(_filter_with_dates(template, date_from, date_to))
+            date_from, date_to = next_from, next_to
+
+        merged_filters.append(_filter_with_dates(template, date_from, date_to))
+
+    return merged_filters
+
+
+def _filter_with_dates(_template, _date_from, _date_to):
+    new_filter = dict(_template)
+    new_filter["dateFrom"] = pandas_timestamp_to_onc_format(_date_from)
+    new_filter["dateTo"] = pandas_timestamp_to_onc_format(_date_to)
+
+    return new_filter
+
+
+class ListingCatalog:
+    '''
+    Local SQLite cache of ONC archive file listings, keyed by device code,
+    extension and the date ranges that have already been listed.
+    '''
+
+    def __init__(self, catalog_path, settle_time=pd.Timedelta(days=1)):
+        # ONC keeps archiving files for a while, so the most recent dates are never considered fully listed.
+        self.settled_until = pd.Timestamp.now(tz="UTC") - settle_time
+
+        self.connection = sqlite3.connect(catalog_path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS coverage ("
+            "device_code TEXT NOT NULL, "
+            "extension TEXT NOT NULL, "
+            "date_from TEXT NOT NULL, "
+            "date_to TEXT NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "filename TEXT PRIMARY KEY, "
+            "device_code TEXT NOT NULL, "
+            "extension TEXT NOT NULL, "
+            "date_from TEXT, "
+            "date_to TEXT, "
+            "file_size INTEGER, "
+            "md5 TEXT)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS files_by_date ON files (device_code, extension, date_from)"
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def missing_ranges(self, new_filter):
+        '''
+        Return the (dateFrom, dateTo) ranges of the filter that have not been
+        listed yet.
+        '''
+
+        date_from = pd.Timestamp(new_filter["dateFrom"])
+        date_to = pd.Timestamp(new_filter["dateTo"])
+
+        covered = self.connection.execute(
+            "SELECT date_from, date_to FROM coverage "
+            "WHERE device_code = ? AND extension = ? AND date_to > ? AND date_from < ? "
+            "ORDER BY date_from",
+            (
+                new_filter["deviceCode"],
+                new_filter.get("extension", ""),
+                pandas_timestamp_to_onc_format(date_from),
+                pandas_timestamp_to_onc_format(date_to),
+            ),
+        ).fetchall()
+
+        missing = []
+        cursor = date_from
+        for covered_from, covered_to in covered:
+            covered_from = pd.Timestamp(covered_from)
+            covered_to = pd.Timestamp(covered_to)
+            if covered_from > cursor:
+                missing.append((cursor, min(covered_from, date_to)))
+            cursor = max(cursor, covered_to)
+
+        if cursor < date_to:
+            missing.append((cursor, date_to))
+
+        return [
+            (pandas_timestamp_to_onc_format(begin), pandas_timestamp_to_onc_format(end))
+            for begin, end in missing
+        ]
+
+    def add_listing(self, new_filter, date_from, date_to, files):
+        device_code = new_filter["deviceCode"]
+        extension = new_filter.get("extension", "")
+
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        file["filename"],
+                        device_code,
+                        extension,
+                        file.get("dateFrom"),
+                        file.get("dateTo"),
+                        file.get("fileSize"),
+                        file.get("md5"),
+                    )
+                    for file in files
+                ],
+            )
+
+            settled_to = min(pd.Timestamp(date_to), self.settled_until)
+            if pd.Timestamp(date_from) < settled_to:
+                self.connection.execute(
+                    "INSERT INTO coverage VALUES (?, ?, ?, ?)",
+                    (device_code, extension, date_from, pandas_timestamp_to_onc_format(settled_to)),
+                )
+
+    def get_files(self, new_filter):
+        '''
+        Return the cached listing entries whose data overlaps the date range
+        of the filter, in the same shape as the ONC "files" entries.
+        '''
+
+        rows = self.connection.execute(
+            "SELECT filename, date_from, date_to, file_size, md5 FROM files "
+            "WHERE device_code = ? AND extension = ? "
+            "AND date_from < ? AND COALESCE(date_to, date_from) >= ?",
+            (
+                new_filter["deviceCode"],
+                new_filter.get("extension", ""),
+                new_filter["dateTo"],
+                new_filter["dateFrom"],
+            ),
+        )
+
+        return [
+            {"filename": filename, "dateFrom": date_from, "dateTo": date_to, "fileSize": file_size, "md5": md5}
+            for filename, date_from, date_to, file_size, md5 in rows
+        ]
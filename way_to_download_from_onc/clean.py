@@ -1,58 +1,33 @@
 import os
 import re
 import time
-import xmltodict
-from tqdm import tqdm
-import geopy.distance
-import multiprocessing 
 import sys
 import numpy as np
 import pandas as pd
 
 from functools import partial
 
+from geodesic import geodesic_distance
+from registry import load_mmsi_registry
+
 from utils import (
     bcolors,
     ais_params,
     get_num_of_threads,
     get_hydrophone_deployments,
-    read_messages_from_json_file,
+    get_coarse_bounds,
+    get_deployment_partition_name,
+    create_dir,
+    list_downloaded_files,
+    is_parsed_ais_file,
+    zulu_column_to_timestamps,
+    zulu_strings_to_nanoseconds,
+    read_parsed_ais_file,
     dump_data_frame_to_feather_file,
+    run_tasks,
 )
 
 
-def _vectorised_distance_to_hydrophone(
-    _hydrophone_x,
-    _hydrophone_y,
-    _vessel_x,
-    _vessel_y,
-    _inclusion_radius,
-    _left_bound,
-    _right_bound,
-    _top_bound,
-    _bottom_bound,
-):
-
-    # The data should be 'clean' by this point, but sanity check the input anyway.
-    if np.isnan(_vessel_x) or np.isnan(_vessel_y):
-        return np.nan
-
-    # We do a quick dead reckoning distance calculation as that is faster than a full geodesic calculation.
-    if (_bottom_bound <= _vessel_y <= _top_bound) and (
-        _left_bound <= _vessel_x <= _right_bound
-    ):
-        # Then do a more precise geodesic distance calculation.
-        distance = geopy.distance.geodesic(
-            (_hydrophone_y, _hydrophone_x), (_vessel_y, _vessel_x)
-        ).meters
-        if (np.ceil(distance).astype("int")) <= int(_inclusion_radius):
-            return distance
-        else:
-            return np.nan
-    else:
-        return np.nan
-
-
 def distance_calculation_for_chunks(
     _deployment_longitude,
     _deployment_latitude,
@@ -64,57 +39,220 @@ def distance_calculation_for_chunks(
     _chunk,
 ):
 
-    _chunk["distance_to_hydrophone"] = np.vectorize(_vectorised_distance_to_hydrophone)(
-        _deployment_longitude,
-        _deployment_latitude,
-        _chunk[ais_params.X].values,
-        _chunk[ais_params.Y].values,
-        _inclusion_radius,
-        _coarse_longitude_left_bound,
-        _coarse_longitude_right_bound,
-        _coarse_latitude_top_bound,
-        _coarse_latitude_bottom_bound,
+    vessel_x = _chunk[ais_params.X].values
+    vessel_y = _chunk[ais_params.Y].values
+
+    # We do a quick dead reckoning distance calculation as that is faster than a full geodesic calculation.
+    # NaN coordinates fail every comparison, so they are left out here.
+    in_bounds = (
+        (_coarse_latitude_bottom_bound <= vessel_y)
+        & (vessel_y <= _coarse_latitude_top_bound)
+        & (_coarse_longitude_left_bound <= vessel_x)
+        & (vessel_x <= _coarse_longitude_right_bound)
+    )
+
+    # Then do a more precise geodesic distance calculation, on the whole column at once.
+    distance = np.full(vessel_x.shape, np.nan)
+    distance[in_bounds] = geodesic_distance(
+        _deployment_latitude, _deployment_longitude, vessel_y[in_bounds], vessel_x[in_bounds]
     )
+    distance[~(np.ceil(distance) <= int(_inclusion_radius))] = np.nan
+
+    _chunk["distance_to_hydrophone"] = distance
 
     return _chunk
 
 
+# The CTD files hold one '<date> <?xml ...?><datapacket>...<data><t1>...</t1>...</data>...' packet per line.
+CTD_LINE_REGEX = re.compile(rb"^([^<\r\n]*?)\s*<\?xml[^\r\n]*?<data>([^\r\n]*?)</data>", re.MULTILINE)
+CTD_FIELD_REGEX = re.compile(rb"<(\w+)[^>/]*>\s*([^<]*?)\s*</\1>")
+CTD_COLUMNS = ["t1", "c1", "p1", "sal", "sv"]
+# Lines with exactly the CTD_COLUMNS, in this order, are matched at once over the whole file.
+CTD_PACKET_REGEX = re.compile(
+    rb"^([^<\r\n]*?)\s*<\?xml[^\r\n]*?<data>"
+    + b"".join(rb"\s*<%s>\s*([^<]*?)\s*</%s>" % (column.encode(), column.encode()) for column in CTD_COLUMNS)
+    + rb"\s*</data>",
+    re.MULTILINE,
+)
+
+
+def _ctd_values_to_float32(_values):
+    values = np.array(_values, dtype=bytes)
+    try:
+        return values.astype(np.float32)
+    except ValueError:
+        # Anything that is not a number becomes NaN.
+        return pd.to_numeric(pd.Series(values).str.decode("ascii", "replace"), errors="coerce").to_numpy(np.float32)
+
+
+def _ctd_dates_to_nanoseconds(_dates):
+    dates = np.array(_dates, dtype=bytes)
+    lengths = np.char.str_len(dates)
+    if (lengths == lengths[0]).all():
+        try:
+            return zulu_strings_to_nanoseconds(dates)
+        except ValueError:
+            pass
+
+    # Mixed or unusual date layouts go through pandas.
+    return pd.to_datetime(pd.Series(_dates).str.decode("ascii"), utc=True).to_numpy("datetime64[ns]").view(np.int64)
+
+
+def extract_ctd_packets(_text):
+    '''
+    Extract the date and the t1/c1/p1/sal/sv values of every datapacket line
+    of a CTD file, given as bytes, with regular expressions instead of an XML
+    parser. Returns the dates as int64 nanoseconds and the values as float32
+    columns, missing values are NaN.
+    '''
+
+    packets = CTD_PACKET_REGEX.findall(_text)
+    if len(packets) == _text.count(b"</data>"):
+        packets = np.array(packets, dtype=bytes).reshape(-1, len(CTD_COLUMNS) + 1)
+        dates = packets[:, 0]
+        values = {column: packets[:, index + 1] for index, column in enumerate(CTD_COLUMNS)}
+
+    else:
+        # Some packets have other fields or another order, every line is looked at.
+        dates = []
+        values = {column: [] for column in CTD_COLUMNS}
+        for line in CTD_LINE_REGEX.finditer(_text):
+            fields = dict(CTD_FIELD_REGEX.findall(line.group(2)))
+            dates.append(line.group(1))
+            for column in CTD_COLUMNS:
+                values[column].append(fields.get(column.encode(), b"nan"))
+
+    if not len(dates):
+        return {"timestamp": np.zeros(0, dtype=np.int64), **{column: np.zeros(0, dtype=np.float32) for column in CTD_COLUMNS}}
+
+    columns = {"timestamp": _ctd_dates_to_nanoseconds(dates)}
+    for column in CTD_COLUMNS:
+        columns[column] = _ctd_values_to_float32(values[column])
+
+    return columns
+
+
 def clean_ctd_file_into_feather(raw_ctd_directory, file, clean_ctd_directory):
 
-    file_dir = os.path.join(raw_ctd_directory, file)
-
-    ctd = open(file_dir, "r")
-    final_dict = {}
-    final_dict["date"] = []
-    final_dict["t1"] = []
-    final_dict["c1"] = []
-    final_dict["p1"] = []
-    final_dict["sal"] = []
-    final_dict["sv"] = []
-
-    for line in ctd:
-        date_and_xml = line.split('<?xml')
-        if len(date_and_xml) != 2:
-            continue
-        xml = f'<?xml{date_and_xml[1]}'
-        xml_dict = xmltodict.parse(xml)
-
-        final_dict["date"].append(date_and_xml[0].strip())
-        final_dict["t1"].append(xml_dict["datapacket"]["data"]["t1"])
-        final_dict["c1"].append(xml_dict["datapacket"]["data"]["c1"])
-        final_dict["p1"].append(xml_dict["datapacket"]["data"]["p1"])
-        final_dict["sal"].append(xml_dict["datapacket"]["data"]["sal"])
-        final_dict["sv"].append(xml_dict["datapacket"]["data"]["sv"])
-
-    final_df = pd.DataFrame.from_dict(final_dict)
+    with open(os.path.join(raw_ctd_directory, file), "rb") as ctd:
+        final_df = pd.DataFrame(extract_ctd_packets(ctd.read()))
 
     # Out it goes.
     feather_file = os.path.join(
         clean_ctd_directory, file.replace(".txt", "_cleaned.feather")
     )
-    dump_data_frame_to_feather_file(feather_file, final_df)
+    dump_data_frame_to_feather_file(feather_file, final_df, step="clean_ctd")
 
-    return
+    return file
+
+
+def get_cleaned_file_name(_parsed_file):
+    return re.sub(r"_parsed\.(json|parquet)$", "_cleaned.feather", _parsed_file)
+
+
+def _prepare_parsed_data_frame(data_frame, mmsi_registry=None):
+
+    # Propagate the 'type_and_cargo' messages throughout the MMSI's, the largest one when there are several.
+    data_frame["type_and_cargo"] = data_frame["type_and_cargo"].fillna(
+        data_frame.groupby("mmsi")["type_and_cargo"].transform("max")
+    )
+
+    # MMSI's without a type in this file get the one the registry knows from the other files and sources.
+    if mmsi_registry is not None:
+        mmsi_registry.fill_type_and_cargo(data_frame)
+
+    # The IMO numbers are kept in the registry only.
+    data_frame = data_frame.drop(columns=[ais_params.IMO], errors="ignore")
+
+    # Drop messages where there are no positional coordinates.
+    data_frame = data_frame[data_frame.x.notna() & data_frame.y.notna()]
+
+    # Drop duplicate messages.
+    data_frame.drop_duplicates(keep="first", inplace=True)
+
+    return data_frame
+
+
+def get_deployment_partitions(hydrophone_deployments, _inclusion_radius):
+    '''
+    Return the deployments as dictionaries with the name of their partition
+    of cleaned files, the whole days they are active as int64 nanoseconds,
+    and their position and coarse bounds.
+    '''
+
+    partitions = []
+    for device in hydrophone_deployments.keys():
+        for deployment in hydrophone_deployments[device].itertuples(index=False):
+            deployment_begin = pd.Timestamp(deployment.begin).normalize()
+            deployment_end = pd.Timestamp(deployment.end).normalize() + pd.DateOffset(
+                days=1
+            )
+
+            partitions.append(
+                {
+                    "name": get_deployment_partition_name(device, deployment_begin, deployment_end),
+                    "begin": deployment_begin.value,
+                    "end": deployment_end.value,
+                    "latitude": deployment.latitude,
+                    "longitude": deployment.longitude,
+                    "bounds": get_coarse_bounds(deployment.latitude, deployment.longitude, _inclusion_radius),
+                }
+            )
+
+    return partitions
+
+
+def clean_for_deployments(
+    _inclusion_radius,
+    _parsed_ais_files_directory,
+    _clean_ais_data_directory,
+    _file_and_partitions,
+    mmsi_registry=None,
+):
+    '''
+    Clean a parsed file for all the deployment partitions that need it at
+    once: the file is read and prepared a single time, then the messages of
+    each deployment active at their time get their distance to that
+    hydrophone and are written to the partition of the deployment.
+    '''
+
+    _file, partitions = _file_and_partitions
+
+    parsed_file = os.path.join(_parsed_ais_files_directory, _file)
+    data_frame = read_parsed_ais_file(parsed_file)
+    rows_in = data_frame.shape[0]
+
+    data_frame = _prepare_parsed_data_frame(data_frame, mmsi_registry)
+    data_frame["pd_timestamp"] = zulu_column_to_timestamps(data_frame["ais_timestamp"])
+    timestamps = data_frame["pd_timestamp"].values.view(np.int64)
+
+    rows_out = 0
+    for partition in partitions:
+        active = (partition["begin"] <= timestamps) & (timestamps <= partition["end"])
+        partition_data_frame = data_frame[active].copy()
+
+        distance_calculation_for_chunks(
+            partition["longitude"],
+            partition["latitude"],
+            _inclusion_radius,
+            *partition["bounds"],
+            partition_data_frame,
+        )
+
+        # Take all vessels that are within the inclusion_radius specified, in the column order of clean_for_chunk.
+        partition_data_frame = partition_data_frame[partition_data_frame.distance_to_hydrophone.notnull()]
+        partition_data_frame = partition_data_frame[
+            [column for column in partition_data_frame.columns if column != "pd_timestamp"] + ["pd_timestamp"]
+        ]
+        rows_out += partition_data_frame.shape[0]
+
+        # Out it goes.
+        feather_file = os.path.join(
+            _clean_ais_data_directory, partition["name"], get_cleaned_file_name(_file)
+        )
+        dump_data_frame_to_feather_file(feather_file, partition_data_frame, step="clean_ais")
+
+    return _file, {"rows_in": rows_in, "rows_out": rows_out}
 
 
 def clean_for_chunk(
@@ -128,25 +266,15 @@ def clean_for_chunk(
     _coarse_latitude_top_bound,
     _coarse_latitude_bottom_bound,
     _file,
+    mmsi_registry=None,
 ):
 
-    # Read the JSON file into a Pandas DataFrame.
-    json_file = os.path.join(
-        _parsed_ais_files_directory, _file.replace(".txt", "_parsed.json")
-    )
-    data_frame = pd.DataFrame(read_messages_from_json_file(json_file))
-
-    # Propagate the 'type_and_cargo' messages throughout the MMSI's.
-    data_frame = data_frame.sort_values(by=["mmsi", "type_and_cargo"])
-    data_frame["type_and_cargo"] = data_frame.groupby("mmsi")["type_and_cargo"].fillna(
-        method="ffill"
-    )
-
-    # Drop messages where there are no positional coordinates.
-    data_frame = data_frame[data_frame.x.notna() & data_frame.y.notna()]
+    # Read the parsed file into a Pandas DataFrame.
+    parsed_file = os.path.join(_parsed_ais_files_directory, _file)
+    data_frame = read_parsed_ais_file(parsed_file)
+    rows_in = data_frame.shape[0]
 
-    # Drop duplicate messages.
-    data_frame.drop_duplicates(keep="first", inplace=True)
+    data_frame = _prepare_parsed_data_frame(data_frame, mmsi_registry)
 
     # Calculate the distance from the hydrophone to the vessel.
     distance_calculation_for_chunks(
@@ -165,13 +293,15 @@ def clean_for_chunk(
 
     # Create a new column that is the Pandas Timestamp.
     # Some things require AIS, some things require Pandas; annoying.
-    data_frame["pd_timestamp"] = pd.to_datetime(data_frame["ais_timestamp"])
+    data_frame["pd_timestamp"] = zulu_column_to_timestamps(data_frame["ais_timestamp"])
 
     # Out it goes.
     feather_file = os.path.join(
-        _clean_ais_data_directory, _file.replace("_parsed.json", "_cleaned.feather")
+        _clean_ais_data_directory, get_cleaned_file_name(_file)
     )
-    dump_data_frame_to_feather_file(feather_file, data_frame)
+    dump_data_frame_to_feather_file(feather_file, data_frame, step="clean_ais")
+
+    return _file, {"rows_in": rows_in, "rows_out": data_frame.shape[0]}
 
 
 def clean_ais_data(
@@ -180,11 +310,22 @@ def clean_ais_data(
     clean_ais_directory,
     _inclusion_radius,
     use_all_threads=False,
+    single_pass=False,
+    mmsi_registry_file=None,
 ):
     '''
-    This function produces the feather files from the JSON inputed files
+    This function produces the feather files from the parsed AIS files
     according some restrictions. The new feather file will contain only
     data there is within the inclusion radius and that have positional data.
+
+    With single_pass, each parsed file is read once for all the deployments
+    and the output is partitioned in one directory per deployment, see
+    clean_ais_data_single_pass.
+
+    With an mmsi_registry_file, the messages of the MMSI's without a type in
+    their file get the type_and_cargo of the MMSI registry.
+
+    Returns the number of rows read and kept for every cleaned file.
     '''
 
     # Threading differences between systems.
@@ -193,11 +334,26 @@ def clean_ais_data(
     # Read in the hydrophone deployments as we will treat each deployment as an individual dataset.
     hydrophone_deployments = get_hydrophone_deployments(deployment_directory)
 
-    print(f"Finding available JSON files to clean...")
-    # List available JSON files to clean in the input folder.
-    available_files = os.listdir(parsed_ais_directory)
+    mmsi_registry = None
+    if mmsi_registry_file is not None and os.path.exists(mmsi_registry_file):
+        mmsi_registry = load_mmsi_registry(mmsi_registry_file)
+        print(f"  Using the MMSI registry of {bcolors.BOLD}{len(mmsi_registry)}{bcolors.ENDC} vessels")
+
+    if single_pass:
+        return clean_ais_data_single_pass(
+            hydrophone_deployments,
+            parsed_ais_directory,
+            clean_ais_directory,
+            _inclusion_radius,
+            number_of_threads,
+            mmsi_registry,
+        )
+
+    print(f"Finding available parsed files to clean...")
+    # List available parsed files to clean in the input folder.
+    available_files = [file for file in os.listdir(parsed_ais_directory) if is_parsed_ais_file(file)]
     available_files.sort()
-    print(f"  Found {bcolors.BOLD}{len(available_files)}{bcolors.ENDC} JSON files to clean")
+    print(f"  Found {bcolors.BOLD}{len(available_files)}{bcolors.ENDC} parsed files to clean")
 
     # List existing cleaned files in the destination folder.
     existing_files = os.listdir(clean_ais_directory)
@@ -206,17 +362,19 @@ def clean_ais_data(
     print(f"  Found {bcolors.BOLD}{len(existing_files)}{bcolors.ENDC} existing Feather files")
 
     print(f"Working out what files need cleaning...")
-    files_to_clean = [file for file in available_files if re.sub("_parsed.json", "_cleaned.feather", file) not in existing_files]
+    files_to_clean = [file for file in available_files if get_cleaned_file_name(file) not in existing_files]
     print(f"  There are {bcolors.BOLD}{len(files_to_clean)}{bcolors.ENDC} files to clean")
     files_to_clean.sort(
         key=lambda f: os.stat(os.path.join(parsed_ais_directory, f)).st_size,
         reverse=False,
     )
 
+    file_counters = {}
+
     # If there is no files to clean, terminate the execution.
     if not files_to_clean:
         print(f"{bcolors.WARNING}No files to clean.{bcolors.ENDC}")
-        return
+        return file_counters
 
     for device in hydrophone_deployments.keys():
         for deployment in hydrophone_deployments[device].itertuples(index=False):
@@ -238,43 +396,15 @@ def clean_ais_data(
             # We initially do a quick dead-reckoning of distance by using a square around the area of interest.
             # This will produce around 20% erroneous results (circle within a square).
             # This is done as a full geodesic distance calculation is far more computational expensive.
-            coarse_offset = _inclusion_radius + 2000.0
-            earth_curvature = 6378137.0
-
-            latitude_offset = (coarse_offset / earth_curvature) * 180.0 / np.pi
-            coarse_latitude_top_bound = deployment.latitude + latitude_offset
-            coarse_latitude_bottom_bound = deployment.latitude - latitude_offset
-
-            longitude_offset = (
-                (
-                    coarse_offset
-                    / (earth_curvature * np.cos(np.pi * deployment.longitude / 180.0))
-                )
-                * 180.0
-                / np.pi
-            )
-            coarse_longitude_left_bound = deployment.longitude + longitude_offset
-            coarse_longitude_right_bound = deployment.longitude - longitude_offset
-            '''
-            @Date : 2023-07-22
-            @Time : 13:00:56
-            '''
-            # print('deployment.longitude',deployment.longitude)
-            # print('deployment.latitude',deployment.latitude)
-            # print("leaft",coarse_longitude_left_bound)
-            # print('right',coarse_longitude_right_bound)
-            # print('top',coarse_latitude_top_bound)
-            # print('bottom',coarse_latitude_bottom_bound)
-            # coarse_longitude_left_bound = -1000000000
-            # coarse_longitude_right_bound = 1000000000
-            # coarse_latitude_top_bound = 90
-            # coarse_latitude_bottom_bound = -90
-
-            # sys.exit()
+            (
+                coarse_longitude_left_bound,
+                coarse_longitude_right_bound,
+                coarse_latitude_top_bound,
+                coarse_latitude_bottom_bound,
+            ) = get_coarse_bounds(deployment.latitude, deployment.longitude, _inclusion_radius)
 
             # Clean the data.
             print("Cleaning AIS data from deployment...")
-            threading_pool = multiprocessing.Pool(processes=number_of_threads)
             function_partial = partial(
                 clean_for_chunk,
                 _inclusion_radius,
@@ -286,14 +416,82 @@ def clean_ais_data(
                 coarse_longitude_right_bound,
                 coarse_latitude_top_bound,
                 coarse_latitude_bottom_bound,
+                mmsi_registry=mmsi_registry,
+            )
+
+            for file, counters in run_tasks(function_partial, deployment_ais_data_files, workers=number_of_threads, ordered=False):
+                file_counters[file] = counters
+
+    return file_counters
+
+
+
+def clean_ais_data_single_pass(
+    hydrophone_deployments,
+    parsed_ais_directory,
+    clean_ais_directory,
+    _inclusion_radius,
+    number_of_threads,
+    mmsi_registry=None,
+):
+
+    print(f"Finding available parsed files to clean...")
+    available_files = [file for file in os.listdir(parsed_ais_directory) if is_parsed_ais_file(file)]
+    available_files.sort()
+    print(f"  Found {bcolors.BOLD}{len(available_files)}{bcolors.ENDC} parsed files to clean")
+
+    partitions = get_deployment_partitions(hydrophone_deployments, _inclusion_radius)
+    print(f"  Found {bcolors.BOLD}{len(partitions)}{bcolors.ENDC} deployments to clean for")
+
+    print(f"Working out what files need cleaning for which deployments...")
+    files_to_clean = []
+    for file in available_files:
+        # The parsed files hold one day of data.
+        file_begin = pd.Timestamp(file.split("_")[1]).value
+        file_end = file_begin + pd.Timedelta(days=1).value
+
+        file_partitions = [
+            partition
+            for partition in partitions
+            if partition["begin"] < file_end
+            and file_begin <= partition["end"]
+            and not os.path.exists(
+                os.path.join(clean_ais_directory, partition["name"], get_cleaned_file_name(file))
             )
+        ]
+        if file_partitions:
+            files_to_clean.append((file, file_partitions))
+
+    print(f"  There are {bcolors.BOLD}{len(files_to_clean)}{bcolors.ENDC} files to clean")
+
+    file_counters = {}
+    if not files_to_clean:
+        print(f"{bcolors.WARNING}No files to clean.{bcolors.ENDC}")
+        return file_counters
+
+    for partition in partitions:
+        create_dir(clean_ais_directory, partition["name"])
 
-            for _ in tqdm(threading_pool.imap_unordered(function_partial, deployment_ais_data_files, chunksize=1), total=len(deployment_ais_data_files)):
-                pass
+    # The biggest files first, so that the pool is not left waiting for one of them at the end.
+    files_to_clean.sort(
+        key=lambda file_and_partitions: os.stat(os.path.join(parsed_ais_directory, file_and_partitions[0])).st_size,
+        reverse=True,
+    )
+
+    # A single pool serves every file and every deployment.
+    print("Cleaning AIS data for all the deployments...")
+    function_partial = partial(
+        clean_for_deployments,
+        _inclusion_radius,
+        parsed_ais_directory,
+        clean_ais_directory,
+        mmsi_registry=mmsi_registry,
+    )
 
-            threading_pool.close()
-            threading_pool.join()
+    for file, counters in run_tasks(function_partial, files_to_clean, workers=number_of_threads, ordered=False):
+        file_counters[file] = counters
 
+    return file_counters
 
 
 def clean_ctd_data(
@@ -316,7 +514,7 @@ def clean_ctd_data(
 
     print(f"Finding available TXT files to clean...")
     # List available TXT files to clean in the input folder.
-    available_files = os.listdir(raw_ctd_directory)
+    available_files = list_downloaded_files(raw_ctd_directory)
     available_files.sort()
     print(f"  Found {bcolors.BOLD}{len(available_files)}{bcolors.ENDC} TXT files to clean")
 
@@ -338,6 +536,11 @@ def clean_ctd_data(
         print(f"{bcolors.WARNING}No files to clean.{bcolors.ENDC}")
         return
 
+    # The file timestamps are parsed once, and a file used by several deployments is cleaned once.
+    file_timestamps = {
+        file: pd.Timestamp(file.split("_")[1].split(".")[0], tz='UTC') for file in files_to_clean
+    }
+    deployment_ctd_data_files = set()
     for device in hydrophone_deployments.keys():
         for deployment in hydrophone_deployments[device].itertuples(index=False):
 
@@ -347,13 +550,19 @@ def clean_ctd_data(
                 days=1
             )
 
-            #deployment_ctd_data_files = []
-
-            for file in tqdm(files_to_clean):
-                file_timestamp = pd.Timestamp(file.split("_")[1].split(".")[0], tz='UTC')
+            deployment_ctd_data_files.update(
+                file for file, file_timestamp in file_timestamps.items()
+                if deployment_begin <= file_timestamp <= deployment_end
+            )
 
-                if deployment_begin <= file_timestamp <= deployment_end:
-                    clean_ctd_file_into_feather(raw_ctd_directory, file, clean_ctd_directory)
+    # The biggest files first, so that the pool is not left waiting for one of them at the end.
+    deployment_ctd_data_files = [file for file in reversed(files_to_clean) if file in deployment_ctd_data_files]
+    print(f"Cleaning {bcolors.BOLD}{len(deployment_ctd_data_files)}{bcolors.ENDC} TXT files used by the deployments...")
+    start_time = time.time()
+    function_partial = partial(clean_ctd_file_into_feather, raw_ctd_directory, clean_ctd_directory=clean_ctd_directory)
+    for _ in run_tasks(function_partial, deployment_ctd_data_files, workers=number_of_threads, ordered=False):
+        pass
+    print("  This took {0:.3f} seconds to process".format(time.time() - start_time))
 
     return
 
@@ -1,88 +1,465 @@
 import os
 import time
-import multiprocessing
-import sys
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 
-from tqdm import tqdm
-
+from registry import load_mmsi_registry
 from utils import (
-    get_num_of_threads,
     get_hydrophone_deployments,
-    dump_data_frame_to_feather_file,
     pandas_timestamp_to_zulu_format,
     read_data_frame_from_feather_file,
+    read_arrow_table_from_feather_file,
+    AisDatasetWriter,
+    read_ais_dataset,
+    get_ais_dataset_schema,
+    zulu_column_to_timestamps,
+    get_deployment_partition_name,
 )
 
 
-def generate_time_steps(_row_pd_timestamp, _row_time_difference, _minimum_delta):
+# Seconds between timestamps.
+MINIMUM_DELTA = np.timedelta64(20, "s")
+MAXIMUM_DELTA = np.timedelta64(1200, "s")
 
-    end_timestamp = _row_pd_timestamp
-    time_difference = _row_time_difference
+# Copies of a batch in memory: the slices of the files, the batch, and the rows converted to Arrow and being written.
+BATCH_MEMORY_FACTOR = 4
 
-    steps_required = np.ceil(time_difference / _minimum_delta)
 
-    time_steps = pd.date_range(
-        start=(end_timestamp - time_difference),
-        end=end_timestamp - (time_difference / steps_required),
-        periods=steps_required,
-    )
+# Columns interpolated between the messages of a vessel, and columns the new rows take from the message before them.
+INTERPOLATED_COLUMNS = ["x", "y", "sog", "cog", "true_heading", "distance_to_hydrophone"]
+FORWARD_FILLED_COLUMNS = ["id", "mmsi", "type_and_cargo"]
+
+
+def _last_valid_index(_valid):
+    # For every row, the index of the last valid row up to it, -1 when there is none.
+    return np.maximum.accumulate(np.where(_valid, np.arange(_valid.size), -1))
+
 
-    return time_steps.to_list()
+def _next_valid_index(_valid):
+    # For every row, the index of the next valid row from it, the number of rows when there is none.
+    return np.minimum.accumulate(np.where(_valid, np.arange(_valid.size), _valid.size)[::-1])[::-1]
 
 
-def interpolation_for_chunks(_chunk):
+class InterpolatedTracks:
     '''
-    Interpolate the location data to generate new entries with more regularity.
-    The new interpolated data will be generated if two values are separated for
-    a time greater than minimum_delta and smaller than maximum_delta.
+    The AIS entries of a deployment together with the interpolated entries
+    of the vessels, generated on demand from the messages instead of being
+    stored. New entries are generated where two messages of an MMSI are
+    separated by more than MINIMUM_DELTA and at most MAXIMUM_DELTA,
+    ceil(gap / MINIMUM_DELTA) of them per gap, evenly spaced from the first
+    message of the gap.
+
+    The values are linearly interpolated along the position of the rows in
+    the track of each MMSI, as pandas' interpolate() does once the new
+    entries are sorted in, and the id, mmsi and type_and_cargo come from
+    the message before. Any window of entries (window()) comes out the same
+    as the rows of the whole interpolated table in that window.
     '''
 
-    # Seconds between timestamps.
-    minimum_delta = np.timedelta64(20, "s")
-    maximum_delta = np.timedelta64(1200, "s")
+    def __init__(self, data_frame):
+        self.data_frame = data_frame.sort_values(by="pd_timestamp", kind="stable", ignore_index=True)
+        self.timestamps = self.data_frame.pd_timestamp.values.view(np.int64)
 
-    _chunk["time_difference"] = _chunk["pd_timestamp"] - _chunk["pd_timestamp"].shift()
-    _chunk["to_interpolate"] = (_chunk["time_difference"] > minimum_delta) & (
-        _chunk["time_difference"] <= maximum_delta
-    )
+        minimum_delta = MINIMUM_DELTA.astype("timedelta64[ns]").astype(np.int64)
+        maximum_delta = MAXIMUM_DELTA.astype("timedelta64[ns]").astype(np.int64)
+
+        # The track of every MMSI, one after the other and in time order.
+        self.order = np.argsort(self.data_frame.mmsi.to_numpy(), kind="stable")
+        mmsi = self.data_frame.mmsi.to_numpy()[self.order]
+        self.track_timestamps = self.timestamps[self.order]
 
-    if _chunk["to_interpolate"].any():
-        time_steps_to_add = np.vectorize(generate_time_steps)(
-            _chunk[_chunk["to_interpolate"]]["pd_timestamp"],
-            _chunk[_chunk["to_interpolate"]]["time_difference"],
-            minimum_delta,
+        time_differences = np.diff(self.track_timestamps)
+        self.same_vessel = mmsi[1:] == mmsi[:-1]
+        # Index of the message that ends every gap to interpolate.
+        self.gap_ends = (
+            np.flatnonzero(self.same_vessel & (time_differences > minimum_delta) & (time_differences <= maximum_delta)) + 1
         )
 
-        time_steps_to_add = [
-            subvalue for value in time_steps_to_add for subvalue in value
+        # The timesteps of pd.date_range(start, end - gap / steps, periods=steps) for each gap, the same to the nanosecond.
+        gaps = time_differences[self.gap_ends - 1]
+        steps = np.ceil(gaps / minimum_delta)
+        self.spans = gaps - (gaps / steps).astype(np.int64)
+        self.steps = steps.astype(np.int64)
+
+        # Position of every row once the new ones are sorted in after the message that starts their gap.
+        inserted_before = np.zeros(mmsi.size, dtype=np.int64)
+        np.add.at(inserted_before, self.gap_ends, self.steps)
+        self.positions = np.arange(mmsi.size) + np.cumsum(inserted_before)
+
+        # First and last row of the track of the MMSI of every row.
+        first_rows = np.r_[True, ~self.same_vessel]
+        self.track_starts = np.maximum.accumulate(np.where(first_rows, np.arange(mmsi.size), 0))
+        self.track_ends = np.r_[np.flatnonzero(first_rows)[1:] - 1, mmsi.size - 1][np.cumsum(first_rows) - 1]
+
+        # The gaps sorted by the time they start, to find the ones of a window.
+        gap_begins = self.track_timestamps[self.gap_ends - 1]
+        self.gaps_by_time = np.argsort(gap_begins, kind="stable")
+        self.sorted_gap_begins = gap_begins[self.gaps_by_time]
+
+        self.dtypes = _interpolated_dtypes(self.data_frame)
+        self.columns = {}
+
+    def __len__(self):
+        return int(self.steps.sum())
+
+    @property
+    def first_timestamp(self):
+        return self.data_frame.pd_timestamp.iloc[0]
+
+    @property
+    def last_timestamp(self):
+        return self.data_frame.pd_timestamp.iloc[-1]
+
+    def _column(self, column):
+        # The values of a column along the tracks, and where the last and next values are, computed once.
+        if column not in self.columns:
+            values = self.data_frame[column].to_numpy(np.float64)[self.order]
+            valid = ~np.isnan(values)
+            self.columns[column] = (values, valid, _last_valid_index(valid), _next_valid_index(valid))
+
+        return self.columns[column]
+
+    def new_entries(self, gaps=None):
+        '''
+        The interpolated entries of the given gaps (all of them by default),
+        None when there are none.
+        '''
+
+        gaps = np.arange(self.gap_ends.size) if gaps is None else np.asarray(gaps)
+        steps = self.steps[gaps]
+        spans = self.spans[gaps]
+        if not steps.size:
+            return None
+
+        gap_of_row = np.repeat(np.arange(gaps.size), steps)
+        step_of_row = np.arange(gap_of_row.size) - np.repeat(np.cumsum(steps) - steps, steps)
+        offsets = np.floor(step_of_row * (spans / (steps - 1))[gap_of_row]).astype(np.int64)
+        last_steps = step_of_row == steps[gap_of_row] - 1
+        offsets[last_steps] = spans[gap_of_row][last_steps]
+
+        gap_starts = (self.gap_ends[gaps] - 1)[gap_of_row]
+        new_timestamps = self.track_timestamps[gap_starts] + offsets
+        new_positions = self.positions[gap_starts] + 1 + step_of_row
+
+        new_entries = {}
+        for column in INTERPOLATED_COLUMNS + FORWARD_FILLED_COLUMNS:
+            # The messages may only have some of the columns, e.g. read for the distances alone.
+            if column not in self.data_frame.columns:
+                continue
+            values, valid, last_valid, next_valid = self._column(column)
+            previous_valid = last_valid[gap_starts]
+            # Vessels without any value before the gap keep it missing.
+            known = previous_valid >= self.track_starts[gap_starts]
+
+            if column in FORWARD_FILLED_COLUMNS:
+                new_values = np.where(known, values[np.maximum(previous_valid, 0)], np.nan)
+            else:
+                new_values = (
+                    np.interp(new_positions, self.positions[valid], values[valid])
+                    if valid.any()
+                    else np.full(gap_of_row.size, np.nan)
+                )
+                # After the last value of a vessel, its last value. np.interp would carry on towards the next vessel.
+                beyond = next_valid[gap_starts + 1] > self.track_ends[gap_starts]
+                new_values[beyond] = values[np.maximum(previous_valid, 0)][beyond]
+                new_values[~known] = np.nan
+
+            new_entries[column] = new_values
+
+        # The new entries have the columns of the messages, missing where they are neither interpolated nor filled.
+        data_frame = pd.DataFrame(index=pd.RangeIndex(gap_of_row.size))
+        for column in self.data_frame.columns:
+            if column == "pd_timestamp":
+                data_frame[column] = pd.to_datetime(new_timestamps, utc=True).astype(self.dtypes[column])
+            elif column in new_entries:
+                data_frame[column] = new_entries[column].astype(self.dtypes[column])
+            else:
+                data_frame[column] = pd.Series(None, index=data_frame.index, dtype=object).astype(self.dtypes[column])
+
+        return data_frame
+
+    def window(self, begin, end):
+        '''
+        The messages and interpolated entries from begin to end (both
+        included), sorted by pd_timestamp with the messages first on ties,
+        with the dtypes of the interpolated table.
+        '''
+
+        begin = pd.Timestamp(begin).value
+        end = pd.Timestamp(end).value
+        maximum_delta = MAXIMUM_DELTA.astype("timedelta64[ns]").astype(np.int64)
+
+        messages = self.data_frame.iloc[
+            np.searchsorted(self.timestamps, begin, side="left"):np.searchsorted(self.timestamps, end, side="right")
+        ]
+
+        # The new entries of a gap are less than MAXIMUM_DELTA after its first message.
+        gaps = self.gaps_by_time[
+            np.searchsorted(self.sorted_gap_begins, begin - maximum_delta, side="left"):np.searchsorted(
+                self.sorted_gap_begins, end, side="right"
+            )
         ]
-        new_timesteps = pd.DataFrame(data=time_steps_to_add, columns=["pd_timestamp"])
+        new_entries = self.new_entries(np.sort(gaps))
+        frames = [messages.astype(self.dtypes)]
+        if new_entries is not None:
+            new_timestamps = new_entries.pd_timestamp.values.view(np.int64)
+            frames.append(new_entries[(new_timestamps >= begin) & (new_timestamps <= end)])
+
+        return pd.concat(frames, ignore_index=True).sort_values(by="pd_timestamp", kind="stable", ignore_index=True)
+
+    def positions_on_grid(self, grid):
+        '''
+        The position and distance to the hydrophone of every vessel at each
+        time of a sorted grid of timestamps (e.g. the 1 minute bins of
+        identify), linearly interpolated in time between its messages where
+        they are at most MAXIMUM_DELTA apart. Only the vessels with a track
+        at a time of the grid are given for that time.
+        '''
+
+        grid = pd.DatetimeIndex(grid)
+        grid = (grid.tz_localize("UTC") if grid.tz is None else grid.tz_convert("UTC")).asi8
+        maximum_delta = MAXIMUM_DELTA.astype("timedelta64[ns]").astype(np.int64)
+        timestamps = self.track_timestamps
+
+        # Grid times on a message, and grid times between two messages of a vessel.
+        hits_begin = np.searchsorted(grid, timestamps, side="left")
+        hits_end = np.searchsorted(grid, timestamps, side="right")
+        segments = np.flatnonzero(self.same_vessel & (np.diff(timestamps) <= maximum_delta))
+        segments_begin = np.searchsorted(grid, timestamps[segments], side="right")
+        segments_end = np.searchsorted(grid, timestamps[segments + 1], side="left")
+
+        starts = np.r_[np.arange(timestamps.size), segments]
+        counts = np.r_[hits_end - hits_begin, np.maximum(segments_end - segments_begin, 0)]
+        first_grid_indices = np.r_[hits_begin, segments_begin]
+
+        row_of_entry = np.repeat(np.arange(starts.size), counts)
+        grid_indices = np.repeat(first_grid_indices, counts) + np.arange(row_of_entry.size) - np.repeat(
+            np.cumsum(counts) - counts, counts
+        )
+        previous_rows = starts[row_of_entry]
+        # Messages are their own next message.
+        next_rows = np.where(row_of_entry < timestamps.size, previous_rows, previous_rows + 1)
+
+        times = grid[grid_indices]
+        durations = timestamps[next_rows] - timestamps[previous_rows]
+        fractions = np.divide(
+            times - timestamps[previous_rows],
+            durations,
+            out=np.zeros(times.size),
+            where=durations > 0,
+        )
+
+        data_frame = pd.DataFrame(
+            {
+                "pd_timestamp": pd.to_datetime(times, utc=True),
+                "mmsi": self.data_frame.mmsi.to_numpy()[self.order][previous_rows],
+            }
+        )
+        for column in ["x", "y", "distance_to_hydrophone"]:
+            values = self._column(column)[0]
+            data_frame[column] = values[previous_rows] + (values[next_rows] - values[previous_rows]) * fractions
+
+        data_frame = data_frame.sort_values(by=["pd_timestamp", "mmsi"], kind="stable", ignore_index=True)
+        return data_frame.drop_duplicates(subset=["pd_timestamp", "mmsi"], ignore_index=True)
+
+
+def read_interpolated_window(_dataset_directory, _begin, _end, _columns=None):
+    '''
+    The messages and interpolated entries from _begin to _end (see
+    InterpolatedTracks.window) of a combined deployment dataset. Only the
+    messages up to MAXIMUM_DELTA either side are read, as the gaps that are
+    interpolated are never longer. The interpolated values are the same as
+    from the whole dataset, unless a vessel's messages are missing the value
+    for longer than that: true_heading, for instance, is then interpolated
+    from the last heading read rather than from an earlier one.
+    '''
+
+    margin = pd.Timedelta(MAXIMUM_DELTA)
+    messages = read_ais_dataset(_dataset_directory, columns=_columns, begin=_begin - margin, end=_end + margin)
+    if messages.empty:
+        return messages.astype(_interpolated_dtypes(messages))
+
+    return InterpolatedTracks(messages).window(_begin, _end)
+
+
+def get_interpolated_window_schema(_dataset_directory):
+    '''
+    The Arrow schema of the windows read by read_interpolated_window from a
+    combined deployment dataset, whatever their rows: the integer and boolean
+    columns become float64, as in _interpolated_dtypes.
+    '''
+
+    schema = get_ais_dataset_schema(_dataset_directory)
+    for index, field in enumerate(schema):
+        if pa.types.is_integer(field.type) or pa.types.is_boolean(field.type):
+            schema = schema.set(index, field.with_type(pa.float64()))
+
+    return schema
+
+
+def interpolate_tracks(_tracks):
+    '''
+    All the interpolated entries of the vessels of _tracks at once (see
+    InterpolatedTracks), None when there are none.
+    '''
+
+    return InterpolatedTracks(_tracks).new_entries()
+
+
+def _estimate_row_bytes(_file):
+    # Size of a row in memory, from the schema of a feather file. Strings count as 64 bytes.
+    row_bytes = 0
+    for field in pa.ipc.open_file(_file).schema:
+        try:
+            row_bytes += max(field.type.bit_width // 8, 1)
+        except ValueError:
+            row_bytes += 64
 
-        _chunk = pd.concat([_chunk, new_timesteps], ignore_index=True)
-        _chunk = _chunk.sort_values(by="pd_timestamp", ignore_index=True)
-        _chunk = _chunk.drop(labels=["time_difference", "to_interpolate"], axis=1)
+    return row_bytes
 
-        _chunk["x"] = _chunk["x"].interpolate()
-        _chunk["y"] = _chunk["y"].interpolate()
-        _chunk["sog"] = _chunk["sog"].interpolate()
-        _chunk["cog"] = _chunk["cog"].interpolate()
-        _chunk["true_heading"] = _chunk["true_heading"].interpolate()
-        _chunk["distance_to_hydrophone"] = _chunk[
-            "distance_to_hydrophone"
-        ].interpolate()
 
-        _chunk["id"] = _chunk["id"].fillna(method="ffill")
-        _chunk["mmsi"] = _chunk["mmsi"].fillna(method="ffill")
-        _chunk["type_and_cargo"] = _chunk["type_and_cargo"].fillna(method="ffill")
+def _interpolated_dtypes(_template):
+    # The interpolated rows start out empty, so the integer columns of the interpolated data end up as floats.
+    return {
+        column: np.float64 if pd.api.types.is_integer_dtype(dtype) or pd.api.types.is_bool_dtype(dtype) else dtype
+        for column, dtype in _template.dtypes.items()
+    }
 
-        return _chunk[_chunk["ais_timestamp"].isna()]
 
-    else:
-        _chunk = _chunk.drop(labels=["time_difference", "to_interpolate"], axis=1)
+def _read_template(_file):
+    # An empty data frame with the columns and dtypes of the rows of a cleaned AIS file.
+    template = pa.ipc.open_file(_file).schema.empty_table().to_pandas().reset_index(drop=True)
+    template["pd_timestamp"] = zulu_column_to_timestamps(template["ais_timestamp"])
+
+    return template
+
+
+def count_mmsi_messages(_files):
+    '''
+    Number of messages of every MMSI across the files, and the first
+    timestamp (int64 nanoseconds) of every file, None when it is empty. Only
+    these two columns are read, one file at a time.
+    '''
+
+    counts = pd.Series(dtype=np.int64)
+    first_timestamps = []
+    for file in _files:
+        data_frame = read_arrow_table_from_feather_file(file, columns=["mmsi", "ais_timestamp"]).to_pandas()
+        if data_frame.empty:
+            first_timestamps.append(None)
+            continue
+
+        first_timestamps.append(zulu_column_to_timestamps(data_frame.ais_timestamp).values.view(np.int64).min())
+        counts = counts.add(data_frame.mmsi.value_counts(), fill_value=0)
+
+    return counts.astype(np.int64), first_timestamps
+
+
+def read_sorted_ais_file(_file, _kept_mmsi, _mmsi_registry=None):
+    # The messages of the kept MMSI's in a cleaned AIS file, sorted by pd_timestamp.
+    data_frame = read_data_frame_from_feather_file(_file, row_filter=pc.field("mmsi").isin(_kept_mmsi))
+    data_frame = data_frame.reset_index(drop=True)
+    if _mmsi_registry is not None:
+        _mmsi_registry.fill_type_and_cargo(data_frame)
+
+    data_frame["pd_timestamp"] = zulu_column_to_timestamps(data_frame["ais_timestamp"])
+
+    return data_frame.sort_values(by="pd_timestamp", kind="stable", ignore_index=True)
+
+
+def merge_sorted_ais_files(_files, _first_timestamps, _batch_rows, _read_file):
+    '''
+    K-way merge of AIS files, each of them sorted by pd_timestamp once read
+    by _read_file, in batches of at least _batch_rows rows (unless the files
+    run out) sorted by pd_timestamp. A file is only read once the merge
+    reaches its first timestamp, so only the files that overlap in time are
+    in memory at once, e.g. two consecutive days.
+    '''
+
+    unopened = sorted(
+        [(first_timestamp, file) for file, first_timestamp in zip(_files, _first_timestamps) if first_timestamp is not None],
+        key=lambda item: item[0],
+    )
+    opened = []
+
+    def open_next_file():
+        data_frame = _read_file(unopened.pop(0)[1])
+        if not data_frame.empty:
+            opened.append([data_frame, data_frame.pd_timestamp.values.view(np.int64), 0])
+
+    while unopened or opened:
+        if not opened:
+            open_next_file()
+            continue
+
+        # The batch ends where the next _batch_rows rows of one of the open files end, files included on the way.
+        bound = min(timestamps[min(position + _batch_rows, timestamps.size) - 1] for _, timestamps, position in opened)
+        while unopened and unopened[0][0] <= bound:
+            open_next_file()
+            bound = min(
+                timestamps[min(position + _batch_rows, timestamps.size) - 1] for _, timestamps, position in opened
+            )
+
+        slices = []
+        for opened_file in opened:
+            data_frame, timestamps, position = opened_file
+            end = np.searchsorted(timestamps, bound, side="right")
+            slices.append(data_frame.iloc[position:end])
+            opened_file[2] = end
+        opened = [opened_file for opened_file in opened if opened_file[2] < opened_file[1].size]
+
+        yield pd.concat(slices, ignore_index=True).sort_values(by="pd_timestamp", kind="stable", ignore_index=True)
+
+
+def combine_deployment_files(
+    _files,
+    _clean_output_directory,
+    _mmsi_registry=None,
+    _memory_budget_mb=1024,
+):
+    '''
+    Combines the cleaned AIS files of a deployment into a Parquet dataset
+    partitioned by day in _clean_output_directory, sorted by pd_timestamp
+    (see utils.AisDatasetWriter). The files are merged in batches sized from
+    _memory_budget_mb, so the memory used does not grow with the length of
+    the deployment. The interpolated positions of the vessels are not
+    stored, see InterpolatedTracks.
+    '''
+
+    print("Counting the messages of every MMSI...")
+
+    start_time = time.time()
+    counts, first_timestamps = count_mmsi_messages(_files)
+    kept_mmsi = counts.index[counts > 1].to_numpy()
+
+    print("  There are {0} MMSI's across {1} entries".format(counts.shape[0], counts.sum()))
+    print("  {0} MMSI's have more than a single message".format(kept_mmsi.shape[0]))
+    print("  This took {0:.3f} seconds to process".format(time.time() - start_time))
+
+    batch_rows = max(int(_memory_budget_mb * 2**20 / (_estimate_row_bytes(_files[0]) * BATCH_MEMORY_FACTOR)), 1000)
+
+    print(f"Merging and dumping the deployment AIS data in batches of {batch_rows} entries...")
+
+    start_time = time.time()
+    clean_writer = AisDatasetWriter(
+        _clean_output_directory,
+        pa.Schema.from_pandas(_read_template(_files[0]), preserve_index=False),
+    )
+
+    batches = merge_sorted_ais_files(
+        _files,
+        first_timestamps,
+        batch_rows,
+        lambda file: read_sorted_ais_file(file, kept_mmsi, _mmsi_registry),
+    )
+    for batch in batches:
+        clean_writer.write(batch)
+    clean_writer.close()
 
-        return pd.DataFrame(columns=_chunk.columns)
+    print("  There are now {0} MMSI's across {1} entries".format(len(clean_writer.mmsi), clean_writer.rows))
+    print("  This took {0:.3f} seconds to process".format(time.time() - start_time))
 
 
 def combine_deployment_ais_data(
@@ -92,27 +469,29 @@ def combine_deployment_ais_data(
     _run_shortest=False,
     _inclusion_radius=15000.0,
     use_all_threads=False,
+    mmsi_registry_file=None,
+    memory_budget_mb=1024,
 ):
     '''
     This function combines the feather files from the same deployment into one
-    unique cleaned file. It also generate a new interpolated file, with values
-    for the location with more granularity with values generated from the linear
-    interpolation of the real ais messages from the original feather files.
+    unique cleaned dataset, partitioned by day. The values for the location with more granularity,
+    generated from the linear interpolation of the real ais messages, are no
+    longer stored in an interpolated file: InterpolatedTracks generates them
+    from the cleaned dataset when they are needed. With an mmsi_registry_file, the vessels still without a type_and_cargo
+    get the one of the MMSI registry. The files are streamed through a
+    memory budget of memory_budget_mb, see combine_deployment_files.
     '''
 
-    # Threading differences between systems.
-    # number_of_threads = get_num_of_threads(use_all_threads)
-    number_of_threads = 2
-
     # Find all of the cleaned AIS files for each deployment.
-    cleaned_ais_files = [file for file in os.listdir(clean_ais_directory)]
+    cleaned_ais_files = [file for file in os.listdir(clean_ais_directory) if file.endswith("_cleaned.feather")]
     # print('cleaned_ais_files: ', cleaned_ais_files)
     # Read in the hydrophone deployments as we will treat each deployment as an individual dataset.
     hydrophone_deployments = get_hydrophone_deployments(deployment_directory)
+    mmsi_registry = load_mmsi_registry(mmsi_registry_file) if mmsi_registry_file is not None else None
     # print(hydrophone_deployments)
     # sys.exit()
     # Process each device and deployment individually.
-    # TIP: You probably don't want to parallelise this level, unless you have a _lot_ of system memory.
+    # TIP: You probably don't want to parallelise this level, as every deployment uses up to its memory budget.
     for device in hydrophone_deployments.keys():
         for deployment in hydrophone_deployments[device].itertuples(index=False):
 
@@ -138,165 +517,35 @@ def combine_deployment_ais_data(
 
             deployment_ais_data_files = []
 
-            for file in cleaned_ais_files:
+            # The single pass clean writes the files of each deployment into its own partition.
+            partition_name = get_deployment_partition_name(device, deployment_begin, deployment_end)
+            if os.path.isdir(os.path.join(clean_ais_directory, partition_name)):
+                deployment_ais_data_files = [
+                    os.path.join(partition_name, file)
+                    for file in sorted(os.listdir(os.path.join(clean_ais_directory, partition_name)))
+                ]
+
+            for file in cleaned_ais_files if not deployment_ais_data_files else []:
                 file_timestamp = pd.Timestamp(file.split("_")[1])
                 if deployment_begin <= file_timestamp <= deployment_end:
                     deployment_ais_data_files.append(file)
 
-            print("Reading cleaned AIS file into a pandas DataFrame...")
-
-            start_time = time.time()
-
-            files = [
-                read_data_frame_from_feather_file(
-                    os.path.join(clean_ais_directory, file)
-                )
-                for file in deployment_ais_data_files
-            ]
-            if not len(files):
+            if not deployment_ais_data_files:
                 continue
 
-            data_frame = pd.concat(files)
-
-            print(
-                "  There are {0} MMSI's across {1} entries".format(
-                    data_frame.mmsi.unique().shape[0], data_frame.shape[0]
-                )
-            )
-            print(
-                "  This took {0:.3f} seconds to process".format(
-                    time.time() - start_time
-                )
-            )
-
-            print("Removing all MMSI's that have a single message...")
-
-            start_time = time.time()
-            data_frame = data_frame.groupby("mmsi").filter(
-                lambda mmsi_entries: len(mmsi_entries) > 1
-            )
-
-            print(
-                "  There are now {0} MMSI's across {1} entries".format(
-                    data_frame.mmsi.unique().shape[0], data_frame.shape[0]
-                )
-            )
-            print(
-                "  This took {0:.3f} seconds to process".format(
-                    time.time() - start_time
-                )
-            )
-
-            print("Populating pd_timestamp column...")
-
-            start_time = time.time()
-            data_frame["pd_timestamp"] = pd.to_datetime(data_frame["ais_timestamp"])
-            data_frame.sort_values(by="pd_timestamp", inplace=True, ignore_index=True)
-            data_frame.reset_index(inplace=True, drop=True)
-
-            print(
-                "  There are now {0} MMSI's across {1} entries".format(
-                    data_frame.mmsi.unique().shape[0], data_frame.shape[0]
-                )
-            )
-            print(
-                "  This took {0:.3f} seconds to process".format(
-                    time.time() - start_time
-                )
-            )
-
-            print("Dumping deployment AIS data to a monolithic FEATHER file...")
-
-            start_time = time.time()
-            output_file_name = "_".join(
-                [
-                    device,
-                    pandas_timestamp_to_zulu_format(deployment_begin),
-                    pandas_timestamp_to_zulu_format(deployment_end),
-                    "clean_ais_data.feather",
-                ]
-            )
-            output_file_name = os.path.join(
-                combined_deployment_directory, output_file_name
-            )
-            dump_data_frame_to_feather_file(output_file_name, data_frame)
-
-            print(
-                "  This took {0:.3f} seconds to process".format(
-                    time.time() - start_time
-                )
-            )
-
-            # Interpolate the position information for each vessel and save to a separate file.
-            print("Performing temporal interpolation on data...")
-            print(
-                f"  There are {data_frame.shape[0]} AIS entries across {data_frame.mmsi.unique().shape[0]} MMSI's"
-            )
-            start_time = time.time()
-            grouped_by_mmsi = data_frame.groupby("mmsi")
-            grouped_data = [data for mmsi, data in grouped_by_mmsi]
-            grouped_data.sort(key=lambda x: x.shape[0], reverse=True)
-
-            threading_pool = multiprocessing.Pool(processes=number_of_threads)
-            outputs = list(
-                tqdm(
-                    threading_pool.imap_unordered(
-                        interpolation_for_chunks, grouped_data, chunksize=1
-                    ),
-                    total=len(grouped_data)
-                )
-            )
-            threading_pool.close()
-            threading_pool.join()
-            interpolated_data_frame = pd.concat(outputs)
-
-            print(
-                f"  There are {interpolated_data_frame.shape[0]} interpolated entries across {interpolated_data_frame.mmsi.unique().shape[0]} MMSI's"
+            output_file_prefix = os.path.join(
+                combined_deployment_directory,
+                "_".join(
+                    [
+                        device,
+                        pandas_timestamp_to_zulu_format(deployment_begin),
+                        pandas_timestamp_to_zulu_format(deployment_end),
+                    ]
+                ),
             )
-            print(
-                "  This took {0:.3f} seconds to process".format(
-                    time.time() - start_time
-                )
-            )
-
-            # Combine the raw and interpolated data frames.
-            print("Combining the raw and interpolated data frames...")
-
-            start_time = time.time()
-            data_frame = pd.concat(
-                [data_frame, interpolated_data_frame], ignore_index=True
-            )
-            data_frame.sort_values(by="pd_timestamp", inplace=True, ignore_index=True)
-
-            print(
-                f"  There are now {data_frame.shape[0]} combined entries across {data_frame.mmsi.unique().shape[0]} MMSI's"
-            )
-            print(
-                "  This took {0:.3f} seconds to process".format(
-                    time.time() - start_time
-                )
-            )
-
-            print(
-                "Dumping interpolated deployment AIS data to a monolithic FEATHER file..."
-            )
-
-            start_time = time.time()
-            output_file_name = "_".join(
-                [
-                    device,
-                    pandas_timestamp_to_zulu_format(deployment_begin),
-                    pandas_timestamp_to_zulu_format(deployment_end),
-                    "clean_interpolated_ais_data.feather",
-                ]
-            )
-            output_file_name = os.path.join(
-                combined_deployment_directory, output_file_name
-            )
-
-            dump_data_frame_to_feather_file(output_file_name, data_frame)
-            print(
-                "  This took {0:.3f} seconds to process...".format(
-                    time.time() - start_time
-                )
+            combine_deployment_files(
+                [os.path.join(clean_ais_directory, file) for file in deployment_ais_data_files],
+                output_file_prefix + "_clean_ais_data",
+                mmsi_registry,
+                memory_budget_mb,
             )
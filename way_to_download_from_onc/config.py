@@ -5,7 +5,7 @@ WORK_DIR="./underwater"
 # 0 - Query ONC deployments
 # 1 - Download AIS files
 # 2 - Download WAV files
-# 3 - Parse AIS to JSON
+# 3 - Parse AIS to Parquet
 # 4 - Clean AIS data
 # 5 - Combine deployment AIS data
 # 6 - Identify scenarios
@@ -18,6 +18,47 @@ WORK_DIR="./underwater"
 # 13 - Generate a balanced version of the full dataset
 STEPS=[0]
 
+# "async" reuses a pool of HTTP connections from one event loop, "pool" is the former one-process-per-file download.
+DOWNLOAD_ENGINE="async"
+MAX_REQUESTS_PER_HOST=8
+
+# "scenario" only downloads the WAV files that overlap the identified scenario intervals, optionally for some classes.
+WAV_DOWNLOAD_MODE="all"
+VESSEL_CLASSES=None
+
+# Executor of the tasks of every step ("serial", "thread" or "process"), number of workers and tasks per
+# worker. None keeps the defaults of each step.
+EXECUTOR=None
+WORKERS=None
+CHUNKSIZE=None
+
+# Number of processes parsing the AIS files, None uses all the cores and 1 parses the files one by one.
+PARSE_WORKERS=None
+
+# Registry of the static data of the vessels, in the working directory, and shipfinder files to import into it.
+MMSI_REGISTRY_FILE="mmsi_registry.feather"
+SHIPFINDER_FILES=None
+
+# "single_pass" cleans each parsed AIS file once for every deployment, "per_deployment" once per deployment.
+CLEAN_MODE="single_pass"
+
+# Compression of the feather files written by each step ("uncompressed", "lz4" or "zstd"), keyed by step name.
+# Uncompressed files are memory-mapped without copies when read, zstd files are the smallest. Steps that are not
+# listed use lz4.
+FEATHER_COMPRESSION={"clean_ais": "lz4", "clean_ctd": "zstd", "identify_scenarios": "uncompressed"}
+
+# The AIS data of the scenario intervals is kept in one store per scenario CSV (see interval_store.py). True also
+# writes the former '<begin>_<end>_interval_data.feather' file of every interval.
+EXPORT_INTERVAL_FILES=False
+
+# Memory the combine step (5) may use for each deployment, in MB, whatever the length of the deployment.
+COMBINE_MEMORY_BUDGET_MB=1024
+
+# Steps whose inputs and parameters did not change since their last run are skipped, see pipeline.py.
+PIPELINE_MANIFEST_FILE="pipeline_manifest.json"
+# Number of independent steps run at the same time.
+PIPELINE_CONCURRENCY=2
+
 MAX_INCLUSION_RADIUS=15000.0
 INCLUSION_RADIUS=15000
 
@@ -0,0 +1,212 @@
+import re
+
+import numpy as np
+
+from utils import ais_params
+
+
+# Taken from https://www.navcen.uscg.gov/?pageName=AISMessages
+# 1, 2, 3 = Position report (Class A)
+# 5 = Static and voyage related data
+# 18 = Standard Class B equipment position report
+# 19 = Extended Class B equipment position report
+# 24 = Static data report
+MESSAGE_IDS_TO_ACCEPT = (1, 2, 3, 5, 18, 19, 24)
+
+# Single sentence messages that can be decoded in batch. Anything else (multi-sentence messages, unusual padding,
+# talkers other than AIVDM, lower case checksums...) is left to the lpais decoder.
+SINGLE_SENTENCE_REGEX = re.compile(
+    r"^(\w{15}\.\w{3})Z !(AIVDM,1,1,[^,]*,[^,*]*,([0-W`-w]+),([0-5]))\*([0-9A-F]{2})\s*$"
+)
+
+# Bit offsets of the fields in the payload of each message ID, as (offset, width).
+POSITION_REPORT_FIELDS = {
+    # Class A position report.
+    1: {"sog": (50, 10), "x": (61, 28), "y": (89, 27), "cog": (116, 12), "true_heading": (128, 9)},
+    # Class B position reports.
+    18: {"sog": (46, 10), "x": (57, 28), "y": (85, 27), "cog": (112, 12), "true_heading": (124, 9)},
+    19: {"sog": (46, 10), "x": (57, 28), "y": (85, 27), "cog": (112, 12), "true_heading": (124, 9), "type_and_cargo": (263, 8)},
+}
+POSITION_REPORT_FIELDS[2] = POSITION_REPORT_FIELDS[1]
+POSITION_REPORT_FIELDS[3] = POSITION_REPORT_FIELDS[1]
+
+DECODED_COLUMNS = (
+    "line_index",
+    "ais_timestamp",
+    "mmsi",
+    "id",
+    ais_params.X,
+    ais_params.Y,
+    ais_params.SOG,
+    ais_params.COG,
+    ais_params.TRUE_HEADING,
+    ais_params.TYPE_AND_CARGO,
+    ais_params.IMO,
+)
+
+# The only payload lengths (in characters, with no fill bits) that libais accepts for each message ID.
+PAYLOAD_LENGTHS = {1: 28, 2: 28, 3: 28, 18: 28, 19: 52, 24: 28}
+
+
+def _armor_value(_character):
+    value = ord(_character) - 48
+    return value - 8 if value > 40 else value
+
+
+def _payload_values(_payloads):
+    # Undo the 6-bit ASCII armoring: '0'-'W' map to 0-39 and '`'-'w' map to 40-63.
+    values = np.frombuffer("".join(_payloads).encode("ascii"), dtype=np.uint8) - 48
+    values[values > 40] -= 8
+
+    return values
+
+
+def _payload_bits(_payloads, _length):
+    values = _payload_values(_payloads).reshape(len(_payloads), _length)
+
+    # Every character holds 6 bits, so drop the 2 leading bits of each unpacked byte.
+    bits = np.unpackbits(values[:, :, None], axis=2)[:, :, 2:]
+
+    return bits.reshape(len(_payloads), _length * 6)
+
+
+def _unsigned_field(_bits, _offset, _width):
+    weights = np.left_shift(1, np.arange(_width - 1, -1, -1, dtype=np.int64))
+    return _bits[:, _offset:_offset + _width].astype(np.int64) @ weights
+
+
+def _signed_field(_bits, _offset, _width):
+    value = _unsigned_field(_bits, _offset, _width)
+    return np.where(value >= (1 << (_width - 1)), value - (1 << _width), value)
+
+
+def _valid_checksums(_sentences, _checksums):
+    # The NMEA checksum is the XOR of every character between '!' and '*'.
+    data = np.frombuffer("".join(_sentences).encode("ascii"), dtype=np.uint8)
+    lengths = np.fromiter((len(sentence) for sentence in _sentences), dtype=np.int64, count=len(_sentences))
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    computed = np.bitwise_xor.reduceat(data, offsets)
+
+    return computed == np.array([int(checksum, 16) for checksum in _checksums], dtype=np.uint8)
+
+
+def _decode_fields(_bits, _message_id):
+    columns = {}
+
+    if _message_id in POSITION_REPORT_FIELDS:
+        fields = POSITION_REPORT_FIELDS[_message_id]
+
+        # Same scaling as libais: 1/10000 minute for positions and 1/10 for the speed and course, which are C floats.
+        x = _signed_field(_bits, *fields["x"]) / 600000.0
+        y = _signed_field(_bits, *fields["y"]) / 600000.0
+        sog = (_unsigned_field(_bits, *fields["sog"]) / 10.0).astype(np.float32)
+        cog = (_unsigned_field(_bits, *fields["cog"]) / 10.0).astype(np.float32)
+        true_heading = _unsigned_field(_bits, *fields["true_heading"]).astype(np.float32)
+
+        # Same validity limits as parse._get_parameters_from_message.
+        columns[ais_params.X] = np.where(x < 181, x, np.nan)
+        columns[ais_params.Y] = np.where(y < 91, y, np.nan)
+        columns[ais_params.SOG] = np.where(sog < 1023, sog, np.nan).astype(np.float32)
+        columns[ais_params.COG] = np.where(cog < 3600, cog, np.nan).astype(np.float32)
+        columns[ais_params.TRUE_HEADING] = np.where(true_heading < 511, true_heading, np.nan).astype(np.float32)
+
+    if _message_id in (19, 24):
+        offset = POSITION_REPORT_FIELDS[19]["type_and_cargo"] if _message_id == 19 else (40, 8)
+        type_and_cargo = _unsigned_field(_bits, *offset).astype(np.float32)
+        columns[ais_params.TYPE_AND_CARGO] = np.where(type_and_cargo != 0, type_and_cargo, np.nan).astype(np.float32)
+
+    return columns
+
+
+def decode_ais_batch(_lines):
+    '''
+    Decode the single sentence AIS messages of many raw lines at once.
+
+    The message ID is read from the first payload character, so unwanted
+    message types are dropped before any decoding. The payloads of the
+    remaining lines are unpacked into NumPy bit arrays, grouped by message
+    ID, and the fields used for types 1/2/3/18/19 and 24 are extracted into
+    columns with the same values and validity rules as the lpais path.
+
+    Returns the decoded columns (with the 'line_index' of every row), in
+    the order of the lines rather than of the message IDs, the indexes of
+    the lines that have to go through lpais instead, and the number of
+    lines rejected here.
+    '''
+
+    line_indexes = []
+    timestamps = []
+    sentences = []
+    payloads = []
+    checksums = []
+    fallback_indexes = []
+    lines_rejected = 0
+
+    for index, line in enumerate(_lines):
+        match = SINGLE_SENTENCE_REGEX.match(line)
+        if not match:
+            fallback_indexes.append(index)
+            continue
+
+        payload = match.group(3)
+        message_id = _armor_value(payload[0])
+        if message_id not in MESSAGE_IDS_TO_ACCEPT:
+            lines_rejected += 1
+            continue
+
+        if PAYLOAD_LENGTHS.get(message_id) != len(payload) or match.group(4) != "0":
+            fallback_indexes.append(index)
+            continue
+
+        line_indexes.append(index)
+        timestamps.append(match.group(1) + "Z")
+        sentences.append(match.group(2))
+        payloads.append(payload)
+        checksums.append(match.group(5))
+
+    decoded = {name: [] for name in DECODED_COLUMNS}
+    if payloads:
+        # Lines with a wrong checksum are left to lpais so they are handled exactly as before.
+        valid = _valid_checksums(sentences, checksums)
+        fallback_indexes.extend(np.array(line_indexes)[~valid].tolist())
+
+        line_indexes = np.array(line_indexes)[valid]
+        timestamps = np.array(timestamps)[valid]
+        payloads = np.array(payloads)[valid]
+        message_ids = np.array([_armor_value(payload[0]) for payload in payloads], dtype=np.uint8)
+
+        for message_id in np.unique(message_ids).tolist():
+            selected = message_ids == message_id
+            bits = _payload_bits(payloads[selected].tolist(), PAYLOAD_LENGTHS[message_id])
+            mmsi = _unsigned_field(bits, 8, 30)
+            columns = _decode_fields(bits, message_id)
+
+            # Does the message have a correct, 9-digit MMSI?
+            keep = (mmsi >= 100000000) & (mmsi <= 999999999)
+
+            # We only care about part B of message ID 24, which carries the type of the vessel.
+            if message_id == 24:
+                keep &= _unsigned_field(bits, 38, 2) == 1
+
+            # A message without any usable parameter is rejected.
+            keep &= np.any([~np.isnan(column) for column in columns.values()], axis=0)
+            lines_rejected += int((~keep).sum())
+
+            decoded["line_index"].append(line_indexes[selected][keep])
+            decoded["ais_timestamp"].append(timestamps[selected][keep])
+            decoded["mmsi"].append(mmsi[keep])
+            decoded["id"].append(np.full(int(keep.sum()), message_id, dtype=np.uint8))
+            for name in DECODED_COLUMNS[4:]:
+                column = columns.get(name, np.full(selected.sum(), np.nan))
+                decoded[name].append(column[keep])
+
+    decoded = {
+        name: np.concatenate(parts) if parts else np.array([])
+        for name, parts in decoded.items()
+    }
+
+    # The rows come grouped by message ID; put them back in the order of their lines.
+    order = np.argsort(decoded["line_index"], kind="stable")
+    decoded = {name: column[order] for name, column in decoded.items()}
+
+    return decoded, sorted(fallback_indexes), lines_rejected
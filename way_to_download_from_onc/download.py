@@ -1,16 +1,25 @@
 import os
 import time
 import os.path
-import multiprocessing
-
+import asyncio
+import hashlib
 
+import aiohttp
+import numpy as np
 import pandas as pd
 
 from tqdm import tqdm
 from onc.onc import ONC
 from functools import partial
 
-from utils import bcolors
+from interval_store import IntervalAisStore
+from utils import bcolors, zulu_strings_to_nanoseconds, run_tasks
+from generate_metadata import get_class_from_code
+from catalog import ListingCatalog, merge_filters
+from manifest import DownloadManifest, download_state, get_manifest_path
+
+
+ONC_BASE_URL = "https://data.oceannetworks.ca/"
 
 
 def get_deployment_filters(deployment_directory, filter_type="WAV"):
@@ -28,6 +37,7 @@ def get_deployment_filters(deployment_directory, filter_type="WAV"):
                         "dateFrom": row["begin"],
                         "dateTo": row["end"],
                         "extension": "wav",
+                        "returnOptions": "all",
                     }
                 )
             elif filter_type.lower() == "ais":
@@ -37,6 +47,7 @@ def get_deployment_filters(deployment_directory, filter_type="WAV"):
                         "dateFrom": row["begin"],
                         "dateTo": row["end"],
                         "extension": "txt",
+                        "returnOptions": "all",
                     }
                 )
             elif filter_type.lower() == "ctd":
@@ -46,24 +57,37 @@ def get_deployment_filters(deployment_directory, filter_type="WAV"):
                         "dateFrom": row["begin"],
                         "dateTo": row["end"],
                         "extension": "txt",
+                        "returnOptions": "all",
                     }
                 )
     return filters
 
 
-def download_onc_file(_filename, _token, _path):
+def download_onc_file(_filename, _token, _path, _base_url=ONC_BASE_URL):
         onc_api = ONC(_token, outPath=_path, timeout=600)
+        onc_api.baseUrl = _base_url
         onc_api.getFile(_filename, overwrite=False)
+        return _filename
 
 
-def download_file_list(output_directory, token, files_to_download):
+def download_file_list(output_directory, token, files_to_download, base_url=ONC_BASE_URL, manifest=None):
     start_time = time.time()
-    thread_pool = multiprocessing.Pool(20)
-    arguments = partial(download_onc_file, _token=token, _path=output_directory)
-    for _ in tqdm(thread_pool.imap(arguments, files_to_download), total=len(files_to_download)):
-        pass
-    thread_pool.close()
-    thread_pool.join()
+    arguments = partial(download_onc_file, _token=token, _path=output_directory, _base_url=base_url)
+    # The downloads wait on the network, threads are enough for them.
+    for filename in run_tasks(arguments, files_to_download, backend="thread", workers=20):
+        if manifest is not None:
+            # The ONC client writes straight to the final name, so the size check is all we can do here.
+            expected_size, _ = manifest.get_expected(filename)
+            # The client can also return without writing the file at all.
+            if not os.path.exists(os.path.join(output_directory, filename)):
+                manifest.mark(filename, download_state.FAILED)
+                continue
+            size = os.path.getsize(os.path.join(output_directory, filename))
+            if expected_size is None or size == expected_size:
+                manifest.mark(filename, download_state.COMPLETE, size)
+            else:
+                os.remove(os.path.join(output_directory, filename))
+                manifest.mark(filename, download_state.FAILED, size)
     print(
         "  This download took {0:.3f} seconds to complete.\n".format(
             time.time() - start_time
@@ -73,6 +97,163 @@ def download_file_list(output_directory, token, files_to_download):
     return
 
 
+def _get_md5_of_file(_file_path, _chunk_size):
+    md5 = hashlib.md5()
+    with open(_file_path, "rb") as input_file:
+        for chunk in iter(lambda: input_file.read(_chunk_size), b""):
+            md5.update(chunk)
+
+    return md5.hexdigest()
+
+
+async def _download_onc_file_async(_session, _url, _token, _filename, _path, _chunk_size, _manifest=None):
+    parameters = {"token": _token, "method": "getFile", "filename": _filename}
+    file_path = os.path.join(_path, _filename)
+    part_path = file_path + ".part"
+
+    expected_size, checksum = (None, None) if _manifest is None else _manifest.get_expected(_filename)
+
+    # Resume from whatever a previous, interrupted attempt left behind.
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+    # A previous attempt may have stopped after its last chunk, before the verification: nothing is left to download.
+    if expected_size is not None and offset >= expected_size:
+        return _finalize_onc_file(_filename, file_path, part_path, expected_size, checksum, _chunk_size, _manifest)
+
+    try:
+        async with _session.get(_url, params=parameters, headers=headers) as response:
+            # The '.part' file already holds the whole file, the server has no bytes left to send from its end.
+            if response.status == 416 and offset:
+                content_range = response.headers.get("Content-Range", "")
+                if expected_size is None and content_range.startswith("bytes */"):
+                    expected_size = int(content_range[len("bytes */"):])
+                return _finalize_onc_file(_filename, file_path, part_path, expected_size, checksum, _chunk_size, _manifest)
+
+            response.raise_for_status()
+
+            # A server that ignores the range request sends the whole file again.
+            if response.status != 206:
+                offset = 0
+
+            if expected_size is None and response.content_length is not None:
+                expected_size = offset + response.content_length
+
+            # Stream the body straight to disk instead of holding the whole file in memory.
+            with open(part_path, "ab" if offset else "wb") as output_file:
+                async for chunk in response.content.iter_chunked(_chunk_size):
+                    output_file.write(chunk)
+
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        # Keep the '.part' file, the next run resumes from where this one stopped.
+        bytes_written = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if _manifest is not None:
+            _manifest.mark(_filename, download_state.PARTIAL, bytes_written)
+        print(f"{bcolors.FAIL}  Failed to download {_filename}: {e!r}{bcolors.ENDC}")
+        return None
+
+    return _finalize_onc_file(_filename, file_path, part_path, expected_size, checksum, _chunk_size, _manifest)
+
+
+def _finalize_onc_file(_filename, _file_path, _part_path, _expected_size, _checksum, _chunk_size, _manifest=None):
+    # Only a verified file is renamed into place, so anything with the final name is complete.
+    size = os.path.getsize(_part_path)
+    if (_expected_size is not None and size != _expected_size) or (
+        _checksum and _get_md5_of_file(_part_path, _chunk_size) != _checksum
+    ):
+        os.remove(_part_path)
+        if _manifest is not None:
+            _manifest.mark(_filename, download_state.FAILED, size)
+        print(f"{bcolors.FAIL}  Verification failed for {_filename}, it will be downloaded again.{bcolors.ENDC}")
+        return None
+
+    os.replace(_part_path, _file_path)
+    if _manifest is not None:
+        _manifest.mark(_filename, download_state.COMPLETE, size)
+
+    return size
+
+
+async def _download_file_list_async(
+    output_directory,
+    token,
+    files_to_download,
+    max_requests_per_host,
+    base_url,
+    timeout,
+    chunk_size,
+    manifest,
+):
+    url = f"{base_url}api/archivefiles"
+    pending_files = iter(files_to_download)
+    results = []
+
+    # The connector keeps the TCP/TLS connections alive between files, so the handshake is only paid once per connection.
+    connector = aiohttp.TCPConnector(limit=max_requests_per_host, limit_per_host=max_requests_per_host)
+    session_timeout = aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=session_timeout) as session:
+        with tqdm(total=len(files_to_download)) as progress_bar:
+
+            async def worker():
+                for filename in pending_files:
+                    results.append(
+                        await _download_onc_file_async(
+                            session, url, token, filename, output_directory, chunk_size, manifest
+                        )
+                    )
+                    progress_bar.update(1)
+
+            # One worker per allowed in-flight request; each worker pulls the next file as soon as it is free.
+            await asyncio.gather(*[worker() for _ in range(max_requests_per_host)])
+
+    return results
+
+
+def download_file_list_async(
+    output_directory,
+    token,
+    files_to_download,
+    max_requests_per_host=8,
+    base_url=ONC_BASE_URL,
+    timeout=600,
+    chunk_size=1 << 20,
+    manifest=None,
+):
+    '''
+    Download the files with a single asyncio event loop that reuses a pool of
+    HTTP connections, instead of a new process and ONC client per file.
+    Each file is written to a '.part' file, resumed with a range request if
+    it was interrupted, verified, and only then renamed into place.
+    '''
+
+    start_time = time.time()
+    results = asyncio.run(
+        _download_file_list_async(
+            output_directory,
+            token,
+            files_to_download,
+            max_requests_per_host,
+            base_url,
+            timeout,
+            chunk_size,
+            manifest,
+        )
+    )
+
+    failed_files = sum(result is None for result in results)
+    if failed_files:
+        print(f"{bcolors.WARNING}  {failed_files} files failed to download and will be retried on the next run.{bcolors.ENDC}")
+
+    print(
+        "  This download took {0:.3f} seconds to complete.\n".format(
+            time.time() - start_time
+        )
+    )
+
+    return results
+
+
 def query_onc_deployments(deployment_directory, token):
     # Instantiate ONC object.
     onc_api = ONC(token, outPath=deployment_directory, timeout=600)
@@ -108,46 +289,186 @@ def query_onc_deployments(deployment_directory, token):
     filters = []
 
     for device_code, intervals in data_to_fetch.items():
-        output_file = open(
-            os.path.join(deployment_directory, f"{device_code}.csv"), "w"
+        deployment_file = os.path.join(deployment_directory, f"{device_code}.csv")
+        contents = "begin,end,latitude,longitude,depth,location\n" + "".join(
+            ",".join(str(entry) for entry in interval) + "\n" for interval in intervals
         )
-        output_file.write("begin,end,latitude,longitude,depth,location\n")
 
-        for interval in intervals:
-            output_file.write(",".join(str(entry) for entry in interval) + "\n")
+        # The file is only replaced when the deployments changed: a new modification time would make the pipeline
+        # rerun every step that reads the deployments.
+        if os.path.exists(deployment_file):
+            with open(deployment_file, "r") as input_file:
+                if input_file.read() == contents:
+                    continue
 
-        output_file.close()
+        with open(deployment_file + ".part", "w") as output_file:
+            output_file.write(contents)
+        os.replace(deployment_file + ".part", deployment_file)
     return
 
 
-def download_files(output_directory, deployment_directory, token, file_type="WAV"):
+def _get_interval_class(_interval_store, _begin, _end, _inclusion_radius):
+    interval_data = _interval_store.get_columns(_begin, _end, ["distance_to_hydrophone", "type_and_cargo"])
+
+    # Same rule as the metadata generation: the class of the vessel within the inclusion radius, "other" when the
+    # vessel has no type and cargo.
+    class_code = interval_data["type_and_cargo"][interval_data["distance_to_hydrophone"] <= _inclusion_radius][0]
+
+    return get_class_from_code(class_code)
+
+
+def get_scenario_intervals(scenario_intervals_directory, interval_ais_data_directory=None, vessel_classes=None):
+    '''
+    Read the scenario interval CSVs produced by the identify step into a single
+    DataFrame of (device, begin, end, label), keeping only the requested
+    vessel classes when given.
+    '''
+
+    intervals = []
+    interval_store = None
+    for file in sorted(os.listdir(scenario_intervals_directory)):
+        if file.endswith("background_intervals.csv"):
+            is_background = True
+        elif file.endswith("unique_vessel_intervals.csv"):
+            is_background = False
+        else:
+            continue
+
+        data_frame = pd.read_csv(os.path.join(scenario_intervals_directory, file))
+        data_frame["device"] = file.split("_")[0]
+
+        if is_background:
+            data_frame["label"] = "background"
+        elif vessel_classes is not None:
+            interval_store = interval_store or IntervalAisStore(interval_ais_data_directory)
+            data_frame["label"] = [
+                _get_interval_class(interval_store, begin, end, inclusion_radius)
+                for begin, end, inclusion_radius in zip(
+                    zulu_strings_to_nanoseconds(data_frame["begin"]),
+                    zulu_strings_to_nanoseconds(data_frame["end"]),
+                    data_frame["inclusion_radius"],
+                )
+            ]
+        else:
+            data_frame["label"] = "vessel"
+
+        intervals.append(data_frame[["device", "begin", "end", "label"]])
+
+    if not intervals:
+        return pd.DataFrame(columns=["device", "begin", "end", "label"])
+
+    intervals = pd.concat(intervals, ignore_index=True)
+    if vessel_classes is not None:
+        intervals = intervals[intervals["label"].isin(vessel_classes)]
+
+    return intervals
+
+
+def select_scenario_wav_files(wav_file_names, intervals, lead_time=pd.Timedelta(minutes=5)):
+    '''
+    Return the WAV files that overlap the scenario intervals, using the same
+    rule as format.split_and_save_wav: a file starting from 'lead_time'
+    before the beginning of an interval up to its end is needed.
+    '''
+
+    wav_file_names = np.array(sorted(wav_file_names))
+    if not wav_file_names.size or intervals.empty:
+        return []
+
+    wav_devices = np.array([os.path.splitext(file)[0].split("_")[0] for file in wav_file_names])
+    wav_timestamps = zulu_strings_to_nanoseconds(
+        [os.path.splitext(file)[0].split("_")[-1] for file in wav_file_names]
+    )
+
+    selected = np.zeros(wav_file_names.size, dtype=bool)
+    for device, device_intervals in intervals.groupby("device"):
+        device_indexes = np.flatnonzero(wav_devices == device)
+        device_timestamps = wav_timestamps[device_indexes]
+        order = np.argsort(device_timestamps, kind="stable")
+        device_indexes = device_indexes[order]
+        device_timestamps = device_timestamps[order]
+
+        begins = zulu_strings_to_nanoseconds(device_intervals["begin"]) - lead_time.value
+        ends = zulu_strings_to_nanoseconds(device_intervals["end"])
+
+        # Mark every [begin - lead_time, end] range at once with a difference array over the sorted files.
+        coverage = np.zeros(device_indexes.size + 1, dtype=np.int64)
+        np.add.at(coverage, np.searchsorted(device_timestamps, begins, side="left"), 1)
+        np.add.at(coverage, np.searchsorted(device_timestamps, ends, side="right"), -1)
+        selected[device_indexes[np.cumsum(coverage[:-1]) > 0]] = True
+
+    return wav_file_names[selected].tolist()
+
+
+def download_files(
+    output_directory,
+    deployment_directory,
+    token,
+    file_type="WAV",
+    engine="async",
+    max_requests_per_host=8,
+    catalog_file=None,
+    scenario_intervals_directory=None,
+    interval_ais_data_directory=None,
+    vessel_classes=None,
+):
     # Instantiate ONC object.
     onc_api = ONC(token, timeout=600)
 
     # Get the desired filter object to query for files at ONC servers.
-    filters = get_deployment_filters(deployment_directory, filter_type=file_type)
+    # The AIS and CTD filters repeat the same device code for every hydrophone deployment, so overlapping ranges are merged first.
+    filters = merge_filters(get_deployment_filters(deployment_directory, filter_type=file_type))
+
+    if catalog_file is None:
+        catalog_file = os.path.join(os.path.dirname(os.path.normpath(deployment_directory)), "onc_catalog.sqlite")
+    catalog = ListingCatalog(catalog_file)
 
     print(f"Finding available {file_type} files to download...")
-    available_files = [
-        files
-        for new_filter in filters
-        for files in onc_api.getListByDevice(new_filter, allPages=True)["files"]
-    ]
-    available_files.sort()
+    available_files = {}
+    for new_filter in filters:
+        # Only the dates that are not in the local catalog yet are listed from ONC.
+        for date_from, date_to in catalog.missing_ranges(new_filter):
+            missing_filter = dict(new_filter, dateFrom=date_from, dateTo=date_to)
+            # With returnOptions set to "all" each entry also carries the file size (and a checksum when ONC has one).
+            listing = onc_api.getListByDevice(dict(missing_filter), allPages=True)["files"]
+            catalog.add_listing(missing_filter, date_from, date_to, listing)
+
+        # The filename is the key, so a file listed by more than one filter is only queued once.
+        for file in catalog.get_files(new_filter):
+            available_files[file["filename"]] = file
+    catalog.close()
     print(
         f"  Found {bcolors.BOLD}{len(available_files)}{bcolors.ENDC} available {file_type} files.\n"
     )
 
-    print(f"Checking existing {file_type} file directory...")
-    existing_files = os.listdir(output_directory)
-    existing_files.sort()
+    if scenario_intervals_directory is not None:
+        print(f"Selecting the {file_type} files that overlap the scenario intervals...")
+        intervals = get_scenario_intervals(scenario_intervals_directory, interval_ais_data_directory, vessel_classes)
+        scenario_files = select_scenario_wav_files(available_files.keys(), intervals)
+        available_files = {filename: available_files[filename] for filename in scenario_files}
+        print(
+            f"  Selected {bcolors.BOLD}{len(available_files)}{bcolors.ENDC} {file_type} files "
+            f"for {bcolors.BOLD}{len(intervals)}{bcolors.ENDC} scenario intervals.\n"
+        )
+
+    print(f"Checking the {file_type} download manifest...")
+    manifest = DownloadManifest(get_manifest_path(output_directory))
+    manifest.register(
+        [
+            (filename, file.get("fileSize"), file.get("md5"))
+            for filename, file in available_files.items()
+        ]
+    )
+    if manifest.is_new:
+        # Only the very first run with a manifest needs to look at the directory itself.
+        manifest.adopt_existing_files(output_directory)
+    completed_files = manifest.completed_files()
     print(
-        f"  Found {bcolors.BOLD}{len(existing_files)}{bcolors.ENDC} existing {file_type} files.\n"
+        f"  Found {bcolors.BOLD}{len(completed_files)}{bcolors.ENDC} completed {file_type} files.\n"
     )
 
     print(f"Working out what files need downloading...")
-    existing_files = set(existing_files)
-    files_to_download = [file for file in available_files if file not in existing_files]
+    files_to_download = sorted(file for file in available_files if file not in completed_files)
     print(
         f"  There are {bcolors.BOLD}{len(files_to_download)}{bcolors.ENDC} {file_type} files to download.\n"
     )
@@ -156,8 +477,19 @@ def download_files(output_directory, deployment_directory, token, file_type="WAV
         print(f"Commencing download of {file_type} files now...")
         # TODO: There are 306345 files to be downloaded. I just downloaded the first 10 files.
         #download_file_list(output_directory, token, files_to_download[:10])
-        download_file_list(output_directory, token, files_to_download)
+        if engine == "async":
+            download_file_list_async(
+                output_directory,
+                token,
+                files_to_download,
+                max_requests_per_host=max_requests_per_host,
+                manifest=manifest,
+            )
+        else:
+            download_file_list(output_directory, token, files_to_download, manifest=manifest)
     else:
         print(f"{bcolors.WARNING}No {file_type} files to download.{bcolors.ENDC}\n")
 
-    return
\ No newline at end of file
+    manifest.close()
+
+    return
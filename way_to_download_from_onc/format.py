@@ -1,60 +1,57 @@
 import os
 import re
 import sys
+import numpy as np
 import pandas as pd
 
 from tqdm import tqdm
 from pydub import AudioSegment
 from datetime import datetime, timedelta
-from utils import bcolors, create_dir, zulu_string_to_datetime, pandas_timestamp_to_onc_format, read_data_frame_from_feather_file
+from functools import partial
+from utils import bcolors, create_dir, list_downloaded_files, zulu_string_to_datetime, pandas_timestamp_to_onc_format, read_data_frame_from_feather_file, zulu_strings_to_nanoseconds, nanoseconds_to_onc_strings, run_tasks
 
 
 def split_and_save_wav(raw_wav_directory, output_save_dir, data_from_range, wav_file_names, inclusion_radius=0, interval_ais_data_directory=''):
     # Define project constants.
-    five_minutes = timedelta(minutes = 5)
+    five_minutes = pd.Timedelta(minutes = 5).value
     csv_data_to_fetch = []
-    for file_idx, (begin, end) in enumerate(tqdm(zip(data_from_range.begin, data_from_range.end), total=len(data_from_range.index))):
-        wav_files_in_range = []
-        ais_begin_datetime = zulu_string_to_datetime(begin)
-        ais_end_datetime = zulu_string_to_datetime(end)
-        for wav_file in wav_file_names:
-            # print('wav file\t', wav_file)
-            wav_timestamp = os.path.splitext(wav_file)[0].split("_")[-1]
-            wav_datetime = zulu_string_to_datetime(wav_timestamp)
-            # print('wav_datetime\t', wav_datetime)
-            # print('ais_begin_datetime\t', ais_begin_datetime)
-            # print('ais_end_datetime\t', ais_end_datetime)
-            # print('five_minutes\t', five_minutes)
-            # print(wav_datetime >= (ais_begin_datetime - five_minutes),(wav_datetime <= ais_end_datetime))
-            # print('-'*10)
-            if (wav_datetime >= (ais_begin_datetime - five_minutes)) and (wav_datetime <= ais_end_datetime):
-                wav_files_in_range.append((wav_datetime, wav_file))
-                # print('wav_files_in_range\t', wav_files_in_range)
-                # sys.exit()
+
+    # Parse every timestamp once, the comparisons are then done on int64 nanoseconds.
+    wav_file_names = np.array(wav_file_names)
+    wav_timestamps = zulu_strings_to_nanoseconds(
+        [os.path.splitext(wav_file)[0].split("_")[-1] for wav_file in wav_file_names]
+    )
+    ais_begin_timestamps = zulu_strings_to_nanoseconds(data_from_range.begin)
+    ais_end_timestamps = zulu_strings_to_nanoseconds(data_from_range.end)
+    ais_begin_strings = nanoseconds_to_onc_strings(ais_begin_timestamps)
+    ais_end_strings = nanoseconds_to_onc_strings(ais_end_timestamps)
+
+    for file_idx, (ais_begin_timestamp, ais_end_timestamp) in enumerate(tqdm(zip(ais_begin_timestamps, ais_end_timestamps), total=len(data_from_range.index))):
+        in_range = (wav_timestamps >= (ais_begin_timestamp - five_minutes)) & (wav_timestamps <= ais_end_timestamp)
+        wav_files_in_range = sorted(zip(wav_timestamps[in_range].tolist(), wav_file_names[in_range].tolist()))
         if len(wav_files_in_range) == 0:
             # print('continue')
             continue
-        wav_files_in_range.sort()
         try:
             # print('try')
             audio_segment = AudioSegment.from_wav(os.path.join(raw_wav_directory, wav_files_in_range[0][1]))
-            start_time = (wav_files_in_range[0][0] - ais_begin_datetime).total_seconds() * 1000
+            start_time = (wav_files_in_range[0][0] - ais_begin_timestamp) / 1e6
             audio_segment = audio_segment[start_time:]
 
-            for idx, (wav_datetime, wav_file_name) in enumerate(wav_files_in_range):
+            for idx, (wav_timestamp, wav_file_name) in enumerate(wav_files_in_range):
                 if idx == 0 or idx == len(wav_files_in_range):
                     continue
                 audio_segment += AudioSegment.from_wav(os.path.join(raw_wav_directory, wav_file_name))
 
             last_segment = AudioSegment.from_wav(os.path.join(raw_wav_directory, wav_files_in_range[-1][1]))
-            end_time = (ais_end_datetime - wav_files_in_range[-1][0]).total_seconds() * 1000
+            end_time = (ais_end_timestamp - wav_files_in_range[-1][0]) / 1e6
             audio_segment += last_segment[:end_time]
 
             audio_segment.export(os.path.join(output_save_dir, str(file_idx) + ".wav"), format="wav")
             csv_data_to_fetch.append(
                     (
-                        pandas_timestamp_to_onc_format(ais_begin_datetime),
-                        pandas_timestamp_to_onc_format(ais_end_datetime),
+                        ais_begin_strings[file_idx],
+                        ais_end_strings[file_idx],
                         str(file_idx),
                     )
                 )
@@ -154,7 +151,7 @@ def group_wav_from_range(classified_wav_directory, scenario_interval_dir, interv
     range_directory = create_dir(classified_wav_directory, directory_name)
 
     # Get a list of the WAV file names.
-    wav_file_names = os.listdir(raw_wav_directory)
+    wav_file_names = list_downloaded_files(raw_wav_directory)
     interval_file_names = os.listdir(scenario_interval_dir)
     # Read background range data from csv.
     background_interval_file_names = [file for file in interval_file_names if file.lower().endswith('background_intervals.csv')]
@@ -186,7 +183,7 @@ def wav_all(classified_wav_directory, scenario_interval_dir, interval_ais_data_d
     directory_name = "icat"
     range_directory = create_dir(classified_wav_directory, directory_name)
     # Get a list of the WAV file names.
-    wav_file_names = os.listdir(raw_wav_directory)
+    wav_file_names = list_downloaded_files(raw_wav_directory)
     interval_file_names = os.listdir(scenario_interval_dir)
     vessel_interval_file_names = [file for file in interval_file_names if file.lower().endswith('unique_vessel_intervals.csv')]
     all_csv_path = glob.glob("./underwater/03ff/*")
@@ -201,7 +198,7 @@ def wav_all_processed(classified_wav_directory, scenario_interval_dir, interval_
     directory_name = "makek"
     range_directory = create_dir(classified_wav_directory, directory_name)
     # Get a list of the WAV file names.
-    wav_file_names = os.listdir(raw_wav_directory)
+    wav_file_names = list_downloaded_files(raw_wav_directory)
     interval_file_names = os.listdir(scenario_interval_dir)
     vessel_interval_file_names = [file for file in interval_file_names if file.lower().endswith('unique_vessel_intervals.csv')]
     # vessel_interval_data = pd.read_csv(os.path.join(scenario_interval_dir, vessel_interval_file_names[0]))
@@ -297,16 +294,13 @@ def process_wav(raw_wav_directory, output_save_dir, data_from_range, wav_file, c
         if ais_begin_datetime > wav_datetime + five_minutes:# 直接错过，跳出循环
             break
 
-from concurrent.futures import ThreadPoolExecutor
+def process_wav_task(raw_wav_directory, output_save_dir, data_from_range, counter_and_wav_file):
+    counter, wav_file = counter_and_wav_file
+    return process_wav(raw_wav_directory, output_save_dir, data_from_range, wav_file, counter)
+
 
 def wav_file_preprocess(raw_wav_directory, output_save_dir, data_from_range, wav_file_names, inclusion_radius=0, interval_ais_data_directory=''):
-    executor = ThreadPoolExecutor(max_workers=32) # 设置线程池大小
-    futures = []
-    counter = 0
-    for wav_file in tqdm(wav_file_names):
-        future = executor.submit(process_wav, raw_wav_directory, output_save_dir, data_from_range, wav_file, counter) # 提交任务到线程池
-        counter+=1
-        futures.append(future)
-    
-    for future in futures:
-        future.result()
\ No newline at end of file
+    function_partial = partial(process_wav_task, raw_wav_directory, output_save_dir, data_from_range)
+    # 32 threads, the work is mostly reading and writing wav files.
+    for _ in run_tasks(function_partial, enumerate(wav_file_names), backend="thread", workers=32, ordered=False):
+        pass
\ No newline at end of file
@@ -3,7 +3,9 @@ import pandas as pd
 import numpy as np
 from tqdm import tqdm
 from pydub.utils import mediainfo
-from utils import read_data_frame_from_feather_file, get_min_max_normalization, get_min_max_values_from_df
+from registry import load_mmsi_registry
+from interval_store import IntervalAisStore
+from utils import read_data_frame_from_feather_file, get_min_max_normalization, get_min_max_values_from_df, zulu_strings_to_nanoseconds, nanoseconds_to_zulu_strings
 
 #CLASSES = ["passengership", "tug", "tanker", "cargo", "other", "background"]
 CLASSES = ["passengership", "tug", "tanker", "cargo", "background"]
@@ -23,17 +25,72 @@ def get_class_from_code(code):
     return "other"
 
 
-def get_mean_ctd_from_range(data_frame, begin_time, end_time):
-    columns = ["t1", "c1", "p1", "sal", "sv"]
+CTD_COLUMNS = ["t1", "c1", "p1", "sal", "sv"]
 
-    ctd_df = data_frame[data_frame['date'].between(begin_time, end_time, inclusive="both")]
-    ctd_df = ctd_df[columns]
-    t1, c1, p1, sal, sv = ctd_df.apply(pd.to_numeric).mean()
+
+class CtdStore:
+    '''
+    CTD measurements sorted by their int64 nanosecond timestamps, with the
+    cumulative sums and counts of every variable, so that the mean over any
+    time interval takes two searchsorted calls instead of a scan of the
+    whole data. NaN values are left out of the means, like pandas does.
+    '''
+
+    def __init__(self, data_frame, columns=CTD_COLUMNS):
+        self.data_frame = data_frame.sort_values(by=['timestamp'], ignore_index=True, kind='stable')
+        self.columns = list(columns)
+        self.timestamps = self.data_frame['timestamp'].to_numpy(np.int64)
+
+        values = self.data_frame[self.columns].apply(pd.to_numeric).to_numpy(np.float64)
+        valid = ~np.isnan(values)
+
+        # The sums are taken around the mean of each variable to keep the precision of the differences.
+        self.offsets = np.where(valid, values, 0.0).sum(axis=0) / np.maximum(valid.sum(axis=0), 1)
+        centered = np.where(valid, values - self.offsets, 0.0)
+
+        # A leading row of zeros, so that the sum of the rows [lo, hi) is sums[hi] - sums[lo].
+        self.sums = np.zeros((values.shape[0] + 1, len(self.columns)))
+        np.cumsum(centered, axis=0, out=self.sums[1:])
+        self.counts = np.zeros((values.shape[0] + 1, len(self.columns)), dtype=np.int64)
+        np.cumsum(valid, axis=0, out=self.counts[1:])
+
+    def __len__(self):
+        return self.timestamps.size
+
+    def means(self, begin_times, end_times):
+        '''
+        Means of every variable over the closed intervals [begin, end] of
+        int64 nanoseconds, as an array with one row per interval and one
+        column per variable. Intervals without measurements give NaN.
+        '''
+
+        lo = np.searchsorted(self.timestamps, np.asarray(begin_times, dtype=np.int64), side='left')
+        hi = np.searchsorted(self.timestamps, np.asarray(end_times, dtype=np.int64), side='right')
+        hi = np.maximum(hi, lo)
+
+        counts = self.counts[hi] - self.counts[lo]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = (self.sums[hi] - self.sums[lo]) / counts + self.offsets
+
+        means[counts == 0] = np.nan
+        return means
+
+    def mean(self, begin_time, end_time):
+        return tuple(self.means([begin_time], [end_time])[0])
+
+
+def get_mean_ctd_from_range(ctd_store, begin_time, end_time):
+    # The times are int64 nanoseconds, see get_full_ctd_dataframe.
+    t1, c1, p1, sal, sv = ctd_store.mean(begin_time, end_time)
 
     return t1, c1, p1, sal, sv
 
 
 def get_full_ctd_dataframe(clean_ctd_directory):
+    '''
+    Read every cleaned CTD file into a CtdStore.
+    '''
+
     data_files = [file for file in os.listdir(clean_ctd_directory)]
 
     files = [
@@ -43,13 +100,18 @@ def get_full_ctd_dataframe(clean_ctd_directory):
         for file in data_files
     ]
 
+    # The cleaned files hold int64 nanosecond timestamps, older ones the dates as strings.
+    for index, file in enumerate(files):
+        if 'timestamp' not in file.columns:
+            file['timestamp'] = zulu_strings_to_nanoseconds(file['date'])
+            files[index] = file.drop(columns=['date'])
+
     df = pd.concat(files)
-    df.sort_values(by=['date'], ignore_index=True, inplace=True)
 
-    return df
+    return CtdStore(df)
 
 
-def generate_full_metadata(root_path, clean_ctd_directory, interval_ais_dir, inclusion_radius):
+def generate_full_metadata(root_path, clean_ctd_directory, interval_ais_dir, inclusion_radius, mmsi_registry_file=None):
 
     columns = ["label", "duration_sec", "path", "sample_rate", "class_code",
                "date", "MMSI", "t1", "c1", "p1", "sal", "sv", "t1_norm",
@@ -61,29 +123,41 @@ def generate_full_metadata(root_path, clean_ctd_directory, interval_ais_dir, inc
     meta_vessel = os.path.join(dir_vessel, "intervals.csv")
     df_vessel = pd.read_csv(meta_vessel)
 
-    ctd_df = get_full_ctd_dataframe(clean_ctd_directory)
-    min_max_ctd = get_min_max_values_from_df(ctd_df, ["t1", "c1", "p1", "sal", "sv"])
+    ctd_store = get_full_ctd_dataframe(clean_ctd_directory)
+    interval_store = IntervalAisStore(interval_ais_dir)
+    mmsi_registry = load_mmsi_registry(mmsi_registry_file) if mmsi_registry_file is not None else None
+    min_max_ctd = get_min_max_values_from_df(ctd_store.data_frame, CTD_COLUMNS)
+
+    begin_times = zulu_strings_to_nanoseconds(df_vessel["begin"])
+    end_times = zulu_strings_to_nanoseconds(df_vessel["end"])
+    begin_names = nanoseconds_to_zulu_strings(begin_times)
+    end_names = nanoseconds_to_zulu_strings(end_times)
+    ctd_means = ctd_store.means(begin_times, end_times)
 
     print(f"Vessel Metafile")
-    for _, row in tqdm(df_vessel.iterrows(), total=df_vessel.shape[0]):
-        begin_time = row["begin"].replace("-","").replace(":","")
-        end_time = row["end"].replace("-","").replace(":","")
+    for index, (_, row) in enumerate(tqdm(df_vessel.iterrows(), total=df_vessel.shape[0])):
+        begin_time = begin_names[index]
+        end_time = end_names[index]
 
-        interval_file = os.path.join(interval_ais_dir, f"{begin_time}_{end_time}_interval_data.feather")
-        metadata_file = read_data_frame_from_feather_file(interval_file)
+        interval_data = interval_store.get_columns(
+            begin_times[index], end_times[index], ["distance_to_hydrophone", "type_and_cargo", "mmsi"]
+        )
 
-        class_code = metadata_file[metadata_file["distance_to_hydrophone"] <= inclusion_radius].type_and_cargo.unique()[0]
-        mmsi = metadata_file[metadata_file["distance_to_hydrophone"] <= inclusion_radius].mmsi.unique()[0]
+        in_range = interval_data["distance_to_hydrophone"] <= inclusion_radius
+        class_code = pd.unique(interval_data["type_and_cargo"][in_range])[0]
+        mmsi = pd.unique(interval_data["mmsi"][in_range])[0]
+        if pd.isna(class_code) and mmsi_registry is not None:
+            class_code = mmsi_registry.lookup([mmsi])[0]
         path = os.path.join(dir_vessel, f'{row["wav_file"]}.wav')
         info = mediainfo(path)
 
-        t1, c1, p1, sal, sv = get_mean_ctd_from_range(ctd_df, begin_time, end_time)
+        t1, c1, p1, sal, sv = ctd_means[index]
 
         # Append AIS data
         metadata["class_code"].append(class_code)
         metadata["MMSI"].append(mmsi)
         metadata["path"].append(path)
-        metadata["date"].append(row["begin"].replace("-","").split("T")[0])
+        metadata["date"].append(begin_time[:8])
         metadata["duration_sec"].append(info["duration"])
         metadata["sample_rate"].append(info["sample_rate"])
         metadata["label"].append(get_class_from_code(class_code))
@@ -106,25 +180,32 @@ def generate_full_metadata(root_path, clean_ctd_directory, interval_ais_dir, inc
     meta_backgorund = os.path.join(dir_background, "intervals.csv")
     df_background = pd.read_csv(meta_backgorund)
 
+    begin_times = zulu_strings_to_nanoseconds(df_background["begin"])
+    end_times = zulu_strings_to_nanoseconds(df_background["end"])
+    begin_names = nanoseconds_to_zulu_strings(begin_times)
+    end_names = nanoseconds_to_zulu_strings(end_times)
+    ctd_means = ctd_store.means(begin_times, end_times)
+
     print(f"Background Metafile")
-    for _, row in tqdm(df_background.iterrows(), total=df_background.shape[0]):
-        begin_time = row["begin"].replace("-","").replace(":","")
-        end_time = row["end"].replace("-","").replace(":","")
+    for index, (_, row) in enumerate(tqdm(df_background.iterrows(), total=df_background.shape[0])):
+        begin_time = begin_names[index]
+        end_time = end_names[index]
 
-        interval_file = os.path.join(interval_ais_dir, f"{begin_time}_{end_time}_interval_data.feather")    
-        metadata_file = read_data_frame_from_feather_file(interval_file)
+        # The background entries take nothing from the AIS data, but the interval must have been identified.
+        if (begin_times[index], end_times[index]) not in interval_store:
+            raise KeyError(f"No AIS data for the interval {begin_time}_{end_time}")
 
         path = os.path.join(dir_background, f'{row["wav_file"]}.wav')
         info = mediainfo(path)
 
-        t1, c1, p1, sal, sv = get_mean_ctd_from_range(ctd_df, begin_time, end_time)
+        t1, c1, p1, sal, sv = ctd_means[index]
 
         # Append AIS data
         class_code = 0
         metadata["class_code"].append(class_code)
         metadata["MMSI"].append(0)
         metadata["path"].append(path)
-        metadata["date"].append(row["begin"].replace("-","").split("T")[0])
+        metadata["date"].append(begin_time[:8])
         metadata["duration_sec"].append(info["duration"])
         metadata["sample_rate"].append(info["sample_rate"])
         metadata["label"].append(get_class_from_code(class_code))
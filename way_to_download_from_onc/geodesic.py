@@ -0,0 +1,88 @@
+import numpy as np
+import geopy.distance
+
+
+# WGS-84 ellipsoid, the default of geopy.distance.geodesic.
+WGS84_SEMI_MAJOR_AXIS = 6378137.0
+WGS84_FLATTENING = 1 / 298.257223563
+WGS84_SEMI_MINOR_AXIS = (1 - WGS84_FLATTENING) * WGS84_SEMI_MAJOR_AXIS
+
+VINCENTY_TOLERANCE = 1e-12
+VINCENTY_MAX_ITERATIONS = 200
+
+
+def geodesic_distance(_latitude, _longitude, _latitudes, _longitudes):
+    '''
+    Geodesic distances (metres) on the WGS-84 ellipsoid from one point to
+    arrays of points, with Vincenty's inverse formula iterated on whole
+    arrays at once.
+
+    Vincenty agrees with the Karney algorithm of geopy to well under a
+    millimetre at the distances we deal with (see tools/geodesic_benchmark.py).
+    The rare nearly antipodal points where the iteration does not converge
+    are handed over to geopy.
+    '''
+
+    latitudes = np.asarray(_latitudes, dtype=np.float64)
+    longitudes = np.asarray(_longitudes, dtype=np.float64)
+
+    f = WGS84_FLATTENING
+    a = WGS84_SEMI_MAJOR_AXIS
+    b = WGS84_SEMI_MINOR_AXIS
+
+    # Reduced latitudes.
+    u1 = np.arctan((1 - f) * np.tan(np.radians(_latitude)))
+    u2 = np.arctan((1 - f) * np.tan(np.radians(latitudes)))
+    sin_u1, cos_u1 = np.sin(u1), np.cos(u1)
+    sin_u2, cos_u2 = np.sin(u2), np.cos(u2)
+
+    longitude_difference = np.radians(longitudes - _longitude)
+    lambda_ = longitude_difference.copy()
+    converged = np.zeros(latitudes.shape, dtype=bool)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for _ in range(VINCENTY_MAX_ITERATIONS):
+            sin_lambda, cos_lambda = np.sin(lambda_), np.cos(lambda_)
+            sin_sigma = np.hypot(
+                cos_u2 * sin_lambda, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lambda
+            )
+            cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lambda
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+
+            sin_alpha = np.where(sin_sigma != 0, cos_u1 * cos_u2 * sin_lambda / sin_sigma, 0.0)
+            cos_squared_alpha = 1 - sin_alpha ** 2
+
+            # Equatorial lines have cos_squared_alpha = 0.
+            cos_2_sigma_m = np.where(
+                cos_squared_alpha != 0, cos_sigma - 2 * sin_u1 * sin_u2 / cos_squared_alpha, 0.0
+            )
+            c = f / 16 * cos_squared_alpha * (4 + f * (4 - 3 * cos_squared_alpha))
+
+            previous_lambda = lambda_
+            lambda_ = longitude_difference + (1 - c) * f * sin_alpha * (
+                sigma + c * sin_sigma * (cos_2_sigma_m + c * cos_sigma * (-1 + 2 * cos_2_sigma_m ** 2))
+            )
+
+            converged = np.abs(lambda_ - previous_lambda) <= VINCENTY_TOLERANCE
+            if converged[~np.isnan(lambda_)].all():
+                break
+
+        u_squared = cos_squared_alpha * (a ** 2 - b ** 2) / b ** 2
+        big_a = 1 + u_squared / 16384 * (4096 + u_squared * (-768 + u_squared * (320 - 175 * u_squared)))
+        big_b = u_squared / 1024 * (256 + u_squared * (-128 + u_squared * (74 - 47 * u_squared)))
+        delta_sigma = big_b * sin_sigma * (
+            cos_2_sigma_m
+            + big_b / 4 * (
+                cos_sigma * (-1 + 2 * cos_2_sigma_m ** 2)
+                - big_b / 6 * cos_2_sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2_sigma_m ** 2)
+            )
+        )
+
+        distance = b * big_a * (sigma - delta_sigma)
+
+    for index in np.flatnonzero(~converged & ~np.isnan(lambda_)):
+        distance[index] = geopy.distance.geodesic(
+            (_latitude, _longitude), (latitudes[index], longitudes[index])
+        ).meters
+
+    return distance
@@ -5,15 +5,122 @@ import numpy as np
 import pandas as pd
 
 from tqdm import tqdm
+from combine import read_interpolated_window, get_interpolated_window_schema
+from interval_store import (
+    IntervalAisStore,
+    IntervalAisStoreWriter,
+    export_interval_ais_files,
+    INTERVAL_MARGIN,
+)
 from utils import (
     create_dir,
     get_hydrophone_deployments,
     pandas_timestamp_to_zulu_format,
-    dump_data_frame_to_feather_file,
-    read_data_frame_from_feather_file,
+    get_ais_dataset_time_range,
 )
 
 
+# Scenario intervals up to this far apart are read from the combined deployment dataset at once.
+INTERVAL_READ_SPAN = pd.Timedelta(1, "D")
+
+# Nanoseconds in a minute. The scenarios are lists of minute indices, the left edges of their minutes in these.
+MINUTE_NANOSECONDS = pd.Timedelta(1, "min").value
+
+
+def minute_index_to_timestamp(minute):
+    return pd.Timestamp(int(minute) * MINUTE_NANOSECONDS, tz="UTC")
+
+
+def iterate_minute_windows(dataset_directory, first_timestamp, last_timestamp, days=1):
+    '''
+    The left edges of the 1 minute intervals from first_timestamp to
+    last_timestamp of a combined deployment dataset, a window of days at a
+    time, with the AIS entries of the window, interpolated ones included (see
+    combine.read_interpolated_window). Only the columns the scenarios depend
+    on are read, so the deployment is never all in memory at once.
+    '''
+
+    first_interval = first_timestamp.floor("1Min")
+    last_interval = last_timestamp.floor("1Min")
+
+    for window_begin in pd.date_range(first_interval.normalize(), last_interval, freq=f"{days}D"):
+        window_end = window_begin + pd.DateOffset(days=days)
+        data_frame = read_interpolated_window(
+            dataset_directory,
+            window_begin,
+            window_end - pd.Timedelta(1, "ns"),
+            ["pd_timestamp", "mmsi", "distance_to_hydrophone"],
+        )
+
+        # Intervals without entries are kept, as a whole deployment grouped at once would have them.
+        interval_lefts = pd.date_range(
+            max(first_interval, window_begin), min(last_interval, window_end - pd.DateOffset(minutes=1)), freq="1Min"
+        )
+
+        yield interval_lefts, data_frame
+
+
+def _cumulative_counts(minutes, distances, number_of_minutes, radii):
+    # Number of entries within each of the (sorted) radii, for every minute.
+    bins = np.searchsorted(radii, distances, side="left")
+    counts = np.bincount(
+        minutes * (radii.shape[0] + 1) + bins, minlength=number_of_minutes * (radii.shape[0] + 1)
+    ).reshape(number_of_minutes, radii.shape[0] + 1)
+
+    return np.cumsum(counts, axis=1)[:, : radii.shape[0]]
+
+
+def identify_minute_scenarios(interval_lefts, data_frame, inclusion_radii, exclusion_radii):
+    '''
+    Background and single vessel minutes of every pair of radii, for the 1
+    minute intervals starting at interval_lefts and the AIS entries of
+    data_frame. Returns two boolean arrays of shape (minutes, radii):
+
+    - background, when there is no entry within the exclusion radius.
+    - single vessel, when the entries within the exclusion radius are those
+      of a single MMSI, and all of them are within the inclusion radius.
+
+    All the radii are worked out from one pass over the entries: the number
+    of entries and of distinct MMSI's (from the closest entry of each MMSI)
+    within every radius of the grid are cumulative counts over the radii.
+    '''
+
+    number_of_minutes = interval_lefts.shape[0]
+    radii = np.unique(np.concatenate([inclusion_radii, exclusion_radii])).astype(np.float64)
+
+    timestamps = data_frame["pd_timestamp"].values.view(np.int64)
+    distances = data_frame["distance_to_hydrophone"].to_numpy(np.float64)
+    mmsi_codes = pd.factorize(data_frame["mmsi"], use_na_sentinel=False)[0]
+    minutes = np.zeros(timestamps.shape, dtype=np.int64)
+    if number_of_minutes:
+        minutes = (timestamps - interval_lefts[0].value) // MINUTE_NANOSECONDS
+
+    # Entries without a distance are never within range.
+    kept = ~np.isnan(distances) & (minutes >= 0) & (minutes < number_of_minutes)
+    minutes, distances, mmsi_codes = minutes[kept], distances[kept], mmsi_codes[kept]
+
+    entries_within = _cumulative_counts(minutes, distances, number_of_minutes, radii)
+
+    # The closest entry of every MMSI in every minute.
+    order = np.lexsort((distances, mmsi_codes, minutes))
+    minutes, distances, mmsi_codes = minutes[order], distances[order], mmsi_codes[order]
+    closest = np.ones(minutes.shape, dtype=bool)
+    closest[1:] = (minutes[1:] != minutes[:-1]) | (mmsi_codes[1:] != mmsi_codes[:-1])
+    vessels_within = _cumulative_counts(minutes[closest], distances[closest], number_of_minutes, radii)
+
+    inclusion_columns = np.searchsorted(radii, inclusion_radii)
+    exclusion_columns = np.searchsorted(radii, exclusion_radii)
+
+    background = entries_within[:, exclusion_columns] == 0
+    single_vessel = (
+        ~background
+        & (vessels_within[:, exclusion_columns] == 1)
+        & (entries_within[:, inclusion_columns] == entries_within[:, exclusion_columns])
+    )
+
+    return background, single_vessel
+
+
 class map_colors:
     exclusion_zone = "#ad2727"
     inclusion_zone = "#27ad27"
@@ -84,6 +191,73 @@ def plot_map(
         )
     )
 
+def find_consecutive_runs(minutes, minimum_consecutive_minutes):
+    '''
+    The first and last positions of the runs of sorted minute indices whose
+    steps from the previous minute are all the same, for the runs of at
+    least minimum_consecutive_minutes.
+
+    The step of the first minute is 0, and a minute that follows a gap has a
+    step of its own: it ends the run before it rather than beginning the
+    next one. The interval of a run therefore goes from its first minute to
+    one minute after its last.
+    '''
+
+    if not minutes.size:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    steps = np.diff(minutes, prepend=minutes[0])
+    run_begins = np.flatnonzero(np.concatenate([[True], steps[1:] != steps[:-1]]))
+    run_ends = np.append(run_begins[1:], minutes.shape[0]) - 1
+    long_enough = run_ends - run_begins + 1 >= minimum_consecutive_minutes
+
+    return run_begins[long_enough], run_ends[long_enough]
+
+
+def write_interval_ais_store(dataset_directory, intervals, interval_ais_data_directory, store_name):
+    '''
+    Write the AIS entries of the intervals (pairs of begin and end
+    timestamps, the interval IDs being their positions) and of the minute
+    either side of them to an interval store (see interval_store.py). The
+    intervals are read from the combined deployment dataset in groups that
+    span up to INTERVAL_READ_SPAN, and each interval is sliced from the
+    entries of its group with searchsorted.
+    '''
+
+    writer = IntervalAisStoreWriter(
+        interval_ais_data_directory, store_name, get_interpolated_window_schema(dataset_directory)
+    )
+
+    begins = np.array([interval[0].value for interval in intervals], dtype=np.int64) - INTERVAL_MARGIN.value
+    ends = np.array([interval[1].value for interval in intervals], dtype=np.int64) + INTERVAL_MARGIN.value
+
+    groups = []
+    for interval_id in np.argsort(begins, kind="stable"):
+        if groups and max(groups[-1][1], ends[interval_id]) - groups[-1][0] <= INTERVAL_READ_SPAN.value:
+            groups[-1][1] = max(groups[-1][1], ends[interval_id])
+            groups[-1][2].append(interval_id)
+        else:
+            groups.append([begins[interval_id], ends[interval_id], [interval_id]])
+
+    for group_begin, group_end, interval_ids in groups:
+        data_frame = read_interpolated_window(
+            dataset_directory, pd.Timestamp(group_begin, tz="UTC"), pd.Timestamp(group_end, tz="UTC")
+        )
+        timestamps = data_frame["pd_timestamp"].values.view(np.int64)
+
+        for interval_id in interval_ids:
+            first_row = np.searchsorted(timestamps, begins[interval_id], side="left")
+            last_row = np.searchsorted(timestamps, ends[interval_id], side="right")
+            writer.write(
+                interval_id,
+                intervals[interval_id][0].value,
+                intervals[interval_id][1].value,
+                data_frame.iloc[first_row:last_row],
+            )
+
+    writer.close()
+
+
 def generate_csv(
     interval_dicts,
     device,
@@ -91,7 +265,7 @@ def generate_csv(
     deployment_end,
     scenario_intervals_directory,
     interval_ais_data_directory,
-    data_frame,
+    dataset_directory,
     minimum_consecutive_minutes=30,
     is_background=True,
     csv_name="file.csv"
@@ -104,83 +278,26 @@ def generate_csv(
     descending_keys = list(interval_dicts.keys())
     descending_keys.sort(reverse=True)
 
-    print(f"Identifying consecutively time intervals and saving to feather file...")
-    for distance_index, key in tqdm(enumerate(descending_keys)):
-
-        # Create a temporary DataFrame with a single column.
-        temporary_data_frame = pd.DataFrame(
-            interval_dicts[key],
-            columns=["closed_left"],
-        )
-
-        # Calculate the difference between each row and the next.
-        temporary_data_frame["difference"] = (
-            temporary_data_frame["closed_left"]
-            .diff()
-            .dt.total_seconds()
-            .div(60, fill_value=0.0)
-        )
-
-        # This logic ignore the first occurency of consecutive diference (the value will be 1 for the first element).
-        # This behaviour is compensated at the feather file dump by incrementing one to the interval.
-        # Tally the number of consecutive differences (e.g. where delta_time == 1 consistently).
-        temporary_data_frame["consecutive"] = (
-            temporary_data_frame["difference"]
-            .groupby(
-                (
-                    temporary_data_frame["difference"]
-                    != temporary_data_frame["difference"].shift()
-                ).cumsum()
-            )
-            .transform("size")
-        )
+    # Sorted minutes already selected at a further range.
+    selected_minutes = np.zeros(0, dtype=np.int64)
 
-        # Select only the intervals where the consecutive number (e.g. total time) meets the criteria above.
-        temporary_data_frame = temporary_data_frame[
-            temporary_data_frame["consecutive"] >= minimum_consecutive_minutes
-        ]
-
-        start_index = -1
-        end_index = -1
-        start_timestamp = None
-        end_timestamp = None
-
-        # There is most certainly a more pandas way of doing this whole process, but bugger it, this is fast enough.
-        # Get start and end timestamps from the consecutive periods.
-        while end_index != (temporary_data_frame.shape[0] - 1):
-            start_index = end_index + 1
-            end_index = (
-                start_index
-                + temporary_data_frame.iloc[start_index]["consecutive"]
-                - 1
-            )
-            start_timestamp = temporary_data_frame.iloc[start_index][
-                "closed_left"
+    print(f"Identifying consecutively time intervals and saving to feather file...")
+    for key in tqdm(descending_keys):
+        minutes = np.asarray(interval_dicts[key], dtype=np.int64)
+        minutes = minutes[~np.isin(minutes, selected_minutes, assume_unique=True)]
+
+        run_begins, run_ends = find_consecutive_runs(minutes, minimum_consecutive_minutes)
+        if run_begins.size:
+            list_of_data_to_fetch[key] = [
+                [minute_index_to_timestamp(minutes[begin]), minute_index_to_timestamp(minutes[end] + 1)]
+                for begin, end in zip(run_begins, run_ends)
             ]
-            end_timestamp = temporary_data_frame.iloc[end_index][
-                "closed_left"
-            ] + pd.DateOffset(minutes=1)
 
-            if key not in list_of_data_to_fetch:
-                list_of_data_to_fetch[key] = []
-
-            list_of_data_to_fetch[key].append(
-                [start_timestamp, end_timestamp]
-            )
-
-
-        # Having the reference list as a set makes the look-up an O(1) operation instead of an O(N) for a list.
-        # Utterly hilarious difference in performance between those two with large lists.
-        reference_list = set(temporary_data_frame["closed_left"])
-
-        for modify_index in range(distance_index + 1, len(descending_keys)):
-            interval_dicts[descending_keys[modify_index]] = [
-                value
-                for value in interval_dicts[
-                    descending_keys[modify_index]
-                ]
-                if value not in reference_list
-            ]
+        # Every minute of the selected runs.
+        run_marks = np.zeros(minutes.shape[0] + 1, dtype=np.int64)
+        np.add.at(run_marks, run_begins, 1)
+        np.add.at(run_marks, run_ends + 1, -1)
+        selected_minutes = np.union1d(selected_minutes, minutes[np.cumsum(run_marks[:-1]) > 0])
 
     file_name = "_".join(
         [
@@ -200,8 +317,9 @@ def generate_csv(
     else:
         output_file.write("inclusion_radius,exclusion_radius,begin,end\n")
 
-    for key, intervals in list_of_data_to_fetch.items():
-        for interval in intervals:
+    intervals = []
+    for key, key_intervals in list_of_data_to_fetch.items():
+        for interval in key_intervals:
             if is_background:
                 output_file.write(
                     ",".join(
@@ -227,31 +345,13 @@ def generate_csv(
                         + "\n"
                     )
 
-            # Dump the AIS data for these scenarios to individual feather files.
-            feather_file_name = "_".join(
-                [
-                    pandas_timestamp_to_zulu_format(interval[0]),
-                    pandas_timestamp_to_zulu_format(interval[1]),
-                    "interval_data.feather",
-                ]
-            )
-
-            dump_data_frame_to_feather_file(
-                os.path.join(interval_ais_data_directory, feather_file_name),
-                data_frame[
-                    (
-                        data_frame["pd_timestamp"]
-                        >= (interval[0] - pd.DateOffset(minutes=1))
-                    )
-                    & (
-                        data_frame["pd_timestamp"]
-                        <= (interval[1] + pd.DateOffset(minutes=1))
-                    )
-                ],
-            )
+            intervals.append(interval)
 
     output_file.close()
 
+    # Store the AIS data of these scenarios, keyed by their row in the CSV.
+    write_interval_ais_store(dataset_directory, intervals, interval_ais_data_directory, os.path.splitext(file_name)[0])
+
 
 def identify_scenarios(
     working_directory,
@@ -259,6 +359,7 @@ def identify_scenarios(
     scenario_intervals_directory,
     interval_ais_data_directory,
     combined_deployment_directory,
+    export_interval_files=False,
 ):
 
     # Read in the hydrophone deployments as we will treat each deployment as an individual dataset.
@@ -287,13 +388,17 @@ def identify_scenarios(
                     device,
                     pandas_timestamp_to_zulu_format(deployment_begin),
                     pandas_timestamp_to_zulu_format(deployment_end),
-                    "clean_interpolated_ais_data.feather",
+                    "clean_ais_data",
                 ]
             )
 
-            data_frame = read_data_frame_from_feather_file(
-                os.path.join(combined_deployment_directory, deployment_file_name)
-            )
+            # The interpolated entries are generated from the cleaned messages, a window at a time, when they are needed.
+            dataset_directory = os.path.join(combined_deployment_directory, deployment_file_name)
+            time_range = get_ais_dataset_time_range(dataset_directory)
+            if time_range is None:
+                print("  There are no AIS entries for this deployment")
+                continue
+            first_timestamp, last_timestamp = time_range
             # print(data_frame.head())
             # sys.exit()
             minimum_distance = 1000
@@ -304,7 +409,6 @@ def identify_scenarios(
             )
             exclusion_radius_offset = 2000
 
-            data_frame = data_frame.sort_values(by=["pd_timestamp"])
             # 2: Find the time intervals where only one vessel is within range.
 
             map_data_directory = create_dir(
@@ -315,99 +419,63 @@ def identify_scenarios(
             exclusion_radii_mapped = []
             inclusion_radii_mapped = []
 
-            # Breaking the data off into dictionaries of DataFrames to make organising it easier, compared to n-columns being added to all entries.
+            # Breaking the data off into dictionaries of minute indices to make organising it easier, compared to n-columns being added to all entries.
             inclusion_exclusion_interval_dicts = {}
             background_noise_interval_dicts = {}
 
-            # data_frame.set_index("pd_timestamp")
-            data_frame.set_index(data_frame['pd_timestamp'], inplace=True)
-            grouped_by_time_intervals = data_frame.groupby(
-                pd.Grouper(freq="1Min", offset="0Min", label="left")
-            )
-            # grouped_by_time_intervals = data_frame.groupby(['distance_to_hydrophone'])
+            exclusion_radii = inclusion_radii + exclusion_radius_offset
+            background_minutes = {exclusion_radius: [] for exclusion_radius in exclusion_radii}
+            single_vessel_minutes = {inclusion_radius: [] for inclusion_radius in inclusion_radii}
 
-            reporting_day = (
-                grouped_by_time_intervals.first().iloc[0]["pd_timestamp"].normalize()
-            )
+            reporting_day = first_timestamp.normalize()
             print(f"Processing day {reporting_day} now...")
 
-            # Due to the size of the primary DataFrame, we only really want to iterate through the entire thing once, so the interval is top.
-            for interval_left, interval_data in tqdm(grouped_by_time_intervals):
-                for inclusion_radius in inclusion_radii:
-                    exclusion_radius = inclusion_radius + exclusion_radius_offset
-
-                    # No entries within exclusion range means that we can use this interval for background noise estimation.
-                    # print('sum\t',sum(interval_data["distance_to_hydrophone"]))
-                    # if sum(interval_data["distance_to_hydrophone"]) != 0:
-                    #     print(sum(interval_data["distance_to_hydrophone"]))
-                    #     sys.exit()
-                    if (sum(interval_data["distance_to_hydrophone"] <= exclusion_radius) == 0):
-                        if exclusion_radius not in background_noise_interval_dicts:
-                            background_noise_interval_dicts[exclusion_radius] = []
-
-                        background_noise_interval_dicts[exclusion_radius].append(interval_left)
-
-                        # Create the map for sanity checking.
-                        if exclusion_radius not in exclusion_radii_mapped:
-                            exclusion_radii_mapped.append(exclusion_radius)
-                            plot_map(
-                                deployment,
-                                device,
-                                map_data_directory,
-                                exclusion_radius=exclusion_radius,
-                                file_name=f"exclusion_radius_{exclusion_radius:05d}_metres.html"
-                            )
-
-                    # Else there is something in the exclusion range.
-                    else:
-                        # print('there is something in the exclusion range.')
-                        only_one_vessel_within_exclusion_radius = (
-                            interval_data[
-                                interval_data["distance_to_hydrophone"]
-                                <= exclusion_radius
-                            ]["mmsi"]
-                            .unique()
-                            .shape[0]
-                        ) == 1
-
-                        number_of_messages_in_inclusion_radius = sum(
-                            interval_data["distance_to_hydrophone"] <= inclusion_radius
-                        )
-                        number_of_messages_in_exclusion_radius = sum(
-                            interval_data["distance_to_hydrophone"] <= exclusion_radius
-                        )
-                        all_messages_are_within_inclusion_radius = (
-                            number_of_messages_in_inclusion_radius
-                            == number_of_messages_in_exclusion_radius
+            # Due to the size of the primary DataFrame, we only really want to iterate through the entire thing once, so
+            # it is read a day at a time and every minute of the day is classified for all the radii at once.
+            for interval_lefts, interval_data in tqdm(
+                iterate_minute_windows(dataset_directory, first_timestamp, last_timestamp)
+            ):
+                background, single_vessel = identify_minute_scenarios(
+                    interval_lefts, interval_data, inclusion_radii, exclusion_radii
+                )
+
+                for index, (inclusion_radius, exclusion_radius) in enumerate(zip(inclusion_radii, exclusion_radii)):
+                    background_minutes[exclusion_radius].append(interval_lefts.asi8[background[:, index]])
+                    single_vessel_minutes[inclusion_radius].append(interval_lefts.asi8[single_vessel[:, index]])
+
+            for inclusion_radius, exclusion_radius in zip(inclusion_radii, exclusion_radii):
+                # No entries within exclusion range means that we can use this interval for background noise estimation.
+                minutes = np.concatenate(background_minutes[exclusion_radius]) // MINUTE_NANOSECONDS
+                if minutes.size:
+                    background_noise_interval_dicts[exclusion_radius] = minutes
+
+                    # Create the map for sanity checking.
+                    if exclusion_radius not in exclusion_radii_mapped:
+                        exclusion_radii_mapped.append(exclusion_radius)
+                        plot_map(
+                            deployment,
+                            device,
+                            map_data_directory,
+                            exclusion_radius=exclusion_radius,
+                            file_name=f"exclusion_radius_{exclusion_radius:05d}_metres.html"
                         )
 
-                        # If there is only a single vessel within the exclusion range and that vessel is within the inclusion range.
-                        if (
-                            only_one_vessel_within_exclusion_radius
-                            and all_messages_are_within_inclusion_radius
-                        ):
-                            scenario = (
-                                f"in_{inclusion_radius:05d}_out_{exclusion_radius:05d}"
-                            )
-
-                            if scenario not in inclusion_exclusion_interval_dicts:
-                                inclusion_exclusion_interval_dicts[scenario] = []
-
-                            inclusion_exclusion_interval_dicts[scenario].append(
-                                interval_left
-                            )
-
-                            if inclusion_radius not in inclusion_radii_mapped:
-                                inclusion_radii_mapped.append(inclusion_radius)
-
-                                plot_map(
-                                    deployment,
-                                    device,
-                                    map_data_directory,
-                                    exclusion_radius=exclusion_radius,
-                                    inclusion_radius=inclusion_radius,
-                                    file_name=f"inclusion_radius_{inclusion_radius:05d}_metres_exclusion_radius_{exclusion_radius:05d}_metres.html"
-                                )
+                # If there is only a single vessel within the exclusion range and that vessel is within the inclusion range.
+                minutes = np.concatenate(single_vessel_minutes[inclusion_radius]) // MINUTE_NANOSECONDS
+                if minutes.size:
+                    scenario = f"in_{inclusion_radius:05d}_out_{exclusion_radius:05d}"
+                    inclusion_exclusion_interval_dicts[scenario] = minutes
+
+                    if inclusion_radius not in inclusion_radii_mapped:
+                        inclusion_radii_mapped.append(inclusion_radius)
+                        plot_map(
+                            deployment,
+                            device,
+                            map_data_directory,
+                            exclusion_radius=exclusion_radius,
+                            inclusion_radius=inclusion_radius,
+                            file_name=f"inclusion_radius_{inclusion_radius:05d}_metres_exclusion_radius_{exclusion_radius:05d}_metres.html"
+                        )
 
             print(f"  Finished identifying all scenarios...")
 
@@ -419,7 +487,7 @@ def identify_scenarios(
                 deployment_end,
                 scenario_intervals_directory,
                 interval_ais_data_directory,
-                data_frame,
+                dataset_directory,
                 minimum_consecutive_minutes=30,
                 is_background=True,
                 csv_name="background_intervals.csv"
@@ -433,9 +501,12 @@ def identify_scenarios(
                 deployment_end,
                 scenario_intervals_directory,
                 interval_ais_data_directory,
-                data_frame,
+                dataset_directory,
                 minimum_consecutive_minutes=5,
                 is_background=False,
                 csv_name="unique_vessel_intervals.csv"
             )
 
+    # The former '<begin>_<end>_interval_data.feather' files, for the tools that read them.
+    if export_interval_files:
+        export_interval_ais_files(IntervalAisStore(interval_ais_data_directory), interval_ais_data_directory)
@@ -0,0 +1,187 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from utils import (
+    bcolors,
+    feather_settings,
+    dump_data_frame_to_feather_file,
+    read_arrow_table_from_feather_file,
+    read_data_frame_from_feather_file,
+    arrow_column_to_numpy,
+    nanoseconds_to_zulu_strings,
+)
+
+
+# Every interval comes with the entries of the minute before and after it.
+INTERVAL_MARGIN = pd.Timedelta(1, "min")
+
+INTERVAL_STORE_SUFFIX = "_ais_data.feather"
+INTERVAL_INDEX_SUFFIX = "_index.feather"
+
+
+def get_interval_file_name(_begin, _end):
+    # The name of the former per-interval files, from int64 nanoseconds.
+    begin, end = nanoseconds_to_zulu_strings(np.array([_begin, _end], dtype=np.int64))
+    return f"{begin}_{end}_interval_data.feather"
+
+
+class IntervalAisStoreWriter:
+    '''
+    Writes the AIS entries of the intervals of a scenario CSV to a single
+    feather file, '<name>_ais_data.feather', one block of rows after the
+    other, and the interval index to '<name>_index.feather': for every
+    interval ID (its row in the CSV), its begin and end (int64 nanoseconds)
+    and the first row and number of rows of its block.
+
+    Every block is converted to the given Arrow schema, so that empty
+    intervals, whose object columns have no type of their own, are written
+    like the others. The compression is the one of the identify_scenarios step, see
+    utils.feather_settings. Both files are written to '.part' files first,
+    and only replace the former store on close().
+    '''
+
+    def __init__(self, directory, name, schema):
+        self.store_file = os.path.join(directory, name + INTERVAL_STORE_SUFFIX)
+        self.index_file = os.path.join(directory, name + INTERVAL_INDEX_SUFFIX)
+        self.writer = None
+        self.schema = schema.remove_metadata()
+        self.number_of_rows = 0
+        self.index = {"interval_id": [], "begin": [], "end": [], "first_row": [], "number_of_rows": []}
+
+    def write(self, interval_id, begin, end, data_frame):
+        table = pa.Table.from_pandas(data_frame, schema=self.schema, preserve_index=False)
+        if self.writer is None:
+            compression = feather_settings.COMPRESSION.get("identify_scenarios") or "lz4"
+            self.writer = pa.ipc.new_file(
+                self.store_file + ".part",
+                self.schema,
+                options=pa.ipc.IpcWriteOptions(compression=None if compression == "uncompressed" else compression),
+            )
+        self.writer.write_table(table)
+
+        self.index["interval_id"].append(interval_id)
+        self.index["begin"].append(begin)
+        self.index["end"].append(end)
+        self.index["first_row"].append(self.number_of_rows)
+        self.index["number_of_rows"].append(table.num_rows)
+        self.number_of_rows += table.num_rows
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            os.replace(self.store_file + ".part", self.store_file)
+        elif os.path.exists(self.store_file):
+            os.remove(self.store_file)
+
+        index = pd.DataFrame({key: np.array(values, dtype=np.int64) for key, values in self.index.items()})
+        dump_data_frame_to_feather_file(self.index_file + ".part", index.sort_values(by="interval_id", ignore_index=True))
+        os.replace(self.index_file + ".part", self.index_file)
+
+
+class IntervalAisStore:
+    '''
+    The AIS entries of the scenario intervals of every store of a directory
+    (see IntervalAisStoreWriter), looked up by (begin, end) in int64
+    nanoseconds. The store files are memory-mapped when first used, and
+    the blocks are slices of them.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.tables = {}
+        self.intervals = {}
+
+        for file in sorted(os.listdir(directory)):
+            if not file.endswith(INTERVAL_INDEX_SUFFIX):
+                continue
+
+            store_file = os.path.join(directory, file[: -len(INTERVAL_INDEX_SUFFIX)] + INTERVAL_STORE_SUFFIX)
+            index = read_data_frame_from_feather_file(os.path.join(directory, file))
+            for begin, end, first_row, number_of_rows in zip(
+                index.begin, index.end, index.first_row, index.number_of_rows
+            ):
+                self.intervals[(int(begin), int(end))] = (store_file, int(first_row), int(number_of_rows))
+
+        # Sorted begins, to find the interval that holds any other (begin, end) pair.
+        self.keys = sorted(self.intervals)
+        self.begins = np.array([begin for begin, _ in self.keys], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def __contains__(self, interval):
+        begin, end = interval
+        return (int(begin), int(end)) in self.intervals
+
+    def _table(self, store_file):
+        if store_file not in self.tables:
+            self.tables[store_file] = read_arrow_table_from_feather_file(store_file)
+        return self.tables[store_file]
+
+    def interval(self, begin, end):
+        '''
+        The Arrow table of the entries of an identified interval, from the
+        minute before begin to the minute after end. KeyError if there is no
+        such interval.
+        '''
+
+        store_file, first_row, number_of_rows = self.intervals[(int(begin), int(end))]
+        return self._table(store_file).slice(first_row, number_of_rows)
+
+    def get(self, begin, end, columns=None):
+        '''
+        The entries from begin to end (both included) as a DataFrame indexed
+        by pd_timestamp, like the former per-interval files. Any (begin, end)
+        pair within an identified interval and its margins can be looked up:
+        the block of the interval is sliced with searchsorted on its
+        timestamps.
+        '''
+
+        begin, end = int(begin), int(end)
+        if (begin, end) in self.intervals:
+            table = self.interval(begin, end)
+        else:
+            margin = INTERVAL_MARGIN.value
+            candidates = self.keys[: np.searchsorted(self.begins, begin + margin, side="right")]
+            holding = [key for key in candidates if key[0] - margin <= begin and end <= key[1] + margin]
+            if not holding:
+                raise KeyError((begin, end))
+
+            table = self.interval(*holding[-1])
+            timestamps = table.column("pd_timestamp").to_numpy().view(np.int64)
+            first_row = np.searchsorted(timestamps, begin, side="left")
+            table = table.slice(first_row, np.searchsorted(timestamps, end, side="right") - first_row)
+
+        data_frame = table.to_pandas()
+        data_frame.set_index(data_frame["pd_timestamp"], inplace=True)
+
+        return data_frame if columns is None else data_frame[columns]
+
+    def get_columns(self, begin, end, columns):
+        '''
+        The given columns of an identified interval as NumPy arrays, keyed by
+        column: views on the memory-mapped store when it is uncompressed.
+        '''
+
+        table = self.interval(begin, end)
+        return {column: arrow_column_to_numpy(table.column(column)) for column in columns}
+
+
+def export_interval_ais_files(_store, _directory):
+    '''
+    Write every interval of the store to its own
+    '<begin>_<end>_interval_data.feather' file, as the identify step did
+    before the store, for the tools that still read those.
+    '''
+
+    for begin, end in _store.keys:
+        dump_data_frame_to_feather_file(
+            os.path.join(_directory, get_interval_file_name(begin, end)),
+            _store.get(begin, end),
+            step="identify_scenarios",
+        )
+
+    print(f"  Exported {bcolors.BOLD}{len(_store)}{bcolors.ENDC} interval files")
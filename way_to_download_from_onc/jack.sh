@@ -2,7 +2,7 @@
     "0 - Query ONC deployments; "
     "1 - Download AIS files; "
     "2 - Download WAV files; "
-    "3 - Parse AIS to JSON; "
+    "3 - Parse AIS to Parquet; "
     "4 - Clean AIS data; "
     "5 - Combine deployment AIS data; "
     "6 - Identify scenarios; "
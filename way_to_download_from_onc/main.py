@@ -2,14 +2,26 @@ import argparse
 import os
 
 from config import *
-from utils import bcolors, create_dir, get_exclusion_radius
+from utils import (
+    bcolors,
+    create_dir,
+    get_exclusion_radius,
+    configure_executor,
+    configure_feather_compression,
+    feather_settings,
+    EXECUTOR_BACKENDS,
+    FEATHER_COMPRESSIONS,
+)
+from metrics import RunLog, compare_runs
 from download import query_onc_deployments, download_files
-from parse import parse_ais_to_json
-from clean import clean_ais_data, clean_ctd_data
+from parse import parse_ais_to_json, get_parsed_file_name
+from registry import update_mmsi_registry
+from clean import clean_ais_data, clean_ctd_data, get_cleaned_file_name
 from combine import combine_deployment_ais_data
 from identify import identify_scenarios
 from format import group_wav_from_range, wav_all, wav_all_processed
 from generate_metadata import generate_full_metadata, generate_balanced_metadata, get_metadata_for_small_times, split_dataset
+from pipeline import Stage, PipelineManifest, run_pipeline
 
 
 def create_parser():
@@ -45,7 +57,7 @@ def create_parser():
         "0 - Query ONC deployments; "
         "1 - Download AIS files; "
         "2 - Download WAV files; "
-        "3 - Parse AIS to JSON; "
+        "3 - Parse AIS to Parquet; "
         "4 - Clean AIS data; "
         "5 - Combine deployment AIS data; "
         "6 - Identify scenarios; "
@@ -58,6 +70,90 @@ def create_parser():
         "13 - Split dataset into Train, Test and Validation.",
     )
 
+    parser.add_argument(
+        "--download_engine",
+        type=str,
+        choices=["async", "pool"],
+        default=DOWNLOAD_ENGINE,
+        help="The engine used to download ONC files. 'async' reuses HTTP connections from a single event loop, "
+        "'pool' downloads each file from a separate process.",
+    )
+
+    parser.add_argument(
+        "--max_requests_per_host",
+        type=int,
+        default=MAX_REQUESTS_PER_HOST,
+        help="The maximum number of in-flight download requests per host. Only used by the 'async' download engine.",
+    )
+
+    parser.add_argument(
+        "--wav_download_mode",
+        type=str,
+        choices=["all", "scenario"],
+        default=WAV_DOWNLOAD_MODE,
+        help="'all' downloads every WAV file of every deployment. 'scenario' only downloads the WAV files that overlap "
+        "the intervals found by the identify step (6), which then runs before the WAV download.",
+    )
+
+    parser.add_argument(
+        "--vessel_classes",
+        type=str,
+        nargs="+",
+        default=VESSEL_CLASSES,
+        help="The classes (e.g. cargo tug background) whose scenario intervals are downloaded. "
+        "Only used with '--wav_download_mode scenario'. By default, all classes are downloaded.",
+    )
+
+    parser.add_argument(
+        "--executor",
+        type=str,
+        choices=list(EXECUTOR_BACKENDS),
+        default=EXECUTOR,
+        help="Run the tasks of every step in this process ('serial'), in threads ('thread') or in processes "
+        "('process'). By default, each step uses its own backend: threads for downloads, processes otherwise.",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help="The number of threads or processes used by every step. By default, each step uses its own number.",
+    )
+
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=CHUNKSIZE,
+        help="The number of tasks sent to a worker at once. By default, tasks are sent one by one.",
+    )
+
+    parser.add_argument(
+        "--parse_workers",
+        type=int,
+        default=PARSE_WORKERS,
+        help="The number of processes used to parse the AIS files (step 3). Large files are split into byte ranges "
+        "parsed in parallel. 1 parses the files one by one, by default all the cores are used. Takes precedence "
+        "over --executor and --workers for this step.",
+    )
+
+    parser.add_argument(
+        "--shipfinder_files",
+        type=str,
+        nargs="+",
+        default=SHIPFINDER_FILES,
+        help="Files of shipfinder records (e.g. oceanship_fg_train_enhanced.txt) to import into the MMSI registry "
+        "before running the steps. The registry fills the type of the vessels that did not broadcast it.",
+    )
+
+    parser.add_argument(
+        "--clean_mode",
+        type=str,
+        choices=["single_pass", "per_deployment"],
+        default=CLEAN_MODE,
+        help="'single_pass' reads each parsed AIS file once for all the deployments and writes one directory of "
+        "cleaned files per deployment. 'per_deployment' cleans the files again for every deployment (step 4).",
+    )
+
     parser.add_argument(
         "--max_inclusion_radius",
         "-m",
@@ -106,6 +202,56 @@ def create_parser():
         help="The proportion reserved from metadata to the test split"
     )
 
+    parser.add_argument(
+        "--combine_memory_budget_mb",
+        type=int,
+        default=COMBINE_MEMORY_BUDGET_MB,
+        help="The memory the combine step (5) may use for each deployment, in MB.",
+    )
+
+    parser.add_argument(
+        "--export_interval_files",
+        action="store_true",
+        default=EXPORT_INTERVAL_FILES,
+        help="Also write the AIS data of every scenario interval to its own '<begin>_<end>_interval_data.feather' "
+        "file in '06b_interval_ais_data', next to the interval stores, for the tools that read those files.",
+    )
+
+    parser.add_argument(
+        "--feather_compression",
+        type=str,
+        nargs="+",
+        metavar="STEP=COMPRESSION",
+        default=None,
+        help=f"The compression ({', '.join(FEATHER_COMPRESSIONS)}) of the feather files written by a step, "
+        "e.g. 'identify_scenarios=uncompressed clean_ctd=zstd'. Uncompressed files are memory-mapped without "
+        "copies when read, zstd files are the smallest. Overrides FEATHER_COMPRESSION of config.py.",
+    )
+
+    parser.add_argument(
+        "--concurrent_steps",
+        type=int,
+        default=PIPELINE_CONCURRENCY,
+        help="The number of independent steps (e.g. the AIS steps 3-6 and the CTD steps 8-9) run at the same time.",
+    )
+
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Remove the outputs of the selected steps and run them again, even if their inputs and parameters "
+        "did not change since their last run (see '<work_dir>/pipeline_manifest.json').",
+    )
+
+    parser.add_argument(
+        "--compare_runs",
+        type=str,
+        nargs=2,
+        metavar=("RUN_LOG_A", "RUN_LOG_B"),
+        default=None,
+        help="Compare the metrics of two run logs (written to '<work_dir>/run_logs') stage by stage, "
+        "instead of running the pipeline.",
+    )
+
     return parser
 
 
@@ -114,6 +260,10 @@ def _main():
     parser = create_parser()
     args = parser.parse_args()
 
+    if args.compare_runs:
+        compare_runs(*args.compare_runs)
+        return
+
     print(f"{bcolors.HEADER}Dataset Preparation Script{bcolors.ENDC}\n")
 
     working_directory = args.work_dir
@@ -132,8 +282,26 @@ def _main():
     making_wav_classification = create_dir(working_directory, "10_making_wav_classification")
     makinggoodmakeer_wav_classification = create_dir(working_directory, "11_making_wav_classification")
 
+    configure_executor(args.executor, args.workers, args.chunksize)
+    configure_feather_compression(
+        {**FEATHER_COMPRESSION, **dict(entry.split("=", 1) for entry in args.feather_compression or [])}
+    )
+
+    # Structured metrics of every executed step, one JSON line per step.
+    run_log = RunLog(create_dir(working_directory, "run_logs"))
+    print(f"Writing the metrics of this run to {bcolors.BOLD}{run_log.log_file}{bcolors.ENDC}")
+
+    # Static data of every vessel seen, filled while parsing (step 3).
+    mmsi_registry_file = os.path.join(working_directory, MMSI_REGISTRY_FILE)
+    if args.shipfinder_files:
+        print(f"Importing {bcolors.BOLD}{len(args.shipfinder_files)}{bcolors.ENDC} shipfinder files into the MMSI registry...")
+        update_mmsi_registry(mmsi_registry_file, shipfinder_files=args.shipfinder_files)
+
     token = args.onc_token
 
+    # Local cache of the ONC file listings, shared by every download step.
+    catalog_file = os.path.join(working_directory, "onc_catalog.sqlite")
+
     # The maximum distance (metres) that a vessel can be from the hydrophone before we start caring about it.
     max_inclusion_radius = args.max_inclusion_radius
     inclusion_radius = args.inclusion_radius
@@ -148,50 +316,69 @@ def _main():
 
     root_path = os.path.join(classified_wav_directory, f"inclusion_{inclusion_radius}_exclusion_{get_exclusion_radius(inclusion_radius)}")
 
-    if 0 in args.steps:
+    def query_deployments(stage):
         print(f"\n{bcolors.HEADER}Querying Ocean Natworks Canada for Deployments{bcolors.ENDC}")
         query_onc_deployments(
             deployment_directory,
             token,
         )
 
-    if 1 in args.steps:
+    def download_ais_files(stage):
         print(f"\n{bcolors.HEADER}Downloading AIS Files{bcolors.ENDC}")
         download_files(
             raw_ais_directory,
             deployment_directory,
             token,
             file_type="AIS",
+            engine=args.download_engine,
+            max_requests_per_host=args.max_requests_per_host,
+            catalog_file=catalog_file,
         )
 
-    if 2 in args.steps:
+    scenario_mode = args.wav_download_mode == "scenario"
+
+    def download_wav_files(stage):
         print(f"\n{bcolors.HEADER}Downloading Raw WAV Files{bcolors.ENDC}")
         download_files(
             raw_wav_directory,
             deployment_directory,
             token,
             file_type="WAV",
+            engine=args.download_engine,
+            max_requests_per_host=args.max_requests_per_host,
+            catalog_file=catalog_file,
+            scenario_intervals_directory=scenario_intervals_directory if scenario_mode else None,
+            interval_ais_data_directory=interval_ais_data_directory if scenario_mode else None,
+            vessel_classes=args.vessel_classes if scenario_mode else None,
         )
 
-    if 3 in args.steps:
-        print(f"\n{bcolors.HEADER}Parsing AIS files to JSON files{bcolors.ENDC}")
-        parse_ais_to_json(
+    def parse_ais(stage):
+        print(f"\n{bcolors.HEADER}Parsing AIS files to Parquet files{bcolors.ENDC}")
+        file_counters = parse_ais_to_json(
             raw_ais_directory,
             parsed_ais_directory,
-            single_threaded_processing=True,
+            single_threaded_processing=args.parse_workers == 1,
+            number_of_workers=args.parse_workers,
+            deployment_directory=deployment_directory,
+            inclusion_radius=max_inclusion_radius,
+            mmsi_registry_file=mmsi_registry_file,
         )
+        stage.add_file_counters(file_counters)
 
-    if 4 in args.steps:
+    def clean_ais(stage):
         print(f"\n{bcolors.HEADER}Cleaning AIS data{bcolors.ENDC}")
-        clean_ais_data(
+        file_counters = clean_ais_data(
             deployment_directory,
             parsed_ais_directory,
             clean_ais_directory,
             _inclusion_radius=max_inclusion_radius,
             use_all_threads=False,
+            single_pass=args.clean_mode == "single_pass",
+            mmsi_registry_file=mmsi_registry_file,
         )
+        stage.add_file_counters(file_counters)
 
-    if 5 in args.steps:
+    def combine_deployment_ais(stage):
         print(f"\n{bcolors.HEADER}Combining Deployment AIS data{bcolors.ENDC}")
         # This will run the shortest hydrophone deployment to speed up development.
         run_shortest = False
@@ -202,9 +389,11 @@ def _main():
             run_shortest,
             max_inclusion_radius,
             use_all_threads=False,
+            mmsi_registry_file=mmsi_registry_file,
+            memory_budget_mb=args.combine_memory_budget_mb,
         )
 
-    if 6 in args.steps:
+    def identify(stage):
         print(f"\n{bcolors.HEADER}Identifying scenarios{bcolors.ENDC}")
         identify_scenarios(
             working_directory,
@@ -212,9 +401,10 @@ def _main():
             scenario_intervals_directory,
             interval_ais_data_directory,
             combined_deployment_directory,
+            export_interval_files=args.export_interval_files,
         )
 
-    if 7 in args.steps:
+    def classify_wav_files(stage):
         print(f"\n{bcolors.HEADER}Classifying the dataset into the chosen range{bcolors.ENDC}")
         group_wav_from_range(
             classified_wav_directory,
@@ -224,16 +414,19 @@ def _main():
             inclusion_radius,
         )
 
-    if 8 in args.steps:
+    def download_ctd_files(stage):
         print(f"\n{bcolors.HEADER}Downloading Conductivity Temperature Depth Files{bcolors.ENDC}")
         download_files(
             raw_ctd_directory,
             deployment_directory,
             token,
             file_type="CTD",
+            engine=args.download_engine,
+            max_requests_per_host=args.max_requests_per_host,
+            catalog_file=catalog_file,
         )
 
-    if 9 in args.steps:
+    def clean_ctd(stage):
         print(f"\n{bcolors.HEADER}Cleaning CTD data{bcolors.ENDC}")
         clean_ctd_data(
             deployment_directory,
@@ -242,16 +435,17 @@ def _main():
             use_all_threads=False,
         )
 
-    if 10 in args.steps:
+    def full_metadata(stage):
         print(f"\n{bcolors.HEADER}Generating the metadata for the full dataset{bcolors.ENDC}")
         generate_full_metadata(
             root_path,
             clean_ctd_directory,
             interval_ais_data_directory,
             inclusion_radius,
+            mmsi_registry_file=mmsi_registry_file,
         )
 
-    if 11 in args.steps:
+    def metadata_for_small_times(stage):
         print(f"\n{bcolors.HEADER}Splitting dataset into small periods of time{bcolors.ENDC}")
         get_metadata_for_small_times(
             root_path,
@@ -259,7 +453,7 @@ def _main():
             seconds,
         )
 
-    if 12 in args.steps:
+    def split(stage):
         print(f"\n{bcolors.HEADER}Splitting dataset into train, test and validation datasets{bcolors.ENDC}")
         split_dataset(
             root_path,
@@ -268,13 +462,14 @@ def _main():
             test_split=metadata_test_split
         )
 
-    if 13 in args.steps:
+    def balanced_metadata(stage):
         print(f"\n{bcolors.HEADER}Generating the balanced metadata version{bcolors.ENDC}")
         generate_balanced_metadata(
             f"{metadata_file}_{seconds}s_train.csv",
             root_path,
         )
-    if 14 in args.steps:
+
+    def making_wav(stage):
         print(f"\n{bcolors.HEADER}making clean the dataset{bcolors.ENDC}")
         wav_all(
             making_wav_classification,
@@ -283,8 +478,9 @@ def _main():
             raw_wav_directory,
             inclusion_radius,
         )
+
     # cutting and preprocessing these raw WAV files.
-    if 15 in args.steps:
+    def making_good_wav(stage):
         wav_all(
             makinggoodmakeer_wav_classification,
             scenario_intervals_directory,
@@ -293,5 +489,101 @@ def _main():
             inclusion_radius,
         )
 
+    # The files written by the metadata steps, all in root_path.
+    metadata_csv = os.path.join(root_path, f"{metadata_file}.csv")
+    small_times_csv = os.path.join(root_path, f"{metadata_file}_{seconds}s.csv")
+    split_csvs = [os.path.join(root_path, f"{metadata_file}_{seconds}s_{split}.csv") for split in ("train", "validation", "test")]
+    balanced_csvs = [os.path.join(root_path, f"{metadata_file}_{seconds}s_train_{kind}.csv") for kind in ("oversampled", "undersampled")]
+
+    # Every step with what it reads, writes and depends on. The AIS branch (3-6) and the CTD branch (8-9) are independent.
+    # The MMSI registry is left out of the inputs of the clean step: new vessel types only reach the files cleaned afterwards.
+    stages = [
+        Stage(0, "query_onc_deployments", query_deployments, outputs=[deployment_directory], source=True),
+        Stage(1, "download_ais_files", download_ais_files, outputs=[raw_ais_directory], depends_on=[0], source=True),
+        Stage(
+            2, "download_wav_files", download_wav_files, outputs=[raw_wav_directory],
+            # In scenario mode the WAV files can only be selected once the scenarios are identified (step 6).
+            depends_on=[0, 6] if scenario_mode else [0], source=True,
+        ),
+        Stage(
+            3, "parse_ais", parse_ais,
+            inputs=[raw_ais_directory, deployment_directory], outputs=[parsed_ais_directory],
+            parameters={"max_inclusion_radius": max_inclusion_radius},
+            depends_on=[0, 1], partition_outputs=lambda file: [get_parsed_file_name(file)],
+        ),
+        Stage(
+            4, "clean_ais", clean_ais,
+            inputs=[parsed_ais_directory, deployment_directory], outputs=[clean_ais_directory],
+            parameters={
+                "max_inclusion_radius": max_inclusion_radius,
+                "clean_mode": args.clean_mode,
+                "compression": feather_settings.COMPRESSION.get("clean_ais"),
+            },
+            depends_on=[0, 3], partition_outputs=lambda file: [get_cleaned_file_name(file)],
+        ),
+        Stage(
+            5, "combine_deployment_ais", combine_deployment_ais,
+            inputs=[clean_ais_directory, deployment_directory], outputs=[combined_deployment_directory],
+            parameters={"max_inclusion_radius": max_inclusion_radius}, depends_on=[4],
+        ),
+        Stage(
+            6, "identify_scenarios", identify,
+            inputs=[combined_deployment_directory, deployment_directory],
+            outputs=[scenario_intervals_directory, interval_ais_data_directory],
+            parameters={
+                "compression": feather_settings.COMPRESSION.get("identify_scenarios"),
+                "export_interval_files": args.export_interval_files,
+            },
+            depends_on=[5],
+        ),
+        Stage(
+            7, "classify_wav_files", classify_wav_files,
+            inputs=[raw_wav_directory, scenario_intervals_directory, interval_ais_data_directory],
+            outputs=[os.path.join(root_path, "background"), os.path.join(root_path, "vessel")],
+            parameters={"inclusion_radius": inclusion_radius}, depends_on=[2, 6],
+        ),
+        Stage(8, "download_ctd_files", download_ctd_files, outputs=[raw_ctd_directory], depends_on=[0], source=True),
+        Stage(
+            9, "clean_ctd", clean_ctd,
+            inputs=[raw_ctd_directory, deployment_directory], outputs=[clean_ctd_directory],
+            parameters={"compression": feather_settings.COMPRESSION.get("clean_ctd")}, depends_on=[8], partition_outputs=lambda file: [file.replace(".txt", "_cleaned.feather")],
+        ),
+        Stage(
+            10, "generate_full_metadata", full_metadata,
+            inputs=[
+                clean_ctd_directory,
+                interval_ais_data_directory,
+                os.path.join(root_path, "background", "intervals.csv"),
+                os.path.join(root_path, "vessel", "intervals.csv"),
+            ],
+            outputs=[os.path.join(root_path, "metadata.csv")],
+            parameters={"inclusion_radius": inclusion_radius}, depends_on=[6, 7, 9],
+        ),
+        Stage(
+            11, "metadata_for_small_times", metadata_for_small_times,
+            inputs=[metadata_csv], outputs=[small_times_csv], parameters={"seconds": seconds}, depends_on=[10],
+        ),
+        Stage(
+            12, "split_dataset", split,
+            inputs=[small_times_csv], outputs=split_csvs,
+            parameters={"validation_split": metadata_val_split, "test_split": metadata_test_split}, depends_on=[11],
+        ),
+        Stage(13, "generate_balanced_metadata", balanced_metadata, inputs=[split_csvs[0]], outputs=balanced_csvs, depends_on=[12]),
+        Stage(
+            14, "making_wav_classification", making_wav,
+            inputs=[raw_wav_directory, scenario_intervals_directory], outputs=[making_wav_classification],
+            parameters={"inclusion_radius": inclusion_radius}, depends_on=[2, 6],
+        ),
+        Stage(
+            15, "making_good_wav_classification", making_good_wav,
+            inputs=[raw_wav_directory, scenario_intervals_directory], outputs=[makinggoodmakeer_wav_classification],
+            parameters={"inclusion_radius": inclusion_radius}, depends_on=[2, 6],
+        ),
+    ]
+
+    manifest = PipelineManifest(os.path.join(working_directory, PIPELINE_MANIFEST_FILE))
+    run_pipeline(stages, args.steps, manifest, run_log, concurrency=args.concurrent_steps, force=args.force)
+
+
 if __name__ == "__main__":
     _main()
@@ -1,15 +1,14 @@
-import json
 import csv
 import os
 import glob
 from tqdm import tqdm
+from utils import read_parsed_ais_messages
 def making_one_file(filename):
     '''
     @Date : 2023-07-29
     @Time : 19:41:59
     '''
-    with open(filename,'r') as f:
-        data = json.load(f)
+    data = read_parsed_ais_messages(filename)
     temp_dir = list()
     for i in data:
         if "type_and_cargo" in i.keys():
@@ -53,7 +52,7 @@ def save_makeed_file(filename, id_time_list):
     # final_path = './underwater/03ff/'
     final_path = "./underwater/03f84/"
     
-    fullpath = os.path.join(final_path, os.path.basename(filename)[:-5])
+    fullpath = os.path.join(final_path, os.path.splitext(os.path.basename(filename))[0])
     filename = f'{fullpath}.csv'
     # 打开csv文件
     with open(filename, mode='w', newline='') as csvfile:
@@ -75,8 +74,7 @@ def making_icat(filename):
     @Time : 19:41:59
     '''
     
-    with open(filename,'r') as f:
-        data = json.load(f)
+    data = read_parsed_ais_messages(filename)
     temp_dir = list()
     for i in data:
         if "type_and_cargo" in i.keys():
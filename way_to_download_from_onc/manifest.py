@@ -0,0 +1,109 @@
+import os
+import time
+import sqlite3
+
+
+class download_state:
+    PENDING = "pending"
+    PARTIAL = "partial"
+    COMPLETE = "complete"
+    FAILED = "failed"
+
+
+def get_manifest_path(output_directory):
+    # The manifest lives next to the output directory so it never shows up in a listing of the downloaded files.
+    output_directory = os.path.normpath(output_directory)
+    return os.path.join(
+        os.path.dirname(output_directory),
+        f"{os.path.basename(output_directory)}_manifest.sqlite",
+    )
+
+
+class DownloadManifest:
+    '''
+    Persistent record of the state of every file of a download directory, so
+    a restarted run only needs a lookup here instead of a directory rescan.
+    '''
+
+    def __init__(self, manifest_path):
+        self.is_new = not os.path.exists(manifest_path)
+        self.connection = sqlite3.connect(manifest_path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "filename TEXT PRIMARY KEY, "
+            "state TEXT NOT NULL, "
+            "expected_size INTEGER, "
+            "checksum TEXT, "
+            "bytes_written INTEGER NOT NULL DEFAULT 0, "
+            "updated REAL NOT NULL)"
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def completed_files(self):
+        return {
+            row[0]
+            for row in self.connection.execute(
+                "SELECT filename FROM files WHERE state = ?", (download_state.COMPLETE,)
+            )
+        }
+
+    def get_expected(self, filename):
+        row = self.connection.execute(
+            "SELECT expected_size, checksum FROM files WHERE filename = ?", (filename,)
+        ).fetchone()
+
+        return row if row else (None, None)
+
+    def register(self, file_details):
+        '''
+        Add the (filename, expected_size, checksum) entries that are not yet
+        known, and refresh the expected size and checksum of the others.
+        '''
+
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO files (filename, state, expected_size, checksum, updated) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(filename) DO UPDATE SET "
+                "expected_size = COALESCE(excluded.expected_size, expected_size), "
+                "checksum = COALESCE(excluded.checksum, checksum)",
+                [
+                    (filename, download_state.PENDING, expected_size, checksum, now)
+                    for filename, expected_size, checksum in file_details
+                ],
+            )
+
+    def mark(self, filename, state, bytes_written=0):
+        with self.connection:
+            self.connection.execute(
+                "UPDATE files SET state = ?, bytes_written = ?, updated = ? WHERE filename = ?",
+                (state, bytes_written, time.time(), filename),
+            )
+
+    def adopt_existing_files(self, output_directory):
+        '''
+        One-off migration for directories downloaded before the manifest
+        existed. Files matching their expected size are marked complete, the
+        others are moved to their '.part' name so they are resumed.
+        '''
+
+        rows = self.connection.execute("SELECT filename, expected_size FROM files").fetchall()
+        existing_files = set(os.listdir(output_directory))
+
+        for filename, expected_size in rows:
+            if filename not in existing_files:
+                continue
+
+            file_path = os.path.join(output_directory, filename)
+            size = os.path.getsize(file_path)
+
+            if expected_size is None or size == expected_size:
+                self.mark(filename, download_state.COMPLETE, size)
+            else:
+                os.replace(file_path, file_path + ".part")
+                self.mark(filename, download_state.PARTIAL, size)
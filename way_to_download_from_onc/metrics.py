@@ -0,0 +1,252 @@
+import os
+import sys
+import time
+import resource
+
+import ujson
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from utils import bcolors
+
+
+# Files whose number of rows can be read without loading them.
+TABLE_EXTENSIONS = (".parquet", ".feather", ".csv")
+
+
+def _snapshot_directories(_directories):
+    # (size, modification time) of every file under the directories.
+    snapshot = {}
+    for directory in _directories:
+        for root, _, files in os.walk(directory):
+            for file in files:
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                snapshot[path] = (stat.st_size, stat.st_mtime_ns)
+
+    return snapshot
+
+
+def count_table_rows(_file):
+    '''
+    Number of rows of a Parquet, Feather or CSV file, read from the file
+    metadata when there is one. Returns None for other files.
+    '''
+
+    try:
+        if _file.endswith(".parquet"):
+            return pq.read_metadata(_file).num_rows
+
+        if _file.endswith(".feather"):
+            with pa.memory_map(_file) as source:
+                reader = pa.ipc.open_file(source)
+                return sum(reader.get_batch(index).num_rows for index in range(reader.num_record_batches))
+
+        if _file.endswith(".csv"):
+            with open(_file, "rb") as input_file:
+                return max(sum(1 for _ in input_file) - 1, 0)
+
+    except (OSError, pa.ArrowInvalid):
+        pass
+
+    return None
+
+
+def _get_cpu_seconds():
+    # Stages run most of their work in child processes, which are only accounted for once they are joined.
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return (
+        self_usage.ru_utime + self_usage.ru_stime + children_usage.ru_utime + children_usage.ru_stime
+    )
+
+
+def _get_peak_rss_bytes(_who):
+    # The high-water mark over the lifetime of the process (or of its largest child), not of a stage.
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    peak_rss = resource.getrusage(_who).ru_maxrss
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+class StageMetrics:
+    '''
+    Counters of a running stage. Stages that know their own counters (e.g.
+    the parse counters) add them per file, the rest is measured by RunLog.
+    '''
+
+    def __init__(self, step, name):
+        self.step = step
+        self.name = name
+        self.rows_in = None
+        self.rows_out = None
+        self.files = {}
+
+    def add_file_counters(self, file_counters):
+        for file, counters in (file_counters or {}).items():
+            if counters:
+                self.files.setdefault(os.path.basename(file), {}).update(counters)
+
+
+class RunLog:
+    '''
+    Structured log of a pipeline run: one JSON line per executed stage, in
+    '<log directory>/<run id>.jsonl'.
+    '''
+
+    def __init__(self, log_directory, run_id=None):
+        self.run_id = run_id or datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        self.log_file = os.path.join(log_directory, f"{self.run_id}.jsonl")
+
+    def write(self, record):
+        with open(self.log_file, "a") as output_file:
+            output_file.write(ujson.dumps(record) + "\n")
+
+    @contextmanager
+    def stage(self, step, name, inputs=(), outputs=()):
+        stage_metrics = StageMetrics(step, name)
+
+        inputs_before = _snapshot_directories(inputs)
+        outputs_before = _snapshot_directories(outputs)
+        start_time = time.time()
+        start_cpu = _get_cpu_seconds()
+        start_peak_rss = _get_peak_rss_bytes(resource.RUSAGE_SELF)
+        start_peak_children_rss = _get_peak_rss_bytes(resource.RUSAGE_CHILDREN)
+        status = "ok"
+
+        try:
+            yield stage_metrics
+        except BaseException:
+            status = "failed"
+            raise
+        finally:
+            wall_seconds = time.time() - start_time
+            cpu_seconds = _get_cpu_seconds() - start_cpu
+            peak_rss = _get_peak_rss_bytes(resource.RUSAGE_SELF)
+            peak_children_rss = _get_peak_rss_bytes(resource.RUSAGE_CHILDREN)
+
+            # Only the files created or modified by the stage are counted as written.
+            outputs_after = _snapshot_directories(outputs)
+            written_files = [
+                path for path, details in outputs_after.items() if outputs_before.get(path) != details
+            ]
+
+            for path in written_files:
+                file_metrics = stage_metrics.files.setdefault(os.path.basename(path), {})
+                file_metrics["bytes_written"] = outputs_after[path][0]
+                if path.endswith(TABLE_EXTENSIONS):
+                    file_metrics["rows_out"] = count_table_rows(path)
+
+            if stage_metrics.rows_out is None:
+                rows_out = [stage_metrics.files[os.path.basename(path)].get("rows_out") for path in written_files]
+                stage_metrics.rows_out = sum(rows for rows in rows_out if rows is not None)
+
+            if stage_metrics.rows_in is None:
+                rows_in = [
+                    counters.get("rows_in", counters.get("lines_read"))
+                    for counters in stage_metrics.files.values()
+                ]
+                stage_metrics.rows_in = sum(rows for rows in rows_in if rows is not None)
+
+            self.write(
+                {
+                    "run_id": self.run_id,
+                    "step": step,
+                    "stage": name,
+                    "status": status,
+                    "started": datetime.fromtimestamp(start_time, timezone.utc).isoformat(),
+                    "wall_seconds": wall_seconds,
+                    "cpu_seconds": cpu_seconds,
+                    "rows_in": stage_metrics.rows_in,
+                    "rows_out": stage_metrics.rows_out,
+                    # The size of the input files, whatever the stage read of them (e.g. only some columns).
+                    "input_bytes": sum(size for size, _ in inputs_before.values()),
+                    "bytes_written": sum(outputs_after[path][0] for path in written_files),
+                    "files_written": len(written_files),
+                    # The peaks of the whole process so far, and by how much the stage raised them. A stage that
+                    # stays below the peak of an earlier one raises them by 0. Concurrent stages share the process.
+                    "process_peak_rss_bytes": peak_rss,
+                    "process_peak_children_rss_bytes": peak_children_rss,
+                    "peak_rss_increase_bytes": peak_rss - start_peak_rss,
+                    "peak_children_rss_increase_bytes": peak_children_rss - start_peak_children_rss,
+                    "files": stage_metrics.files,
+                }
+            )
+
+
+def read_run_log(log_file):
+    with open(log_file, "r") as input_file:
+        return [ujson.loads(line) for line in input_file if line.strip()]
+
+
+def _get_throughput(_record):
+    # Rows per second, falling back to bytes per second for the stages without rows.
+    if _record["wall_seconds"] <= 0:
+        return None, ""
+    if _record["rows_out"]:
+        return _record["rows_out"] / _record["wall_seconds"], "rows/s"
+    return _record["bytes_written"] / _record["wall_seconds"], "B/s"
+
+
+def compare_runs(log_file_a, log_file_b, regression_threshold=0.1):
+    '''
+    Print the stages of two run logs side by side, flagging the stages whose
+    throughput dropped by more than regression_threshold in the second run.
+    '''
+
+    # The last record of a stage wins when a run executed it more than once.
+    stages_a = {(record["step"], record["stage"]): record for record in read_run_log(log_file_a)}
+    stages_b = {(record["step"], record["stage"]): record for record in read_run_log(log_file_b)}
+
+    print(f"Comparing {bcolors.BOLD}{log_file_a}{bcolors.ENDC} to {bcolors.BOLD}{log_file_b}{bcolors.ENDC}")
+    print(
+        f"  {'step':>4} {'stage':<28} {'wall A':>10} {'wall B':>10} {'cpu A':>10} {'cpu B':>10} "
+        f"{'rows A':>12} {'rows B':>12} {'throughput':>12}"
+    )
+
+    regressions = []
+    for key in sorted(set(stages_a) | set(stages_b)):
+        record_a = stages_a.get(key)
+        record_b = stages_b.get(key)
+        if not record_a or not record_b:
+            missing = "A" if not record_a else "B"
+            print(f"  {key[0]:>4} {key[1]:<28} {bcolors.WARNING}not in run {missing}{bcolors.ENDC}")
+            continue
+
+        throughput_a, unit = _get_throughput(record_a)
+        throughput_b, _ = _get_throughput(record_b)
+        change = ""
+        color = ""
+        if throughput_a and throughput_b is not None:
+            ratio = throughput_b / throughput_a - 1.0
+            change = f"{ratio:+.1%}"
+            if ratio < -regression_threshold:
+                color = bcolors.FAIL
+                regressions.append(key)
+            elif ratio > regression_threshold:
+                color = bcolors.OKGREEN
+
+        print(
+            f"  {key[0]:>4} {key[1]:<28} {record_a['wall_seconds']:>10.3f} {record_b['wall_seconds']:>10.3f} "
+            f"{record_a['cpu_seconds']:>10.3f} {record_b['cpu_seconds']:>10.3f} "
+            f"{record_a['rows_out']:>12} {record_b['rows_out']:>12} {color}{change:>12}{bcolors.ENDC} {unit}"
+        )
+
+    if regressions:
+        print(f"{bcolors.FAIL}{len(regressions)} stages are more than {regression_threshold:.0%} slower{bcolors.ENDC}")
+
+    return regressions
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print(f"Usage: {sys.argv[0]} <run log A> <run log B>")
+        sys.exit(1)
+
+    compare_runs(sys.argv[1], sys.argv[2])
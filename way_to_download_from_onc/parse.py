@@ -1,16 +1,35 @@
 import os
 import re
 import time
-from tqdm import tqdm
-import ujson
 
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import lpais.ais as ais
 
 from functools import partial
-import multiprocessing
+from itertools import islice
 
-from utils import bcolors, ais_params
+from utils import (
+    bcolors,
+    ais_params,
+    list_downloaded_files,
+    is_parsed_ais_file,
+    zulu_strings_to_nanoseconds,
+    get_num_of_threads,
+    executor_settings,
+    run_tasks,
+)
+from decode import MESSAGE_IDS_TO_ACCEPT, decode_ais_batch
+from prefilter import load_deployment_prefilter
+from registry import load_mmsi_registry, update_mmsi_registry
+
+
+# Raw lines look like 'YYYYMMDDThhmmss.sssZ !AIVDM,...'.
+CORRECT_FORMATTING_REGEX = re.compile("^\\w{15}\\.\\w{4}\\ !")
+
+# The fragment number of a sentence, as in 'YYYYMMDDThhmmss.sssZ !AIVDM,2,2,...'.
+MULTI_SENTENCE_REGEX = re.compile(rb"^\S+ ![A-Z]{5},\d+,(\d+),")
 
 
 def _get_parameters_from_message(_message, _parameters):
@@ -64,9 +83,10 @@ def _get_parameters_from_message(_message, _parameters):
                 value = _message[ais_params.FIX_TYPE]
 
             elif parameter == ais_params.IMO:
+                # libais names it 'imo_num'.
                 value = (
-                    _message[ais_params.IMO]
-                    if _message[ais_params.IMO] != 0
+                    _message["imo_num"]
+                    if _message["imo_num"] != 0
                     else np.nan
                 )
 
@@ -80,31 +100,245 @@ def _get_parameters_from_message(_message, _parameters):
     return response
 
 
-def dump_data_to_json_file(_file, _data):
+# Fixed schema of the parsed AIS files.
+PARSED_AIS_SCHEMA = pa.schema(
+    [
+        ("ais_timestamp", pa.timestamp("ns", tz="UTC")),
+        ("mmsi", pa.int32()),
+        ("id", pa.uint8()),
+        (ais_params.X, pa.float64()),
+        (ais_params.Y, pa.float64()),
+        (ais_params.SOG, pa.float32()),
+        (ais_params.COG, pa.float32()),
+        (ais_params.TRUE_HEADING, pa.float32()),
+        (ais_params.TYPE_AND_CARGO, pa.float32()),
+        (ais_params.IMO, pa.int32()),
+    ]
+)
 
-    # print("Dumping valid messages to JSON file now...")
-    start_time = time.time()
-    output_file_name = _file
+# Number of raw lines decoded together and written out as one row group.
+PARSED_AIS_BATCH_SIZE = 65536
 
-    with open(output_file_name, "w") as output_file:
-        ujson.dump(_data, output_file)
+# Smallest byte range that a raw file is split into when it is parsed in parallel.
+PARSE_SHARD_MIN_SIZE = 8 * 1024 * 1024
 
-    # print("  Dumped valid messages to JSON file in {0:.3f} seconds".format(time.time() - start_time))
 
+def get_parsed_file_name(_raw_file):
+    return re.sub(r"\.txt$", "_parsed.parquet", _raw_file)
 
-def parse_all_valid_messages(
-    _raw_file_path, _raw_data_directory, _parsed_data_directory
-):
 
-    # Check if the file already exist.
-    if os.path.exists(
-        os.path.join(
-            _parsed_data_directory, _raw_file_path.strip(".txt") + "_parsed.json"
-        )
-    ):
-        # Pull the data in from all of the JSON files.
-        print(f"  The JSON file for this data file already exists, passing through")
-        return
+def _write_batch_to_parquet(_writer, _columns):
+    # The timestamps are int64 nanoseconds by now, see _parse_byte_range.
+    arrays = [
+        pa.array(_columns[field.name], type=field.type, from_pandas=True)
+        for field in PARSED_AIS_SCHEMA
+    ]
+
+    _writer.write_table(pa.Table.from_arrays(arrays, schema=PARSED_AIS_SCHEMA))
+
+
+def _apply_prefilter(_prefilter, _columns, _counters):
+    # Messages carrying the static data of a vessel are always kept, for the MMSI registry and the clean step.
+    keep = ~np.isnan(_columns[ais_params.TYPE_AND_CARGO].astype(np.float64)) | ~np.isnan(
+        _columns[ais_params.IMO].astype(np.float64)
+    ) | _prefilter.positions_to_keep(
+        _columns["ais_timestamp"],
+        _columns[ais_params.X].astype(np.float64),
+        _columns[ais_params.Y].astype(np.float64),
+    )
+
+    _counters["messages_outside_deployments"] += int((~keep).sum())
+
+    return {name: column[keep] for name, column in _columns.items()}
+
+
+def _parse_line_with_lpais(_line, _decoder, _counters):
+
+    # Declare formating message.
+    if not CORRECT_FORMATTING_REGEX.match(_line):
+        _counters["messages_rejected"] += 1
+        return None
+
+    _counters["lines_read"] += 1
+
+    # On the off chance that there is an errant space in the message, split by the zulu indicator and space.
+    line_contents = _line.split("Z ")
+
+    # Timestamp appears as YYYYMMDDT000000.000Z.
+    ais_timestamp = line_contents[0] + "Z"
+    data = line_contents[1].strip("\n")
+
+    # Start decoding the message.
+    message = None
+
+    try:
+        message = _decoder(data)
+
+    except:
+        _counters["messages_rejected"] += 1
+        return None
+
+    # Corrupted, non-compliant, and multi-line messages return None, so ignore it.
+    if not message:
+        return None
+
+    _counters["messages_decoded"] += 1
+
+    # Does the message have a correct, 9-digit MMSI?
+    if len(str(message["mmsi"])) != 9:
+        _counters["messages_rejected"] += 1
+        return None
+
+    # Is the message ID one that we care about?
+    if message["id"] not in MESSAGE_IDS_TO_ACCEPT:
+        _counters["messages_rejected"] += 1
+        return None
+
+    # Begin processing the messages by ID.
+    parameters = ()
+
+    # Message ID's 1, 2, and 3 all seem to be the same information for Class A vessels.
+    # Message ID 18 is for Class B vessels, but we want the same information from that message ID.
+    if message["id"] in (1, 2, 3, 18):
+        parameters = ("x", "y", "sog", "cog", "true_heading")
+
+    # Message ID 5 is for Class A vessel information.
+    # Message ID 24 is for Class B vessel information and comes in 2 parts.
+    # We only care about the information in part 2.
+    elif message["id"] == 5:
+        parameters = ("type_and_cargo", "imo")
+
+    elif message["id"] == 24 and message["part_num"] == 1:
+        parameters = ("type_and_cargo",)
+
+    # Message ID 19 is essentially an ID 1, 2, 3, or 18 message with additional fields from ID 5.
+    elif message["id"] == 19:
+        parameters = ("x", "y", "sog", "cog", "true_heading", "type_and_cargo")
+
+    responses = _get_parameters_from_message(message, parameters)
+
+    if not responses:
+        _counters["messages_rejected"] += 1
+        return None
+
+    _counters["messages_accepted"] += 1
+    responses["ais_timestamp"] = ais_timestamp
+    responses["mmsi"] = message["mmsi"]
+    responses["id"] = message["id"]
+
+    return responses
+
+
+def parse_lines(_lines, _decoder, _counters, batch_decoding=True):
+    '''
+    Parse a batch of raw AIS lines into columns of accepted messages, in the
+    order of the lines. With batch_decoding, the single sentence messages
+    are decoded together by decode.decode_ais_batch and only the remaining
+    lines (multi-sentence messages, malformed lines...) go through lpais,
+    one by one and in order, so its multi-sentence state is unchanged.
+    '''
+
+    if batch_decoding:
+        decoded, fallback_indexes, lines_rejected = decode_ais_batch(_lines)
+        _counters["lines_read"] += len(_lines) - len(fallback_indexes)
+        _counters["messages_decoded"] += decoded["mmsi"].size + lines_rejected
+        _counters["messages_accepted"] += decoded["mmsi"].size
+        _counters["messages_rejected"] += lines_rejected
+        fallback_lines = [_lines[index] for index in fallback_indexes]
+    else:
+        decoded = {name: np.array([]) for name in ("line_index",) + tuple(PARSED_AIS_SCHEMA.names)}
+        fallback_indexes = list(range(len(_lines)))
+        fallback_lines = _lines
+
+    fallback_columns = {name: [] for name in decoded}
+    for index, line in zip(fallback_indexes, fallback_lines):
+        responses = _parse_line_with_lpais(line, _decoder, _counters)
+        if responses:
+            responses["line_index"] = index
+            for name, column in fallback_columns.items():
+                column.append(responses.get(name, np.nan))
+
+    fallback_columns = {name: np.array(column) for name, column in fallback_columns.items()}
+    if not fallback_columns["line_index"].size:
+        return decoded
+    if not decoded["line_index"].size:
+        return fallback_columns
+
+    # Put the rows of both paths back in the order of their lines.
+    order = np.argsort(
+        np.concatenate((decoded["line_index"], fallback_columns["line_index"])), kind="stable"
+    )
+
+    return {
+        name: np.concatenate((decoded[name], fallback_columns[name]))[order]
+        for name in decoded
+    }
+
+
+def _new_counters():
+    return {
+        "lines_read": 0,
+        "messages_decoded": 0,
+        "messages_accepted": 0,
+        "messages_rejected": 0,
+        "messages_outside_deployments": 0,
+    }
+
+
+def _read_lines_in_range(_file_path, _start, _end):
+    # Lines are read as bytes so that the position in the file is known exactly.
+    with open(_file_path, "rb") as input_file:
+        input_file.seek(_start)
+        position = _start
+        for line in input_file:
+            if position >= _end:
+                break
+            position += len(line)
+            yield line.decode("utf-8", errors="replace").rstrip("\r\n") + "\n"
+
+
+def _is_continuation_line(_line):
+    # The following sentences of a multi-sentence message have to stay in the shard of the first one.
+    match = MULTI_SENTENCE_REGEX.match(_line)
+    return bool(match) and match.group(1) != b"1"
+
+
+def get_line_aligned_shards(_file_path, _number_of_shards):
+    '''
+    Split a raw AIS file into at most _number_of_shards (start, end) byte
+    ranges. Every range begins at the start of a line and never begins on a
+    continuation sentence of a multi-sentence message.
+    '''
+
+    file_size = os.path.getsize(_file_path)
+    boundaries = [0]
+
+    with open(_file_path, "rb") as input_file:
+        for shard in range(1, _number_of_shards):
+            target = file_size * shard // _number_of_shards
+            if target <= boundaries[-1]:
+                continue
+
+            # Move to the start of the first line beginning at or after the target.
+            input_file.seek(target - 1)
+            input_file.readline()
+            position = input_file.tell()
+
+            while True:
+                line = input_file.readline()
+                if not line or not _is_continuation_line(line):
+                    break
+                position += len(line)
+
+            if boundaries[-1] < position < file_size:
+                boundaries.append(position)
+
+    boundaries.append(file_size)
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def _parse_byte_range(_file_path, _start, _end, _output_file, batch_decoding=True, prefilter=None):
 
     # Checksums appear to be quite useless.
     # Read comments here: https://math.stackexchange.com/questions/2841295/how-many-possible-invalid-ais-message-body-combinations-are-there-for-a-specific
@@ -115,164 +349,239 @@ def parse_all_valid_messages(
         handle_err=None,
     )
 
-    lines_read = 0
-    messages_decoded = 0
-    messages_accepted = 0
-    messages_rejected = 0
+    counters = _new_counters()
 
-    message_ids_in_file = []
-    valid_messages = []
+    # Write to a temporary name so an interrupted parse is never mistaken for a finished one.
+    partial_file = _output_file + ".part"
+    writer = pq.ParquetWriter(partial_file, PARSED_AIS_SCHEMA)
 
-    # Read input ais files.
-    input_file = open(os.path.join(_raw_data_directory, _raw_file_path), "r")
-    file_contents = input_file.readlines()
-    input_file.close()
+    # Read input ais files, PARSED_AIS_BATCH_SIZE lines at a time.
+    rows_written = 0
+    lines_in_range = _read_lines_in_range(_file_path, _start, _end)
+    while True:
+        lines = list(islice(lines_in_range, PARSED_AIS_BATCH_SIZE))
+        if not lines:
+            break
 
-    # Declare formating message.
-    correct_formatting_regex = re.compile("^\w{15}\.\w{4}\ !")
+        columns = parse_lines(lines, decoder, counters, batch_decoding)
+        columns["ais_timestamp"] = zulu_strings_to_nanoseconds(columns["ais_timestamp"])
+        if prefilter is not None:
+            columns = _apply_prefilter(prefilter, columns, counters)
 
-    for line in file_contents:
-        if not correct_formatting_regex.match(line):
-            messages_rejected += 1
-            continue
+        if columns["mmsi"].size:
+            _write_batch_to_parquet(writer, columns)
+            rows_written += columns["mmsi"].size
 
-        lines_read += 1
+    if not rows_written:
+        _write_batch_to_parquet(writer, {name: [] for name in PARSED_AIS_SCHEMA.names})
 
-        # On the off chance that there is an errant space in the message, split by the zulu indicator and space.
-        line_contents = line.split("Z ")
+    writer.close()
+    os.replace(partial_file, _output_file)
 
-        # Timestamp appears as YYYYMMDDT000000.000Z.
-        # Translate that into a more standard ISO 8601 representation as that is what the ONC API requires.
-        # 'YYYY-MM-DDThh:mm:ss.sssZ'
-        ais_timestamp = line_contents[0] + "Z"
-        data = line_contents[1].strip("\n")
+    return counters
 
-        # Start decoding the message.
-        message = None
 
-        try:
-            message = decoder(data)
+def parse_all_valid_messages(
+    _raw_file_path, _raw_data_directory, _parsed_data_directory, batch_decoding=True, prefilter=None
+):
 
-        except:
-            messages_rejected += 1
-            continue
+    parsed_file = os.path.join(_parsed_data_directory, get_parsed_file_name(_raw_file_path))
 
-        # Corrupted, non-compliant, and multi-line messages return None, so ignore it.
-        if message:
-            messages_decoded += 1
+    # Check if the file already exist.
+    if os.path.exists(parsed_file):
+        print(f"  The parsed file for this data file already exists, passing through")
+        return
 
-            # Does the message have a correct, 9-digit MMSI?
-            if len(str(message["mmsi"])) != 9:
-                messages_rejected += 1
-                continue
+    raw_file = os.path.join(_raw_data_directory, _raw_file_path)
 
-            # Is the message ID one that we care about?
+    return _parse_byte_range(raw_file, 0, os.path.getsize(raw_file), parsed_file, batch_decoding, prefilter)
 
-            # Taken from https://www.navcen.uscg.gov/?pageName=AISMessages
-            # 1 = Position report (Class A)
-            # 2 = Position report (Class A)
-            # 3 = Position report (Class A)
-            # 5 = Static and voyage related data
-            # 18 = Standard Class B equipment position report
-            # 19 = Extended Class B equipment position report
-            # 24 = Static data report
-            message_ids_to_accept = (1, 2, 3, 5, 18, 19, 24)
 
-            if message["id"] not in message_ids_to_accept:
-                messages_rejected += 1
-                continue
+def _get_shard_file_name(_parsed_file, _shard_index):
+    # Not a '_parsed.parquet' name, so an unmerged shard is never read by the clean step.
+    return f"{_parsed_file}.shard{_shard_index:03d}"
+
+
+def parse_file(_raw_file_path, _raw_data_directory, _parsed_data_directory, batch_decoding=True, prefilter=None):
+    return _raw_file_path, parse_all_valid_messages(
+        _raw_file_path, _raw_data_directory, _parsed_data_directory, batch_decoding, prefilter
+    )
+
+
+def parse_shard(_shard, batch_decoding=True, prefilter=None):
+    raw_file, start, end, shard_file = _shard
+    return raw_file, _parse_byte_range(raw_file, start, end, shard_file, batch_decoding, prefilter)
+
+
+def merge_parsed_shards(_shard_files, _parsed_file):
+    '''
+    Merge the parsed shards of a raw file into its parsed file. The shards
+    are contiguous line ranges, so they are copied in shard order, one row
+    group at a time: the messages keep the order of their lines, as when
+    the file is parsed in one piece, and only a row group is in memory.
+    '''
+
+    partial_file = _parsed_file + ".part"
+    writer = pq.ParquetWriter(partial_file, PARSED_AIS_SCHEMA)
+    for shard_file in _shard_files:
+        shard = pq.ParquetFile(shard_file)
+        for row_group in range(shard.num_row_groups):
+            writer.write_table(shard.read_row_group(row_group))
+    writer.close()
+    os.replace(partial_file, _parsed_file)
+
+    for shard_file in _shard_files:
+        os.remove(shard_file)
+
+
+def merge_parsed_shards_task(_parsed_file_and_shard_files):
+    parsed_file, shard_files = _parsed_file_and_shard_files
+    merge_parsed_shards(shard_files, parsed_file)
+
 
-            # Purely for tracking what message ID's were in the original file.
-            if message["id"] not in message_ids_in_file:
-                message_ids_in_file.append(message["id"])
-
-            # Begin processing the messages by ID.
-            parameters = ()
-
-            # Message ID's 1, 2, and 3 all seem to be the same information for Class A vessels.
-            # Message ID 18 is for Class B vessels, but we want the same information from that message ID.
-            if message["id"] in (1, 2, 3, 18):
-                parameters = ("x", "y", "sog", "cog", "true_heading")
-
-            # Message ID 5 is for Class A vessel information.
-            # Message ID 24 is for Class B vessel information and comes in 2 parts.
-            # We only care about the information in part 2.
-            elif (message["id"] == 5) or (
-                message["id"] == 24 and message["part_num"] == 1
-            ):
-                parameters = ("type_and_cargo",)
-
-            # Message ID 19 is essentially an ID 1, 2, 3, or 18 message with additional fields from ID 5.
-            elif message["id"] == 19:
-                parameters = ("x", "y", "sog", "cog", "true_heading", "type_and_cargo")
-
-            responses = _get_parameters_from_message(message, parameters)
-
-            if responses:
-                messages_accepted += 1
-                responses["ais_timestamp"] = ais_timestamp
-                responses["mmsi"] = message["mmsi"]
-                responses["id"] = message["id"]
-                valid_messages.append(responses)
-
-            else:
-                messages_rejected += 1
-
-    dump_data_to_json_file(
-        os.path.join(
-            _parsed_data_directory, _raw_file_path.replace(".txt", "_parsed.json")
-        ),
-        valid_messages,
+def get_files_to_parse(raw_ais_directory, parsed_ais_directory):
+    # A raw file is parsed when its Parquet output, or the JSON output of older runs, exists.
+    existing_files = set(os.listdir(parsed_ais_directory))
+
+    return [
+        file
+        for file in sorted(list_downloaded_files(raw_ais_directory))
+        if get_parsed_file_name(file) not in existing_files
+        and re.sub(r"\.txt$", "_parsed.json", file) not in existing_files
+    ]
+
+
+def _update_mmsi_registry(_parsed_ais_directory, _mmsi_registry_file, _parsed_raw_files):
+    if _mmsi_registry_file is None:
+        return
+
+    # A registry without AIS records yet (new, or with shipfinder records only) starts from every parsed file there is.
+    has_ais_records = (load_mmsi_registry(_mmsi_registry_file).records.source == "ais").any()
+    if has_ais_records:
+        parsed_files = [get_parsed_file_name(file) for file in _parsed_raw_files]
+    else:
+        parsed_files = [file for file in os.listdir(_parsed_ais_directory) if is_parsed_ais_file(file)]
+
+    if not parsed_files:
+        return
+
+    print(f"Updating the MMSI registry with {bcolors.BOLD}{len(parsed_files)}{bcolors.ENDC} parsed files...")
+    update_mmsi_registry(
+        _mmsi_registry_file,
+        [os.path.join(_parsed_ais_directory, file) for file in sorted(parsed_files)],
     )
 
 
 def parse_ais_to_json(
-    raw_ais_directory, parsed_ais_directory, single_threaded_processing=True
+    raw_ais_directory,
+    parsed_ais_directory,
+    single_threaded_processing=True,
+    number_of_workers=None,
+    deployment_directory=None,
+    inclusion_radius=None,
+    mmsi_registry_file=None,
 ):
     '''
-    This function parse the ais messages downloaded from ONC into JSON files,
-    filtering by the type of the messages and discarting messages without the
-    needed values.
+    This function parse the ais messages downloaded from ONC into Parquet
+    files with a fixed schema, filtering by the type of the messages and
+    discarting messages without the needed values.
+
+    Without single_threaded_processing, every raw file is split into
+    newline-aligned byte ranges that are parsed by number_of_workers
+    processes (all the cores by default) and merged back in line order.
+
+    With a deployment_directory and an inclusion_radius, the positions that
+    are not near any hydrophone deployment active at their time are dropped
+    while parsing, see prefilter.DeploymentPrefilter.
+
+    With an mmsi_registry_file, the static data of the vessels in the newly
+    parsed files is added to the MMSI registry, see registry.MmsiRegistry.
+
+    Returns the parse counters of every parsed file.
     '''
 
     print(f"Finding available AIS files to parse...")
     # List available RAW files to parse in the input folder.
-    available_files = os.listdir(raw_ais_directory)
-    available_files.sort()
+    available_files = list_downloaded_files(raw_ais_directory)
     print(f"  Found {bcolors.BOLD}{len(available_files)}{bcolors.ENDC} AIS files to parse")
 
-    # List existing parsed files in the destination folder.
-    existing_files = os.listdir(parsed_ais_directory)
-    existing_files.sort()
-    print(f"  Found {bcolors.BOLD}{len(existing_files)}{bcolors.ENDC} existing JSON files")
-
     print(f"Working out what files need parsing...")
-    files_to_parse = [file for file in available_files if file not in existing_files]
+    files_to_parse = get_files_to_parse(raw_ais_directory, parsed_ais_directory)
     print(f"  There are {bcolors.BOLD}{len(files_to_parse)}{bcolors.ENDC} files to parse")
 
+    file_counters = {}
+    if not files_to_parse:
+        print(f"{bcolors.WARNING}No files to parse.{bcolors.ENDC}")
+        _update_mmsi_registry(parsed_ais_directory, mmsi_registry_file, files_to_parse)
+        return file_counters
+
+    prefilter = None
+    if deployment_directory is not None and inclusion_radius is not None:
+        prefilter = load_deployment_prefilter(deployment_directory, inclusion_radius)
+        print(f"  Keeping the positions near {bcolors.BOLD}{len(prefilter)}{bcolors.ENDC} hydrophone deployments")
+
     print(f"Beginning to parse AIS files now...")
     if single_threaded_processing:
-        if files_to_parse:
-            for file in tqdm(files_to_parse):
-                parse_all_valid_messages(file, raw_ais_directory, parsed_ais_directory)
-        else:
-            print(f"{bcolors.WARNING}No files to parse.{bcolors.ENDC}")
-
-    else:
-        print("Begin Multi threading processing...")
-        start_time = time.time()
-        thread_pool = multiprocessing.Pool(2)
         arguments = partial(
-            parse_all_valid_messages,
+            parse_file,
             _raw_data_directory=raw_ais_directory,
             _parsed_data_directory=parsed_ais_directory,
+            prefilter=prefilter,
         )
-        for _ in tqdm(thread_pool.imap(arguments, available_files), total=len(available_files)):
+        for file, counters in run_tasks(arguments, files_to_parse, backend="serial", stage_settings=True):
+            file_counters[file] = counters
+
+    else:
+        # A number of workers given to this step takes precedence over the --executor and --workers of every step, so
+        # the shards are planned for the workers that parse them.
+        backend = "process" if number_of_workers else executor_settings.BACKEND or "process"
+        number_of_workers = number_of_workers or executor_settings.WORKERS or get_num_of_threads(use_all_threads=True)
+        print(f"Begin Multi processing with {number_of_workers} workers...")
+        start_time = time.time()
+
+        shards = []
+        shards_per_file = {}
+        for file in files_to_parse:
+            raw_file = os.path.join(raw_ais_directory, file)
+            parsed_file = os.path.join(parsed_ais_directory, get_parsed_file_name(file))
+
+            # Small files are not worth splitting in many shards.
+            number_of_shards = min(
+                number_of_workers,
+                max(1, os.path.getsize(raw_file) // PARSE_SHARD_MIN_SIZE),
+            )
+
+            shard_files = []
+            for index, (start, end) in enumerate(get_line_aligned_shards(raw_file, number_of_shards)):
+                shard_files.append(_get_shard_file_name(parsed_file, index))
+                shards.append((raw_file, start, end, shard_files[-1]))
+            shards_per_file[parsed_file] = shard_files
+
+        arguments = partial(parse_shard, prefilter=prefilter)
+        for raw_file, counters in run_tasks(
+            arguments, shards, backend=backend, workers=number_of_workers, ordered=False, stage_settings=True
+        ):
+            file_counters.setdefault(os.path.basename(raw_file), _new_counters())
+            for name, count in counters.items():
+                file_counters[os.path.basename(raw_file)][name] += count
+
+        print(f"Merging the parsed shards...")
+        for _ in run_tasks(
+            merge_parsed_shards_task,
+            shards_per_file.items(),
+            backend=backend,
+            workers=number_of_workers,
+            ordered=False,
+            stage_settings=True,
+        ):
             pass
-        thread_pool.close()
-        thread_pool.join()
+
         print(
             "  This process took {0:.3f} seconds to complete".format(
                 time.time() - start_time
             )
         )
+
+    _update_mmsi_registry(parsed_ais_directory, mmsi_registry_file, files_to_parse)
+
+    return file_counters
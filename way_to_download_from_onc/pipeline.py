@@ -0,0 +1,239 @@
+import os
+import shutil
+import hashlib
+import threading
+
+import ujson
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from utils import bcolors
+
+
+class Stage:
+    '''
+    A step of the pipeline and what it depends on.
+
+    - function(stage_metrics) runs the step, see metrics.RunLog.stage.
+    - inputs and outputs are files or directories. The outputs are the
+      files the step writes, and are removed when they are stale.
+    - parameters are the settings the outputs depend on.
+    - depends_on are the steps whose outputs this one reads. Steps that do
+      not depend on each other run concurrently.
+    - With partition_outputs, the files of the first input directory are
+      partitions: partition_outputs(input file name) gives the names of the
+      output files made from it (they may sit in any output sub-directory),
+      and only the outputs of the changed partitions are removed. The step
+      itself skips the outputs that still exist.
+    - Sources (e.g. the downloads) have no inputs to fingerprint. They
+      always run, and their outputs are never removed.
+    '''
+
+    def __init__(
+        self,
+        step,
+        name,
+        function,
+        inputs=(),
+        outputs=(),
+        parameters=None,
+        depends_on=(),
+        partition_outputs=None,
+        source=False,
+    ):
+        self.step = step
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.parameters = parameters or {}
+        self.depends_on = list(depends_on)
+        self.partition_outputs = partition_outputs
+        self.source = source
+
+
+def fingerprint_paths(paths):
+    '''
+    (size, modification time) of every file under the paths, keyed by path.
+    Hashing the contents of the whole dataset would take longer than most
+    of the steps, so files are assumed unchanged as long as these are.
+    '''
+
+    fingerprints = {}
+    for path in paths:
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            fingerprints[path] = [stat.st_size, stat.st_mtime_ns]
+            continue
+
+        for root, _, files in os.walk(path):
+            for file in files:
+                # Unfinished downloads and writes are not part of the data yet.
+                if file.endswith(".part"):
+                    continue
+                file_path = os.path.join(root, file)
+                try:
+                    stat = os.stat(file_path)
+                except FileNotFoundError:
+                    continue
+                fingerprints[file_path] = [stat.st_size, stat.st_mtime_ns]
+
+    return fingerprints
+
+
+def fingerprint_parameters(parameters):
+    return hashlib.sha1(ujson.dumps(parameters, sort_keys=True).encode()).hexdigest()
+
+
+class PipelineManifest:
+    '''
+    Fingerprints of the parameters, inputs and outputs of every step at the
+    end of its last successful run, in a JSON file of the working directory.
+    '''
+
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        self.lock = threading.Lock()
+        self.stages = {}
+        if os.path.exists(manifest_file):
+            with open(manifest_file, "r") as input_file:
+                self.stages = ujson.load(input_file)
+
+    def get(self, stage):
+        return self.stages.get(str(stage.step))
+
+    def record(self, stage, input_fingerprints):
+        with self.lock:
+            self.stages[str(stage.step)] = {
+                "name": stage.name,
+                "parameters": fingerprint_parameters(stage.parameters),
+                "inputs": input_fingerprints,
+                "outputs": fingerprint_paths(stage.outputs),
+            }
+
+            partial_file = self.manifest_file + ".part"
+            with open(partial_file, "w") as output_file:
+                ujson.dump(self.stages, output_file)
+            os.replace(partial_file, self.manifest_file)
+
+
+def _remove_outputs(_stage, _names=None):
+    # Every output file, or only the ones with the given names.
+    removed = 0
+    for path in fingerprint_paths(_stage.outputs):
+        if _names is None or os.path.basename(path) in _names:
+            os.remove(path)
+            removed += 1
+
+    # Outputs that are whole directories of the step are emptied too, e.g. the deployment partitions.
+    if _names is None:
+        for output in _stage.outputs:
+            if os.path.isdir(output):
+                for entry in os.listdir(output):
+                    entry_path = os.path.join(output, entry)
+                    if os.path.isdir(entry_path):
+                        shutil.rmtree(entry_path)
+
+    return removed
+
+
+def plan_stage(stage, manifest, force=False):
+    '''
+    Work out whether a step has to run, and remove its stale outputs.
+    Returns (run, reason, input fingerprints).
+    '''
+
+    input_fingerprints = fingerprint_paths(stage.inputs)
+    if stage.source:
+        return True, "source step", input_fingerprints
+
+    recorded = manifest.get(stage)
+    if force or recorded is None:
+        reason = "forced" if force else "never ran"
+        if force:
+            _remove_outputs(stage)
+        return True, reason, input_fingerprints
+
+    if recorded["parameters"] != fingerprint_parameters(stage.parameters):
+        removed = _remove_outputs(stage)
+        return True, f"parameters changed, {removed} outputs removed", input_fingerprints
+
+    recorded_inputs = recorded["inputs"]
+    changed_inputs = {
+        path
+        for path in set(recorded_inputs) | set(input_fingerprints)
+        if recorded_inputs.get(path) != input_fingerprints.get(path)
+    }
+    outputs_changed = recorded["outputs"] != fingerprint_paths(stage.outputs)
+
+    if not changed_inputs and not outputs_changed:
+        return False, "up to date", input_fingerprints
+
+    if not changed_inputs:
+        return True, "outputs changed", input_fingerprints
+
+    partition_directory = stage.inputs[0] if stage.partition_outputs else None
+    changed_partitions = [
+        path for path in changed_inputs if partition_directory and os.path.dirname(path) == partition_directory
+    ]
+    if len(changed_partitions) < len(changed_inputs):
+        removed = _remove_outputs(stage)
+        return True, f"inputs changed, {removed} outputs removed", input_fingerprints
+
+    names = set()
+    for path in changed_partitions:
+        names.update(stage.partition_outputs(os.path.basename(path)))
+    removed = _remove_outputs(stage, names)
+
+    return True, f"{len(changed_partitions)} partitions changed, {removed} outputs removed", input_fingerprints
+
+
+def run_pipeline(stages, steps, manifest, run_log, concurrency=2, force=False):
+    '''
+    Run the selected steps in dependency order, skipping the ones whose
+    parameters, inputs and outputs are unchanged since their last run (see
+    plan_stage). Steps whose dependencies are done run concurrently, up to
+    concurrency at a time. Dependencies on steps that are not selected are
+    taken as met.
+    '''
+
+    selected = {stage.step: stage for stage in stages if stage.step in steps}
+    pending = dict(selected)
+    running = {}
+    done = set()
+
+    def run(stage):
+        run_stage, reason, input_fingerprints = plan_stage(stage, manifest, force)
+        if not run_stage:
+            print(f"{bcolors.OKGREEN}Step {stage.step} ({stage.name}) is {reason}, skipping{bcolors.ENDC}")
+            return
+
+        print(f"{bcolors.OKBLUE}Running step {stage.step} ({stage.name}): {reason}{bcolors.ENDC}")
+        with run_log.stage(stage.step, stage.name, inputs=stage.inputs, outputs=stage.outputs) as stage_metrics:
+            stage.function(stage_metrics)
+        manifest.record(stage, input_fingerprints)
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        while pending or running:
+            ready = [
+                stage
+                for stage in pending.values()
+                if all(step in done or step not in selected for step in stage.depends_on)
+            ]
+            # Steps that run one after the other keep the order of their IDs.
+            for stage in sorted(ready, key=lambda stage: stage.step):
+                running[executor.submit(run, stage)] = stage
+                del pending[stage.step]
+
+            if not running:
+                raise ValueError(f"The steps {sorted(pending)} depend on each other")
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                # A failed step stops the pipeline, once the running steps are done.
+                if future.exception() is not None:
+                    pending.clear()
+                    wait(running)
+                    raise future.exception()
+                done.add(stage.step)
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+
+from utils import get_hydrophone_deployments, get_coarse_bounds
+
+
+class DeploymentPrefilter:
+    '''
+    Coarse spatial and temporal filter built from every hydrophone
+    deployment, so that the AIS messages far from all the hydrophones are
+    dropped while parsing instead of after they have been written to disk.
+
+    A position is kept when it is inside the coarse box of a deployment
+    (see utils.get_coarse_bounds) that is active at the time of the message.
+    A deployment is active over the same whole days the clean step uses.
+    '''
+
+    def __init__(self, hydrophone_deployments, inclusion_radius):
+        periods = []
+        bounds = []
+        for deployments in hydrophone_deployments.values():
+            for deployment in deployments.itertuples(index=False):
+                if np.isnan(deployment.latitude) or np.isnan(deployment.longitude):
+                    continue
+
+                # Deployments without an end are still running.
+                begin = pd.Timestamp(deployment.begin).normalize().value
+                end = np.iinfo(np.int64).max
+                if not pd.isna(deployment.end):
+                    end = (pd.Timestamp(deployment.end).normalize() + pd.DateOffset(days=1)).value
+
+                periods.append((begin, end))
+                bounds.append(get_coarse_bounds(deployment.latitude, deployment.longitude, inclusion_radius))
+
+        periods = np.array(periods, dtype=np.int64).reshape(-1, 2)
+        bounds = np.array(bounds, dtype=np.float64).reshape(-1, 4)
+        self.begins, self.ends = periods[:, 0], periods[:, 1]
+        self.left_bounds, self.right_bounds = bounds[:, 0], bounds[:, 1]
+        self.top_bounds, self.bottom_bounds = bounds[:, 2], bounds[:, 3]
+
+    def __len__(self):
+        return self.begins.size
+
+    def positions_to_keep(self, timestamps, x, y):
+        '''
+        Return a mask of the positions, given as int64 nanosecond timestamps
+        and x/y arrays, that are near a deployment active at that time.
+        '''
+
+        keep = np.zeros(np.shape(x), dtype=bool)
+        for index in range(len(self)):
+            keep |= (
+                (self.begins[index] <= timestamps)
+                & (timestamps <= self.ends[index])
+                & (self.left_bounds[index] <= x)
+                & (x <= self.right_bounds[index])
+                & (self.bottom_bounds[index] <= y)
+                & (y <= self.top_bounds[index])
+            )
+
+        return keep
+
+
+def load_deployment_prefilter(deployment_directory, inclusion_radius):
+    return DeploymentPrefilter(get_hydrophone_deployments(deployment_directory), inclusion_radius)
@@ -0,0 +1,286 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from utils import (
+    bcolors,
+    ais_params,
+    read_parsed_ais_file,
+    zulu_column_to_timestamps,
+    dump_data_frame_to_feather_file,
+    read_data_frame_from_feather_file,
+    run_tasks,
+)
+
+
+REGISTRY_COLUMNS = [
+    "mmsi",
+    "source",
+    "first_seen",
+    "last_seen",
+    ais_params.TYPE_AND_CARGO,
+    "type_and_cargo_seen",
+    ais_params.IMO,
+    "imo_seen",
+]
+
+# When several sources know an MMSI, the values broadcast by the vessel itself win.
+SOURCE_PRIORITY = ("ais", "shipfinder")
+
+# Ship types of the shipfinder records (in Chinese) and the closest AIS type_and_cargo code.
+SHIPFINDER_TYPES_TO_TYPE_AND_CARGO = {
+    "捕捞": 30,  # Fishing
+    "拖引": 31,  # Towing
+    "拖引并且船长>200m或船宽>25m": 32,  # Towing, length over 200 m or breadth over 25 m
+    "疏浚或水下作业": 33,  # Dredging or underwater operations
+    "潜水作业": 34,  # Diving operations
+    "参与军事行动": 35,  # Military operations
+    "帆船航行": 36,  # Sailing
+    "娱乐船": 37,  # Pleasure craft
+    "备用-用于当地船舶的任务分配": 38,  # Reserved for regional use
+    "引航船": 50,  # Pilot vessel
+    "搜救船": 51,  # Search and rescue
+    "拖轮": 52,  # Tug
+    "港口供应船": 53,  # Port tender
+    "载有防污染装置和设备的船舶": 54,  # Anti-pollution equipment
+    "客船": 60,  # Passenger
+    "货船": 70,  # Cargo
+    "集装箱船": 70,  # Container ship, a cargo ship for AIS
+    "油轮": 80,  # Tanker
+    "其他": 90,  # Other
+    "其他类型船舶": 90,  # Other type of ship
+}
+
+
+def _empty_records():
+    return pd.DataFrame(
+        {
+            "mmsi": np.zeros(0, dtype=np.int64),
+            "source": np.zeros(0, dtype=object),
+            "first_seen": np.zeros(0, dtype=np.int64),
+            "last_seen": np.zeros(0, dtype=np.int64),
+            ais_params.TYPE_AND_CARGO: np.zeros(0, dtype=np.float32),
+            "type_and_cargo_seen": np.zeros(0, dtype=np.int64),
+            ais_params.IMO: np.zeros(0, dtype=np.float64),
+            "imo_seen": np.zeros(0, dtype=np.int64),
+        }
+    )
+
+
+def _reduce_records(_records):
+    # One record per (mmsi, source): the first and last time it was seen, and the latest known value of each field.
+    keys = ["mmsi", "source"]
+    reduced = _records.groupby(keys).agg(first_seen=("first_seen", "min"), last_seen=("last_seen", "max"))
+
+    for column in (ais_params.TYPE_AND_CARGO, ais_params.IMO):
+        seen = f"{column}_seen"
+        known = _records[_records[column].notna()].sort_values(by=seen, kind="stable")
+        known = known.groupby(keys)[[column, seen]].last()
+        # Nullable, so that the nanoseconds do not go through float64 where the join leaves gaps.
+        reduced = reduced.join(known.astype({seen: "Int64"}))
+
+    reduced = reduced.reset_index()
+    reduced[ais_params.TYPE_AND_CARGO] = reduced[ais_params.TYPE_AND_CARGO].astype(np.float32)
+    reduced[ais_params.IMO] = reduced[ais_params.IMO].astype(np.float64)
+    for seen in ("type_and_cargo_seen", "imo_seen"):
+        reduced[seen] = reduced[seen].fillna(0).astype(np.int64)
+
+    return reduced[REGISTRY_COLUMNS]
+
+
+class MmsiRegistry:
+    '''
+    Static data of every known vessel, keyed by MMSI: its type_and_cargo and
+    IMO number, and the first and last time it was seen (int64 nanoseconds).
+    Records of each source are kept apart, see SOURCE_PRIORITY.
+
+    The registry is updated incrementally with update() (updates are
+    idempotent) and answers vectorized lookups for whole MMSI columns.
+    '''
+
+    def __init__(self, records=None):
+        self.records = _reduce_records(_empty_records() if records is None else records)
+        self._build_index()
+
+    def __len__(self):
+        return self.records.mmsi.nunique()
+
+    def _build_index(self):
+        ranks = self.records.source.map({source: rank for rank, source in enumerate(SOURCE_PRIORITY)})
+        self.index = {}
+        for column in (ais_params.TYPE_AND_CARGO, ais_params.IMO):
+            known = self.records[self.records[column].notna()].assign(rank=ranks.fillna(len(SOURCE_PRIORITY)))
+            known = known.sort_values(by=["mmsi", "rank"], kind="stable").drop_duplicates(subset="mmsi")
+            self.index[column] = (known.mmsi.to_numpy(np.int64), known[column].to_numpy(np.float64))
+
+    def update(self, records):
+        self.records = _reduce_records(pd.concat([self.records, records], ignore_index=True))
+        self._build_index()
+
+    def lookup(self, mmsi, column=ais_params.TYPE_AND_CARGO):
+        '''
+        The value of column for every MMSI of an array, NaN when unknown.
+        '''
+
+        mmsi = np.asarray(mmsi, dtype=np.float64)
+        keys, values = self.index[column]
+        result = np.full(mmsi.shape, np.nan)
+        if not keys.size:
+            return result
+
+        valid = np.isfinite(mmsi)
+        positions = np.searchsorted(keys, mmsi[valid].astype(np.int64))
+        positions = np.minimum(positions, keys.size - 1)
+        found = keys[positions] == mmsi[valid].astype(np.int64)
+        result[np.flatnonzero(valid)[found]] = values[positions[found]]
+
+        return result
+
+    def fill_type_and_cargo(self, data_frame):
+        # Only the messages without a type of their own get the one of the registry.
+        missing = data_frame[ais_params.TYPE_AND_CARGO].isna().to_numpy()
+        if missing.any():
+            type_and_cargo = data_frame[ais_params.TYPE_AND_CARGO].to_numpy(np.float64, copy=True)
+            type_and_cargo[missing] = self.lookup(data_frame.mmsi.to_numpy()[missing])
+            data_frame[ais_params.TYPE_AND_CARGO] = type_and_cargo.astype(data_frame[ais_params.TYPE_AND_CARGO].dtype)
+
+        return data_frame
+
+    def save(self, file):
+        partial_file = file + ".part"
+        dump_data_frame_to_feather_file(partial_file, self.records.reset_index(drop=True))
+        os.replace(partial_file, file)
+
+
+def load_mmsi_registry(file):
+    if file is None or not os.path.exists(file):
+        return MmsiRegistry()
+
+    return MmsiRegistry(read_data_frame_from_feather_file(file))
+
+
+def summarize_ais_messages(data_frame, source="ais"):
+    '''
+    Registry records of parsed AIS messages, given with their mmsi,
+    ais_timestamp, type_and_cargo and (optionally) imo columns.
+    '''
+
+    if data_frame.empty:
+        return _empty_records()
+
+    mmsi = data_frame.mmsi.to_numpy(np.int64)
+    timestamps = zulu_column_to_timestamps(data_frame.ais_timestamp).values.view(np.int64)
+
+    # Every message counts for the times an MMSI was seen, only a few carry static data.
+    seen = pd.DataFrame({"mmsi": mmsi, "timestamp": timestamps}).groupby("mmsi").timestamp.agg(["min", "max"])
+    seen_records = pd.DataFrame(
+        {
+            "mmsi": seen.index.to_numpy(np.int64),
+            "first_seen": seen["min"].to_numpy(np.int64),
+            "last_seen": seen["max"].to_numpy(np.int64),
+            ais_params.TYPE_AND_CARGO: np.nan,
+            "type_and_cargo_seen": 0,
+            ais_params.IMO: np.nan,
+            "imo_seen": 0,
+        }
+    )
+
+    type_and_cargo = data_frame[ais_params.TYPE_AND_CARGO].to_numpy(np.float64)
+    imo = (
+        data_frame[ais_params.IMO].to_numpy(np.float64)
+        if ais_params.IMO in data_frame.columns
+        else np.full(mmsi.shape, np.nan)
+    )
+    static = ~np.isnan(type_and_cargo) | ~np.isnan(imo)
+    static_records = pd.DataFrame(
+        {
+            "mmsi": mmsi[static],
+            "first_seen": timestamps[static],
+            "last_seen": timestamps[static],
+            ais_params.TYPE_AND_CARGO: type_and_cargo[static],
+            "type_and_cargo_seen": timestamps[static],
+            ais_params.IMO: imo[static],
+            "imo_seen": timestamps[static],
+        }
+    )
+
+    records = pd.concat([seen_records, static_records], ignore_index=True)
+    records["source"] = source
+
+    return _reduce_records(records)
+
+
+def summarize_parsed_ais_file(_file):
+    columns = ["ais_timestamp", "mmsi", ais_params.TYPE_AND_CARGO, ais_params.IMO]
+
+    # Files parsed before the registry existed have no 'imo' column.
+    if _file.endswith(".parquet"):
+        columns = [column for column in columns if column in pq.read_schema(_file).names]
+
+    return summarize_ais_messages(read_parsed_ais_file(_file, columns=columns))
+
+
+def read_shipfinder_records(_file):
+    '''
+    Registry records of a file of shipfinder records, one vessel per line:
+    '[crawl time],mmsi,callsign,heading,course,imo,sog,ship type,longitude,
+    latitude,length,width,draught,destination...,eta,last time'. The
+    destination may hold commas, so the last fields are read from the end.
+    '''
+
+    records = []
+    with open(_file, "r", encoding="utf-8") as input_file:
+        for line in input_file:
+            fields = line.rstrip("\n").split(",")
+            if len(fields) < 16 or not fields[1].isdigit():
+                continue
+
+            records.append(
+                {
+                    "mmsi": int(fields[1]),
+                    ais_params.TYPE_AND_CARGO: SHIPFINDER_TYPES_TO_TYPE_AND_CARGO.get(fields[7], np.nan),
+                    ais_params.IMO: float(fields[5]) if fields[5].isdigit() else np.nan,
+                    "last_seen": fields[-1].strip(),
+                }
+            )
+
+    if not records:
+        return _empty_records()
+
+    records = pd.DataFrame(records)
+    last_seen = pd.to_datetime(records.last_seen, utc=True, errors="coerce")
+    records = records[last_seen.notna()]
+    last_seen = last_seen[last_seen.notna()].values.view(np.int64)
+
+    records["first_seen"] = last_seen
+    records["last_seen"] = last_seen
+    records["type_and_cargo_seen"] = last_seen
+    records["imo_seen"] = last_seen
+    records["source"] = "shipfinder"
+
+    return _reduce_records(records)
+
+
+def update_mmsi_registry(registry_file, parsed_files=(), shipfinder_files=()):
+    '''
+    Add the parsed AIS files and the shipfinder files to the registry saved
+    in registry_file, creating it if needed, and return the registry.
+    '''
+
+    registry = load_mmsi_registry(registry_file)
+    known_mmsi = len(registry)
+
+    records = list(run_tasks(summarize_parsed_ais_file, parsed_files, ordered=False)) if parsed_files else []
+    records += [read_shipfinder_records(file) for file in shipfinder_files]
+    if records:
+        registry.update(pd.concat(records, ignore_index=True))
+
+    registry.save(registry_file)
+    print(
+        f"  The MMSI registry knows {bcolors.BOLD}{len(registry)}{bcolors.ENDC} vessels, "
+        f"{len(registry) - known_mmsi} of them new"
+    )
+
+    return registry
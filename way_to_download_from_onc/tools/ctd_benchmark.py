@@ -0,0 +1,80 @@
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import xmltodict
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from clean import CTD_COLUMNS, extract_ctd_packets
+from utils import nanoseconds_to_onc_strings
+
+# One day of 1 Hz datapackets of the SBE 19plus CTD.
+NUMBER_OF_LINES = 86400
+DAY_BEGIN = pd.Timestamp("2020-08-05").value
+
+
+def generate_ctd_text(_number_of_lines):
+    random = np.random.default_rng(0)
+    dates = nanoseconds_to_onc_strings(DAY_BEGIN + np.arange(_number_of_lines, dtype=np.int64) * 1000000000)
+    values = random.uniform([8, 3, 20, 28, 1480], [12, 4, 40, 31, 1490], (_number_of_lines, len(CTD_COLUMNS)))
+
+    lines = []
+    for date, (t1, c1, p1, sal, sv) in zip(dates, values):
+        lines.append(
+            f'{date} <?xml version="1.0"?><datapacket><hdr><mfg>Sea-Bird</mfg><model>19plus</model></hdr>'
+            f"<data><t1> {t1:.4f}</t1><c1> {c1:.5f}</c1><p1> {p1:.3f}</p1><sal> {sal:.4f}</sal>"
+            f"<sv>{sv:.3f}</sv></data></datapacket>\n"
+        )
+
+    return "".join(lines)
+
+
+def extract_with_xmltodict(_text):
+    # The former extraction, one XML document per line.
+    final_dict = {column: [] for column in ["date"] + CTD_COLUMNS}
+    for line in _text.splitlines():
+        date_and_xml = line.split("<?xml")
+        if len(date_and_xml) != 2:
+            continue
+        xml_dict = xmltodict.parse(f"<?xml{date_and_xml[1]}")
+
+        final_dict["date"].append(date_and_xml[0].strip())
+        for column in CTD_COLUMNS:
+            final_dict[column].append(xml_dict["datapacket"]["data"][column])
+
+    return final_dict
+
+
+def main():
+    text = generate_ctd_text(NUMBER_OF_LINES)
+
+    start_time = time.time()
+    reference = extract_with_xmltodict(text)
+    xmltodict_elapsed = time.time() - start_time
+
+    start_time = time.time()
+    columns = extract_ctd_packets(text.encode())
+    regex_elapsed = time.time() - start_time
+
+    print(f"{NUMBER_OF_LINES} datapackets")
+    print(f"  xmltodict: {NUMBER_OF_LINES / xmltodict_elapsed:12.0f} lines/s")
+    print(f"  regex:     {NUMBER_OF_LINES / regex_elapsed:12.0f} lines/s")
+
+    mismatches = [
+        column for column in CTD_COLUMNS
+        if not np.array_equal(columns[column], np.array(reference[column], dtype=np.float32))
+    ]
+    if not np.array_equal(nanoseconds_to_onc_strings(columns["timestamp"]), np.array(reference["date"])):
+        mismatches.append("timestamp")
+
+    if mismatches:
+        print(f"  The extractions differ on {mismatches}")
+        sys.exit(1)
+    print("  The extractions are identical")
+
+
+if __name__ == "__main__":
+    main()
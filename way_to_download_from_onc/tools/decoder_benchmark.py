@@ -0,0 +1,65 @@
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import lpais.ais as ais
+
+from parse import parse_lines
+
+
+def new_decoder():
+    return ais.decoder(
+        allow_unknown=True,
+        allow_missing_timestamps=True,
+        pass_invalid_checksums=True,
+        handle_err=None,
+    )
+
+
+def run_decoder(name, lines, batch_decoding):
+    counters = {
+        "lines_read": 0,
+        "messages_decoded": 0,
+        "messages_accepted": 0,
+        "messages_rejected": 0,
+    }
+
+    start_time = time.time()
+    columns = parse_lines(lines, new_decoder(), counters, batch_decoding)
+    elapsed = time.time() - start_time
+
+    print(f"{name:>6}: {len(lines) / elapsed:10.0f} lines/s ({elapsed:.3f} s, {counters['messages_accepted']} accepted)")
+
+    return columns
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} <raw AIS file> [<raw AIS file> ...]")
+        sys.exit(1)
+
+    lines = []
+    for raw_file in sys.argv[1:]:
+        with open(raw_file, "r") as input_file:
+            lines.extend(input_file)
+
+    print(f"Decoding {len(lines)} lines")
+    lpais_columns = run_decoder("lpais", lines, False)
+    batch_columns = run_decoder("batch", lines, True)
+
+    for name, column in lpais_columns.items():
+        if column.dtype.kind == "f":
+            same = ((column == batch_columns[name]) | ((column != column) & (batch_columns[name] != batch_columns[name]))).all()
+        else:
+            same = (column == batch_columns[name]).all()
+        if not same:
+            print(f"  Column {name} differs between the two decoders")
+            sys.exit(1)
+
+    print("  Both decoders produce the same columns")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from decoder_benchmark import new_decoder
+from parse import parse_lines
+
+# A type 18, a type 1 and a type 18 message, all decoded by the batch decoder.
+MIXED_LINES = [
+    "20200805T000030.930Z !AIVDM,1,1,,A,B545JrP0Tmjq1fW1au5el;g5j000,0*00\n",
+    "20200805T000014.175Z !AIVDM,1,1,,A,1:khsP001vo;v0FKt@=06C`t0000,0*0D\n",
+    "20200805T000057.026Z !AIVDM,1,1,,A,B3F47300OUjhGpW38sEsCwg5j000,0*2B\n",
+]
+
+
+def new_counters():
+    return {"lines_read": 0, "messages_decoded": 0, "messages_accepted": 0, "messages_rejected": 0}
+
+
+def main():
+    lpais_columns = parse_lines(MIXED_LINES, new_decoder(), new_counters(), batch_decoding=False)
+    batch_columns = parse_lines(MIXED_LINES, new_decoder(), new_counters(), batch_decoding=True)
+
+    if batch_columns["line_index"].tolist() != list(range(len(MIXED_LINES))):
+        print(f"  The batch rows are in the line order {batch_columns['line_index'].tolist()}")
+        sys.exit(1)
+
+    for name, column in lpais_columns.items():
+        if not np.array_equal(column, batch_columns[name], equal_nan=column.dtype.kind == "f"):
+            print(f"  Column {name} differs between the two decoders")
+            sys.exit(1)
+
+    print("  Both decoders return the messages of mixed types in the order of the lines")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from download import download_file_list, download_file_list_async
+
+NUMBER_OF_FILES = 500
+FILE_SIZE = 256 * 1024
+MAX_REQUESTS_PER_HOST = 8
+TOKEN = "benchmark-token"
+
+
+class ArchiveFilesHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so that clients are able to keep the connection alive between files.
+    protocol_version = "HTTP/1.1"
+    body = os.urandom(FILE_SIZE)
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stand_in_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ArchiveFilesHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def run_engine(name, download_function, files_to_download):
+    output_directory = tempfile.mkdtemp(prefix=f"onc_{name}_")
+
+    start_time = time.time()
+    download_function(output_directory, files_to_download)
+    elapsed = time.time() - start_time
+
+    total_bytes = sum(
+        os.path.getsize(os.path.join(output_directory, file)) for file in os.listdir(output_directory)
+    )
+    shutil.rmtree(output_directory)
+
+    print(
+        f"{name:>6}: {len(files_to_download) / elapsed:8.1f} files/s "
+        f"{total_bytes / elapsed / 1e6:8.1f} MB/s ({elapsed:.3f} s)"
+    )
+
+
+def main():
+    server, base_url = start_stand_in_server()
+    files_to_download = [f"ICLISTENAF2523_20200805T{index:06d}.000Z.wav" for index in range(NUMBER_OF_FILES)]
+
+    print(f"Downloading {NUMBER_OF_FILES} files of {FILE_SIZE / 1024:.0f} KiB from {base_url}")
+    run_engine(
+        "pool",
+        lambda output_directory, files: download_file_list(output_directory, TOKEN, files, base_url=base_url),
+        files_to_download,
+    )
+    run_engine(
+        "async",
+        lambda output_directory, files: download_file_list_async(
+            output_directory,
+            TOKEN,
+            files,
+            max_requests_per_host=MAX_REQUESTS_PER_HOST,
+            base_url=base_url,
+        ),
+        files_to_download,
+    )
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
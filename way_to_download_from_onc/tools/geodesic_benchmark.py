@@ -0,0 +1,54 @@
+import os
+import sys
+import time
+
+import numpy as np
+import geopy.distance
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from geodesic import geodesic_distance
+
+# A hydrophone of the Strait of Georgia, with vessels spread over a square of the coarse box size.
+HYDROPHONE_LATITUDE = 49.0404
+HYDROPHONE_LONGITUDE = -123.3256
+BOX_SIZE_DEGREES = 0.3
+
+NUMBER_OF_POINTS = 2000000
+NUMBER_OF_GEOPY_POINTS = 20000
+
+# Maximum difference (metres) allowed with geopy, whose geodesic is the reference.
+MAXIMUM_ERROR = 1e-3
+
+
+def main():
+    random = np.random.default_rng(0)
+    latitudes = HYDROPHONE_LATITUDE + random.uniform(-BOX_SIZE_DEGREES, BOX_SIZE_DEGREES, NUMBER_OF_POINTS)
+    longitudes = HYDROPHONE_LONGITUDE + random.uniform(-BOX_SIZE_DEGREES, BOX_SIZE_DEGREES, NUMBER_OF_POINTS)
+
+    start_time = time.time()
+    distances = geodesic_distance(HYDROPHONE_LATITUDE, HYDROPHONE_LONGITUDE, latitudes, longitudes)
+    numpy_elapsed = time.time() - start_time
+
+    start_time = time.time()
+    reference = np.array(
+        [
+            geopy.distance.geodesic((HYDROPHONE_LATITUDE, HYDROPHONE_LONGITUDE), (latitude, longitude)).meters
+            for latitude, longitude in zip(latitudes[:NUMBER_OF_GEOPY_POINTS], longitudes[:NUMBER_OF_GEOPY_POINTS])
+        ]
+    )
+    geopy_elapsed = time.time() - start_time
+
+    error = np.abs(distances[:NUMBER_OF_GEOPY_POINTS] - reference)
+    print(f"Distances up to {reference.max() / 1000:.1f} km from the hydrophone")
+    print(f"  geopy: {NUMBER_OF_GEOPY_POINTS / geopy_elapsed / 1e6:8.4f} Mpts/s")
+    print(f"  numpy: {NUMBER_OF_POINTS / numpy_elapsed / 1e6:8.4f} Mpts/s")
+    print(f"  Maximum difference with geopy: {error.max() * 1000:.6f} mm, mean {error.mean() * 1000:.6f} mm")
+
+    if error.max() > MAXIMUM_ERROR:
+        print(f"  The difference is above the {MAXIMUM_ERROR * 1000:.3f} mm tolerance")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
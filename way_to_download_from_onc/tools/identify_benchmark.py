@@ -0,0 +1,82 @@
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from identify import iterate_minute_windows, identify_minute_scenarios
+from utils import get_ais_dataset_time_range
+
+INCLUSION_RADII = np.arange(1000, 11000, 1000)
+EXCLUSION_RADIUS_OFFSET = 2000
+
+
+def identify_minute_by_minute(_interval_lefts, _data_frame, _inclusion_radii, _exclusion_radii):
+    # The former identification, one minute and one pair of radii at a time.
+    data_frame = _data_frame.set_index(_data_frame["pd_timestamp"])
+    grouped_by_time_intervals = dict(list(data_frame.groupby(pd.Grouper(freq="1Min", offset="0Min", label="left"))))
+
+    background = np.zeros((_interval_lefts.shape[0], _inclusion_radii.shape[0]), dtype=bool)
+    single_vessel = np.zeros(background.shape, dtype=bool)
+    for minute, interval_left in enumerate(_interval_lefts):
+        interval_data = grouped_by_time_intervals.get(interval_left, data_frame.iloc[:0])
+
+        for index, (inclusion_radius, exclusion_radius) in enumerate(zip(_inclusion_radii, _exclusion_radii)):
+            if sum(interval_data["distance_to_hydrophone"] <= exclusion_radius) == 0:
+                background[minute, index] = True
+                continue
+
+            only_one_vessel_within_exclusion_radius = (
+                interval_data[interval_data["distance_to_hydrophone"] <= exclusion_radius]["mmsi"].unique().shape[0]
+            ) == 1
+            all_messages_are_within_inclusion_radius = sum(
+                interval_data["distance_to_hydrophone"] <= inclusion_radius
+            ) == sum(interval_data["distance_to_hydrophone"] <= exclusion_radius)
+
+            single_vessel[minute, index] = (
+                only_one_vessel_within_exclusion_radius and all_messages_are_within_inclusion_radius
+            )
+
+    return background, single_vessel
+
+
+def main():
+    if len(sys.argv) != 2:
+        print(f"Usage: {sys.argv[0]} <combined deployment '*_clean_ais_data' dataset>")
+        sys.exit(1)
+
+    first_timestamp, last_timestamp = get_ais_dataset_time_range(sys.argv[1])
+    exclusion_radii = INCLUSION_RADII + EXCLUSION_RADIUS_OFFSET
+
+    reference_elapsed = 0.0
+    vectorized_elapsed = 0.0
+    number_of_minutes = 0
+    mismatches = 0
+    for interval_lefts, data_frame in iterate_minute_windows(sys.argv[1], first_timestamp, last_timestamp):
+        number_of_minutes += interval_lefts.shape[0]
+
+        start_time = time.time()
+        reference = identify_minute_by_minute(interval_lefts, data_frame, INCLUSION_RADII, exclusion_radii)
+        reference_elapsed += time.time() - start_time
+
+        start_time = time.time()
+        scenarios = identify_minute_scenarios(interval_lefts, data_frame, INCLUSION_RADII, exclusion_radii)
+        vectorized_elapsed += time.time() - start_time
+
+        mismatches += sum(int((expected != result).sum()) for expected, result in zip(reference, scenarios))
+
+    print(f"{number_of_minutes} minutes, {INCLUSION_RADII.shape[0]} pairs of radii")
+    print(f"  minute by minute: {reference_elapsed:8.3f} s")
+    print(f"  vectorized:       {vectorized_elapsed:8.3f} s")
+
+    if mismatches:
+        print(f"  The identifications differ on {mismatches} minutes")
+        sys.exit(1)
+    print("  The identifications are identical")
+
+
+if __name__ == "__main__":
+    main()
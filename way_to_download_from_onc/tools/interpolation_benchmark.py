@@ -0,0 +1,103 @@
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from combine import MINIMUM_DELTA, MAXIMUM_DELTA, interpolate_tracks
+from utils import read_ais_dataset
+
+
+def generate_time_steps(_row_pd_timestamp, _row_time_difference, _minimum_delta):
+    end_timestamp = _row_pd_timestamp
+    time_difference = _row_time_difference
+
+    steps_required = np.ceil(time_difference / _minimum_delta)
+
+    time_steps = pd.date_range(
+        start=(end_timestamp - time_difference),
+        end=end_timestamp - (time_difference / steps_required),
+        periods=steps_required,
+    )
+
+    return time_steps.to_list()
+
+
+def interpolation_for_chunks(_chunk):
+    # The former interpolation, one MMSI at a time.
+    _chunk["time_difference"] = _chunk["pd_timestamp"] - _chunk["pd_timestamp"].shift()
+    _chunk["to_interpolate"] = (_chunk["time_difference"] > MINIMUM_DELTA) & (
+        _chunk["time_difference"] <= MAXIMUM_DELTA
+    )
+
+    if not _chunk["to_interpolate"].any():
+        return None
+
+    time_steps_to_add = np.vectorize(generate_time_steps)(
+        _chunk[_chunk["to_interpolate"]]["pd_timestamp"],
+        _chunk[_chunk["to_interpolate"]]["time_difference"],
+        MINIMUM_DELTA,
+    )
+    time_steps_to_add = [subvalue for value in time_steps_to_add for subvalue in value]
+    new_timesteps = pd.DataFrame(data=time_steps_to_add, columns=["pd_timestamp"])
+
+    _chunk = pd.concat([_chunk, new_timesteps], ignore_index=True)
+    _chunk = _chunk.sort_values(by="pd_timestamp", kind="stable", ignore_index=True)
+    _chunk = _chunk.drop(labels=["time_difference", "to_interpolate"], axis=1)
+
+    for column in ["x", "y", "sog", "cog", "true_heading", "distance_to_hydrophone"]:
+        _chunk[column] = _chunk[column].interpolate()
+    for column in ["id", "mmsi", "type_and_cargo"]:
+        _chunk[column] = _chunk[column].ffill()
+
+    return _chunk[_chunk["ais_timestamp"].isna()]
+
+
+def interpolate_by_mmsi(_data_frame):
+    outputs = [interpolation_for_chunks(data.copy()) for mmsi, data in _data_frame.groupby("mmsi")]
+    return pd.concat([output for output in outputs if output is not None], ignore_index=True)
+
+
+def sorted_entries(_data_frame):
+    _data_frame = _data_frame.astype({column: np.float64 for column in ["id", "mmsi"]})
+    return _data_frame.sort_values(by=["mmsi", "pd_timestamp"], kind="stable", ignore_index=True)
+
+
+def main():
+    if len(sys.argv) != 2:
+        print(f"Usage: {sys.argv[0]} <combined deployment '*_clean_ais_data' dataset>")
+        sys.exit(1)
+
+    data_frame = read_ais_dataset(sys.argv[1])
+    print(f"{data_frame.shape[0]} AIS entries across {data_frame.mmsi.unique().shape[0]} MMSI's")
+
+    start_time = time.time()
+    reference = interpolate_by_mmsi(data_frame)
+    reference_elapsed = time.time() - start_time
+
+    start_time = time.time()
+    interpolated = interpolate_tracks(data_frame)
+    kernel_elapsed = time.time() - start_time
+
+    print(f"  {reference.shape[0]} interpolated entries")
+    print(f"  per MMSI: {reference_elapsed:8.3f} s")
+    print(f"  kernel:   {kernel_elapsed:8.3f} s")
+
+    reference = sorted_entries(reference[interpolated.columns])
+    interpolated = sorted_entries(interpolated)
+    mismatches = [
+        column
+        for column in interpolated.columns
+        if not reference[column].astype(interpolated[column].dtype).equals(interpolated[column])
+    ]
+    if reference.shape != interpolated.shape or mismatches:
+        print(f"  The interpolations differ on {mismatches}")
+        sys.exit(1)
+    print("  The interpolations are identical")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from identify import write_interval_ais_store
+from interval_store import IntervalAisStore
+from utils import AisDatasetWriter, zulu_column_to_timestamps
+
+
+def synthetic_messages():
+    # Two vessels a minute apart, from 01:10 to 01:20, with the AIS timestamps kept as zulu strings.
+    timestamps = pd.date_range("2020-08-05T01:10:00Z", "2020-08-05T01:20:00Z", freq="1min")
+    data_frame = pd.DataFrame(
+        {
+            "ais_timestamp": np.repeat(timestamps.strftime("%Y%m%dT%H%M%S.000Z"), 2),
+            "mmsi": np.tile(np.array([316001000, 316002000], dtype=np.int32), timestamps.shape[0]),
+            "id": np.ones(2 * timestamps.shape[0], dtype=np.uint8),
+            "x": np.linspace(-123.0, -122.9, 2 * timestamps.shape[0]),
+            "y": np.linspace(48.0, 48.1, 2 * timestamps.shape[0]),
+            "distance_to_hydrophone": np.linspace(1000.0, 2000.0, 2 * timestamps.shape[0]),
+        }
+    )
+    data_frame["pd_timestamp"] = zulu_column_to_timestamps(data_frame["ais_timestamp"])
+
+    return data_frame
+
+
+def main():
+    messages = synthetic_messages()
+    intervals = [
+        # No messages within this interval and its margins, and it is written first.
+        (pd.Timestamp("2020-08-05T00:00:00Z"), pd.Timestamp("2020-08-05T00:05:00Z")),
+        (pd.Timestamp("2020-08-05T01:12:00Z"), pd.Timestamp("2020-08-05T01:15:00Z")),
+    ]
+
+    with tempfile.TemporaryDirectory() as directory:
+        dataset_directory = os.path.join(directory, "clean_ais_data")
+        writer = AisDatasetWriter(dataset_directory, pa.Schema.from_pandas(messages, preserve_index=False))
+        writer.write(messages)
+        writer.close()
+
+        write_interval_ais_store(dataset_directory, intervals, directory, "scenarios")
+        store = IntervalAisStore(directory)
+
+        empty = store.get(intervals[0][0].value, intervals[0][1].value)
+        entries = store.get(intervals[1][0].value, intervals[1][1].value)
+
+    expected = messages[
+        (messages.pd_timestamp >= intervals[1][0] - pd.Timedelta(1, "min"))
+        & (messages.pd_timestamp <= intervals[1][1] + pd.Timedelta(1, "min"))
+    ]
+
+    # The interpolated entries are the ones without an AIS timestamp.
+    entries = entries[entries.ais_timestamp.notna()]
+    if len(store) != 2 or not empty.empty or entries.shape[0] != expected.shape[0]:
+        print(f"  The store holds {len(store)} intervals of {empty.shape[0]} and {entries.shape[0]} messages")
+        sys.exit(1)
+    if not (entries.ais_timestamp.to_numpy() == expected.ais_timestamp.to_numpy()).all():
+        print("  The entries of the store differ from the dataset")
+        sys.exit(1)
+    print("  An empty first interval is stored with the schema of the dataset")
+
+
+if __name__ == "__main__":
+    main()
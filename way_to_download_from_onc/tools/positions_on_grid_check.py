@@ -0,0 +1,81 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from combine import MAXIMUM_DELTA, InterpolatedTracks
+from utils import read_ais_dataset
+
+GRID_COLUMNS = ["x", "y", "distance_to_hydrophone"]
+
+
+def positions_from_densified_table(_densified, _grid):
+    # Every vessel at each grid time, linearly interpolated in time between the messages of the densified table.
+    grid = _grid.asi8
+    maximum_delta = MAXIMUM_DELTA.astype("timedelta64[ns]").astype(np.int64)
+
+    outputs = []
+    messages = _densified[_densified.ais_timestamp.notna()]
+    for mmsi, track in messages.groupby("mmsi", sort=True):
+        times = track.pd_timestamp.values.view(np.int64)
+        on_message = np.searchsorted(times, grid, side="left")
+        previous_rows = np.searchsorted(times, grid, side="right") - 1
+        hits = (on_message < times.size) & (times[np.minimum(on_message, times.size - 1)] == grid)
+        between = (
+            ~hits
+            & (previous_rows >= 0)
+            & (previous_rows + 1 < times.size)
+            & (times[np.minimum(previous_rows + 1, times.size - 1)] - times[np.maximum(previous_rows, 0)] <= maximum_delta)
+        )
+
+        rows = np.flatnonzero(hits | between)
+        if not rows.size:
+            continue
+        previous_rows = np.where(hits, on_message, previous_rows)[rows]
+        next_rows = np.where(hits[rows], previous_rows, previous_rows + 1)
+        durations = times[next_rows] - times[previous_rows]
+        fractions = np.divide(grid[rows] - times[previous_rows], durations, out=np.zeros(rows.size), where=durations > 0)
+
+        output = pd.DataFrame({"pd_timestamp": _grid[rows], "mmsi": np.full(rows.size, mmsi)})
+        for column in GRID_COLUMNS:
+            values = track[column].to_numpy(np.float64)
+            output[column] = values[previous_rows] + (values[next_rows] - values[previous_rows]) * fractions
+        outputs.append(output)
+
+    data_frame = pd.concat(outputs, ignore_index=True)
+    return data_frame.sort_values(by=["pd_timestamp", "mmsi"], kind="stable", ignore_index=True)
+
+
+def main():
+    if len(sys.argv) != 2:
+        print(f"Usage: {sys.argv[0]} <combined deployment '*_clean_ais_data' dataset>")
+        sys.exit(1)
+
+    tracks = InterpolatedTracks(read_ais_dataset(sys.argv[1]))
+    grid = pd.date_range(tracks.first_timestamp.floor("1min"), tracks.last_timestamp.ceil("1min"), freq="1min")
+
+    positions = tracks.positions_on_grid(grid)
+    reference = positions_from_densified_table(tracks.window(tracks.first_timestamp, tracks.last_timestamp), grid)
+    print(f"{positions.shape[0]} positions of {positions.mmsi.unique().shape[0]} MMSI's on {grid.shape[0]} minutes")
+
+    same_keys = positions.shape == reference.shape and (
+        positions[["pd_timestamp", "mmsi"]].astype({"mmsi": np.float64}).equals(
+            reference[["pd_timestamp", "mmsi"]].astype({"mmsi": np.float64})
+        )
+    )
+    mismatches = [
+        column
+        for column in GRID_COLUMNS
+        if not same_keys or not np.allclose(positions[column], reference[column], equal_nan=True)
+    ]
+    if mismatches:
+        print(f"  The positions on the grid differ from the densified table on {mismatches}")
+        sys.exit(1)
+    print("  The positions on the grid match the densified table")
+
+
+if __name__ == "__main__":
+    main()
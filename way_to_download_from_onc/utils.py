@@ -1,10 +1,17 @@
 import os
+import shutil
 import ujson
 import multiprocessing
+import multiprocessing.pool
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
 import pyarrow.feather as feather
 
+from tqdm import tqdm
 from datetime import datetime
 
 
@@ -42,17 +49,237 @@ def create_dir(path, dir_name):
     return dir
 
 
+def list_downloaded_files(directory):
+    # Interrupted downloads are kept as '.part' files until they are resumed and verified.
+    return [file for file in os.listdir(directory) if not file.endswith(".part")]
+
+
 def read_messages_from_json_file(_file):
     with open(_file, "r") as input_file:
         return ujson.load(input_file)
 
 
-def dump_data_frame_to_feather_file(_file, _data_frame):
-    feather.write_feather(_data_frame, _file)
+def is_parsed_ais_file(_file):
+    # Older runs wrote the parsed messages as JSON lists.
+    return _file.endswith("_parsed.parquet") or _file.endswith("_parsed.json")
+
+
+def read_parsed_ais_file(_file, columns=None):
+    if _file.endswith(".json"):
+        data_frame = pd.DataFrame(read_messages_from_json_file(_file))
+        return data_frame if columns is None else data_frame.reindex(columns=columns)
+
+    return pq.read_table(_file, columns=columns).to_pandas()
+
+
+def read_parsed_ais_messages(_file):
+    # The parsed messages as the list of dictionaries the JSON files used to hold.
+    data_frame = read_parsed_ais_file(_file)
+    if data_frame.empty:
+        return []
+
+    data_frame["ais_timestamp"] = nanoseconds_to_zulu_strings(data_frame["ais_timestamp"].values)
+    return [
+        {key: value for key, value in message.items() if not pd.isna(value)}
+        for message in data_frame.to_dict(orient="records")
+    ]
+
+
+class feather_settings:
+    # Set from the main.py flags: the compression of the feather files written by each step, keyed by step name.
+    # Steps that are not listed keep the pyarrow default (lz4).
+    COMPRESSION = {}
+
+
+FEATHER_COMPRESSIONS = ("uncompressed", "lz4", "zstd")
+
+
+def configure_feather_compression(compression=None):
+    compression = dict(compression or {})
+    for step, codec in compression.items():
+        if codec not in FEATHER_COMPRESSIONS:
+            raise ValueError(f"Unknown compression '{codec}' for step '{step}', expected one of {FEATHER_COMPRESSIONS}")
+
+    feather_settings.COMPRESSION = compression
+
+
+def dump_data_frame_to_feather_file(_file, _data_frame, step=None):
+    feather.write_feather(_data_frame, _file, compression=feather_settings.COMPRESSION.get(step))
+
+
+def read_arrow_table_from_feather_file(_file, columns=None, row_filter=None):
+    '''
+    The Arrow table of a feather file, with only the given columns and, when
+    row_filter (a pyarrow.compute expression, e.g.
+    pc.field("distance_to_hydrophone") <= 3000) is given, only the matching
+    rows. The file is memory-mapped: the columns of uncompressed files are
+    zero-copy views on it, compressed columns are decompressed one by one.
+    '''
+
+    table = feather.read_table(_file, columns=columns, memory_map=True)
+    if row_filter is not None:
+        table = table.filter(row_filter)
+
+    return table
+
+
+def arrow_column_to_numpy(_column):
+    # A view on the Arrow buffer when the column is a single chunk of numbers without nulls, a copy otherwise.
+    if _column.num_chunks == 1:
+        return _column.chunk(0).to_numpy(zero_copy_only=False)
+
+    return _column.to_numpy()
+
+
+def read_data_frame_from_feather_file(_file, columns=None, row_filter=None):
+    return read_arrow_table_from_feather_file(_file, columns=columns, row_filter=row_filter).to_pandas()
+
+
+# Rows of the row groups of the AIS datasets. Readers skip the row groups whose statistics are outside their range.
+AIS_DATASET_ROW_GROUP_ROWS = 65536
+AIS_DATASET_STATISTICS = ["pd_timestamp", "distance_to_hydrophone"]
+AIS_DATASET_PARTITIONING = ds.partitioning(pa.schema([("day", pa.string())]), flavor="hive")
+
+
+class AisDatasetWriter:
+    '''
+    Writes AIS entries that come sorted by pd_timestamp into a Parquet
+    dataset partitioned by day ('day=YYYY-MM-DD' directories, one file each),
+    in row groups of row_group_rows rows with min/max statistics on the
+    AIS_DATASET_STATISTICS columns. The dataset is written next to its
+    directory and only moved into place once closed.
+    '''
+
+    def __init__(self, directory, schema, row_group_rows=AIS_DATASET_ROW_GROUP_ROWS):
+        self.directory = directory
+        self.partial_directory = directory + ".part"
+        self.schema = schema
+        self.row_group_rows = row_group_rows
+        self.day = None
+        self.writer = None
+        self.pending = []
+        self.rows = 0
+        self.mmsi = set()
+
+        if os.path.isdir(self.partial_directory):
+            shutil.rmtree(self.partial_directory)
+        os.makedirs(self.partial_directory)
+
+    def _flush(self, complete=False):
+        # Full row groups, and the rest of the day once it is complete.
+        table = pa.concat_tables(self.pending) if self.pending else self.schema.empty_table()
+        rows = table.num_rows if complete else table.num_rows - table.num_rows % self.row_group_rows
+        if rows:
+            self.writer.write_table(table.slice(0, rows), row_group_size=self.row_group_rows)
+        self.pending = [table.slice(rows)] if rows < table.num_rows else []
+
+    def _open_day(self, day):
+        if self.writer is not None:
+            self._flush(complete=True)
+            self.writer.close()
+
+        self.day = day
+        day_directory = create_dir(self.partial_directory, f"day={day}")
+        self.writer = pq.ParquetWriter(
+            os.path.join(day_directory, "part-0.parquet"),
+            self.schema,
+            write_statistics=AIS_DATASET_STATISTICS,
+        )
+
+    def write(self, data_frame):
+        if data_frame.empty:
+            return
+
+        days = data_frame.pd_timestamp.dt.strftime("%Y-%m-%d").to_numpy()
+        day_starts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]])
+        for start, end in zip(day_starts, np.r_[day_starts[1:], days.size]):
+            if days[start] != self.day:
+                self._open_day(days[start])
+            self.pending.append(pa.Table.from_pandas(data_frame.iloc[start:end], schema=self.schema, preserve_index=False))
+            self._flush()
+
+        self.rows += data_frame.shape[0]
+        self.mmsi.update(data_frame.mmsi.unique())
+
+    def close(self):
+        if self.writer is not None:
+            self._flush(complete=True)
+            self.writer.close()
+
+        if os.path.isdir(self.directory):
+            shutil.rmtree(self.directory)
+        os.replace(self.partial_directory, self.directory)
+
+
+def _timestamp_scalar(_timestamp):
+    return pa.scalar(pd.Timestamp(_timestamp).value, type=pa.timestamp("ns", tz="UTC"))
+
+
+def read_ais_dataset(_directory, columns=None, begin=None, end=None, maximum_distance=None):
+    '''
+    The AIS entries of a dataset written by AisDatasetWriter from begin to
+    end (both included, UTC) and up to maximum_distance from the hydrophone,
+    sorted by pd_timestamp. The predicates are pushed down to the scan: only
+    the days, and then the row groups, whose statistics overlap them are
+    decoded.
+    '''
+
+    dataset = ds.dataset(_directory, format="parquet", partitioning=AIS_DATASET_PARTITIONING)
+
+    predicates = []
+    if begin is not None:
+        predicates.append(ds.field("day") >= pd.Timestamp(begin).strftime("%Y-%m-%d"))
+        predicates.append(ds.field("pd_timestamp") >= _timestamp_scalar(begin))
+    if end is not None:
+        predicates.append(ds.field("day") <= pd.Timestamp(end).strftime("%Y-%m-%d"))
+        predicates.append(ds.field("pd_timestamp") <= _timestamp_scalar(end))
+    if maximum_distance is not None:
+        predicates.append(ds.field("distance_to_hydrophone") <= maximum_distance)
+
+    predicate = None
+    for condition in predicates:
+        predicate = condition if predicate is None else predicate & condition
+
+    columns = columns or [name for name in dataset.schema.names if name != "day"]
+    data_frame = dataset.to_table(columns=columns, filter=predicate).to_pandas()
 
+    if "pd_timestamp" not in data_frame.columns:
+        return data_frame
+    return data_frame.sort_values(by="pd_timestamp", kind="stable", ignore_index=True)
 
-def read_data_frame_from_feather_file(_file):
-    return feather.read_feather(_file)
+
+def get_ais_dataset_time_range(_directory):
+    '''
+    The first and last pd_timestamp of a dataset written by AisDatasetWriter,
+    from the statistics of its row groups. None when it is empty.
+    '''
+
+    minimum = None
+    maximum = None
+    for fragment in ds.dataset(_directory, format="parquet", partitioning=AIS_DATASET_PARTITIONING).get_fragments():
+        metadata = fragment.metadata
+        column = metadata.schema.names.index("pd_timestamp")
+        for row_group in range(metadata.num_row_groups):
+            statistics = metadata.row_group(row_group).column(column).statistics
+            if statistics is None or not statistics.has_min_max:
+                continue
+            minimum = statistics.min_raw if minimum is None else min(minimum, statistics.min_raw)
+            maximum = statistics.max_raw if maximum is None else max(maximum, statistics.max_raw)
+
+    if minimum is None:
+        return None
+
+    return pd.Timestamp(minimum, tz="UTC"), pd.Timestamp(maximum, tz="UTC")
+
+
+def get_ais_dataset_schema(_directory):
+    '''
+    The Arrow schema of the entries of a dataset written by AisDatasetWriter,
+    without the day partition column.
+    '''
+
+    schema = ds.dataset(_directory, format="parquet", partitioning=AIS_DATASET_PARTITIONING).schema
+    return schema.remove(schema.get_field_index("day")).remove_metadata()
 
 
 def get_num_of_threads(use_all_threads=False):
@@ -61,6 +288,97 @@ def get_num_of_threads(use_all_threads=False):
     if not use_all_threads:
         number_of_threads = int(number_of_threads / 2)
 
+    return max(number_of_threads, 1)
+
+
+class executor_settings:
+    # Set from the main.py flags. When set, they override the defaults that every stage passes to run_tasks.
+    BACKEND = None
+    WORKERS = None
+    CHUNKSIZE = None
+
+
+EXECUTOR_BACKENDS = ("serial", "thread", "process")
+
+
+def configure_executor(backend=None, workers=None, chunksize=None):
+    executor_settings.BACKEND = backend
+    executor_settings.WORKERS = workers
+    executor_settings.CHUNKSIZE = chunksize
+
+
+# Process pools start their workers with "spawn": the steps run in threads of the pipeline (see
+# pipeline.run_pipeline), and a forked worker could inherit a lock held by another thread. Spawned workers are
+# still children of this process, so their CPU time is accounted for in the run log.
+PROCESS_START_METHOD = "spawn"
+
+
+def _initialize_worker(_feather_compression):
+    # Spawned workers start from a new interpreter, without the settings made by main.py.
+    feather_settings.COMPRESSION = _feather_compression
+
+
+def run_tasks(
+    function,
+    tasks,
+    backend="process",
+    workers=None,
+    chunksize=1,
+    ordered=True,
+    description=None,
+    stage_settings=False,
+):
+    '''
+    Run function over every task with the serial, thread or process backend
+    and yield the results as they come, in the order of the tasks when
+    ordered. The backend, workers (all the cores by default) and chunksize
+    are the defaults of the calling stage, overridden by executor_settings.
+    With stage_settings, the backend and workers come from the stage's own
+    flags (e.g. --parse_workers) and take precedence over executor_settings.
+    Progress is reported with tqdm.
+    '''
+
+    tasks = list(tasks)
+    if not stage_settings:
+        backend = executor_settings.BACKEND or backend
+        workers = executor_settings.WORKERS or workers
+    workers = workers or get_num_of_threads(use_all_threads=True)
+    chunksize = executor_settings.CHUNKSIZE or chunksize
+
+    if backend not in EXECUTOR_BACKENDS:
+        raise ValueError(f"Unknown executor backend '{backend}', expected one of {EXECUTOR_BACKENDS}")
+
+    progress = tqdm(total=len(tasks), desc=description)
+
+    if backend == "serial" or workers == 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield function(task)
+            progress.update()
+        progress.close()
+        return
+
+    if backend == "thread":
+        pool = multiprocessing.pool.ThreadPool(processes=min(workers, len(tasks)))
+    else:
+        pool = multiprocessing.get_context(PROCESS_START_METHOD).Pool(
+            processes=min(workers, len(tasks)),
+            initializer=_initialize_worker,
+            initargs=(dict(feather_settings.COMPRESSION),),
+        )
+    try:
+        results = pool.imap(function, tasks, chunksize) if ordered else pool.imap_unordered(function, tasks, chunksize)
+        for result in results:
+            yield result
+            progress.update()
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        # Joining the workers also accounts for their CPU time in the run log.
+        pool.join()
+        progress.close()
+
 
 def get_hydrophone_deployments(deployments_directory):
     # Read in the hydrophone deployments as we need the deployment details for distance calculations.
@@ -95,6 +413,165 @@ def zulu_string_to_datetime(_timestamp):
     return datetime.strptime(_timestamp, '%Y%m%dT%H%M%S.%f'+'Z')
 
 
+# Fixed layouts of the timestamps, 'YYYYMMDDThhmmss.fffZ' (zulu) and 'YYYY-MM-DDThh:mm:ss.fffZ' (ONC).
+ZULU_TIMESTAMP_LENGTH = 20
+ONC_TIMESTAMP_LENGTH = 24
+
+# Positions of the zulu characters in the ONC layout.
+ONC_TO_ZULU_CHARACTERS = [0, 1, 2, 3, 5, 6, 8, 9, 10, 11, 12, 14, 15, 17, 18, 19, 20, 21, 22, 23]
+
+NANOSECONDS_PER_MILLISECOND = 1000000
+MILLISECONDS_PER_DAY = 86400000
+
+
+def _days_from_civil(_year, _month, _day):
+    # Days since 1970-01-01 of proleptic Gregorian dates, from http://howardhinnant.github.io/date_algorithms.html
+    year = _year - (_month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (_month + np.where(_month > 2, -3, 9)) + 2) // 5 + _day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+
+    return era * 146097 + day_of_era - 719468
+
+
+def _civil_from_days(_days):
+    days = _days + 719468
+    era = days // 146097
+    day_of_era = days - era * 146097
+    year_of_era = (day_of_era - day_of_era // 1460 + day_of_era // 36524 - day_of_era // 146096) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 - year_of_era // 100)
+    shifted_month = (5 * day_of_year + 2) // 153
+    day = day_of_year - (153 * shifted_month + 2) // 5 + 1
+    month = shifted_month + np.where(shifted_month < 10, 3, -9)
+
+    return year_of_era + era * 400 + (month <= 2), month, day
+
+
+def zulu_strings_to_nanoseconds(_timestamps):
+    '''
+    Parse a whole array (list, NumPy, pandas or Arrow) of zulu or ONC
+    formatted timestamps into int64 nanoseconds since the epoch, working on
+    the characters as a 2D array of bytes instead of one datetime at a time.
+    '''
+
+    if isinstance(_timestamps, (pa.Array, pa.ChunkedArray)):
+        _timestamps = _timestamps.to_numpy(zero_copy_only=False)
+
+    timestamps = np.asarray(_timestamps)
+    if timestamps.size == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    length = len(timestamps.flat[0])
+    characters = np.frombuffer(timestamps.astype(f"S{length}").tobytes(), dtype=np.uint8).reshape(-1, length)
+    if length == ONC_TIMESTAMP_LENGTH:
+        characters = characters[:, ONC_TO_ZULU_CHARACTERS]
+
+    separators = characters[:, [8, 15, 19]]
+    if characters.shape[1] != ZULU_TIMESTAMP_LENGTH or (separators != np.frombuffer(b"T.Z", dtype=np.uint8)).any():
+        raise ValueError(f"Timestamps do not match the zulu or ONC layouts, e.g. '{timestamps[0]}'")
+
+    digits = characters.astype(np.int64) - ord("0")
+
+    def number(_first, _last):
+        weights = 10 ** np.arange(_last - _first - 1, -1, -1, dtype=np.int64)
+        return digits[:, _first:_last] @ weights
+
+    days = _days_from_civil(number(0, 4), number(4, 6), number(6, 8))
+    milliseconds = (
+        (days * 24 + number(9, 11)) * 60 + number(11, 13)
+    ) * 60000 + number(13, 15) * 1000 + number(16, 19)
+
+    return milliseconds * NANOSECONDS_PER_MILLISECOND
+
+
+def _format_nanoseconds(_nanoseconds, _layout):
+    nanoseconds = np.asarray(_nanoseconds)
+    if np.issubdtype(nanoseconds.dtype, np.datetime64):
+        nanoseconds = nanoseconds.astype("datetime64[ns]").view(np.int64)
+
+    # Milliseconds are truncated, like the strftime based formatting.
+    milliseconds = nanoseconds.astype(np.int64) // NANOSECONDS_PER_MILLISECOND
+    days, milliseconds_of_day = np.divmod(milliseconds, MILLISECONDS_PER_DAY)
+    year, month, day = _civil_from_days(days)
+
+    fields = {
+        "Y": (year, 4),
+        "m": (month, 2),
+        "d": (day, 2),
+        "H": (milliseconds_of_day // 3600000, 2),
+        "M": (milliseconds_of_day // 60000 % 60, 2),
+        "S": (milliseconds_of_day // 1000 % 60, 2),
+        "f": (milliseconds_of_day % 1000, 3),
+    }
+
+    columns = []
+    for token in _layout:
+        if token in fields:
+            value, width = fields[token]
+            for power in range(width - 1, -1, -1):
+                columns.append(value // 10 ** power % 10 + ord("0"))
+        else:
+            columns.append(np.full(nanoseconds.shape, ord(token)))
+
+    characters = np.stack(columns, axis=-1).astype(np.uint8)
+
+    return characters.view(f"S{len(columns)}")[..., 0].astype(f"U{len(columns)}")
+
+
+def nanoseconds_to_zulu_strings(_nanoseconds):
+    # Inverse of zulu_strings_to_nanoseconds, as 'YYYYMMDDThhmmss.fffZ' strings.
+    return _format_nanoseconds(_nanoseconds, "YmdTHMS.fZ")
+
+
+def nanoseconds_to_onc_strings(_nanoseconds):
+    # Same as pandas_timestamp_to_onc_format, for a whole array.
+    return _format_nanoseconds(_nanoseconds, "Y-m-dTH:M:S.fZ")
+
+
+def zulu_column_to_timestamps(_column):
+    # The UTC timestamps of a column that holds either timestamps already or zulu/ONC strings.
+    if pd.api.types.is_datetime64_any_dtype(_column):
+        return pd.to_datetime(_column, utc=True)
+
+    return pd.Series(
+        pd.to_datetime(zulu_strings_to_nanoseconds(_column), utc=True),
+        index=getattr(_column, "index", None),
+    )
+
+
+def get_coarse_bounds(latitude, longitude, inclusion_radius):
+    '''
+    Return the (left, right, top, bottom) bounds in degrees of a box around
+    a point that contains every position up to inclusion_radius metres away,
+    with a 2 km margin. A degree of longitude shrinks with cos(latitude).
+    '''
+
+    coarse_offset = inclusion_radius + 2000.0
+    earth_curvature = 6378137.0
+
+    latitude_offset = np.degrees(coarse_offset / earth_curvature)
+    longitude_offset = np.degrees(coarse_offset / (earth_curvature * np.cos(np.radians(latitude))))
+
+    return (
+        longitude - longitude_offset,
+        longitude + longitude_offset,
+        latitude + latitude_offset,
+        latitude - latitude_offset,
+    )
+
+
+def get_deployment_partition_name(device, deployment_begin, deployment_end):
+    # Same prefix as the combined deployment files, e.g. 'ICLISTENAF2523_20200804T000000.000Z_20200808T000000.000Z'.
+    return "_".join(
+        [
+            device,
+            pandas_timestamp_to_zulu_format(deployment_begin),
+            pandas_timestamp_to_zulu_format(deployment_end),
+        ]
+    )
+
+
 def get_exclusion_radius(inclusion_radius):
     return inclusion_radius+2000
 